@@ -1,33 +1,143 @@
-from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse, HTMLResponse
+from contextlib import asynccontextmanager
+from fastapi import Depends, FastAPI, Request, HTTPException
+from fastapi.responses import JSONResponse, HTMLResponse, Response
 import httpx
 import os
 
-app = FastAPI(title="ZTA Demo App with Microservices", version="5.0")
+from zta_common import (
+    AdmissionMiddleware, AuditLog, AuthMiddleware, CompressionMiddleware, Compressor, ConcurrencyLimiter, Identity,
+    Lifecycle, LifecycleMiddleware, MetricsMiddleware, MetricsRegistry, PolicyEngine, PolicyMiddleware, RateLimiter,
+    ResponseCache, TokenVerifier, Tracer, TracingMiddleware, UpstreamBalancer, get_identity,
+)
+from zta_common.admission import Overloaded, overloaded_response
+from zta_common.batch import handle_batch
+from zta_common.cache import CachedResponse
+from zta_common.env import env_int, env_list, env_str
+from zta_common.identity import cache_info as identity_cache_info
+from zta_common.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+from zta_common.templates import Template, render_html
 
 # TKB service URL (running on AWS via WireGuard)
 TKB_SERVICE_URL = os.getenv("TKB_SERVICE_URL", "http://10.200.0.1:30080")
+# Optional comma-separated list of TKB replicas; requests are balanced by latency
+TKB_SERVICE_URLS = env_list("TKB_SERVICE_URLS", [TKB_SERVICE_URL])
+# "json": GETs are cached and annotated with a _proxy field (default)
+# "stream": every request is streamed through untouched, metadata in headers
+TKB_PROXY_MODE = os.getenv("TKB_PROXY_MODE", "json")
+# tkb-service only serves GET, and authz.rego grants only GET on /api/tkb. To
+# proxy another method, add it here together with its role_permissions entry;
+# non-GET requests are always streamed, body included.
+PROXY_METHODS = ["GET"]
+PROXY_HEADERS = {
+    "X-Proxied-By": "demo-app (OpenStack)",
+    "X-Target-Service": "tkb-service (AWS Singapore)",
+    "X-Proxy-Connection": "WireGuard VPN Tunnel",
+}
 
-@app.get("/", response_class=HTMLResponse)
-async def home(request: Request):
-    user = request.headers.get("x-forwarded-user", "anonymous")
-    groups = request.headers.get("x-forwarded-groups", "none")
-    
-    html = f"""
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled client per TKB endpoint for the whole app lifetime, so proxied
+    # calls reuse warm connections through the WireGuard tunnel; the balancer
+    # health-checks them and sends each request to the fastest one. Every call
+    # that actually crosses the tunnel holds a TKB_LIMIT slot.
+    METRICS.register_routes(app.routes)
+    app.state.tkb = UpstreamBalancer.from_env("tkb-service", TKB_SERVICE_URLS, "TKB",
+                                              metrics=METRICS.upstream("tkb-service"), limiter=TKB_LIMIT)
+    await app.state.tkb.start()
+    # The schedule changes rarely: cache it per (path, role set) and let one
+    # upstream call serve every concurrent request for the same key.
+    app.state.tkb_cache = ResponseCache.from_env("TKB")
+    if AUTH is not None:
+        await AUTH.start()
+    AUDIT.start()
+    TRACER.start()
+    # /ready stays 503 until the warmup steps below have run
+    await LIFECYCLE.start()
+    try:
+        yield
+    finally:
+        await LIFECYCLE.stop()
+        await app.state.tkb.aclose()
+        if AUTH is not None:
+            await AUTH.aclose()
+        await AUDIT.stop()
+        await TRACER.aclose()
+
+
+app = FastAPI(title="ZTA Demo App with Microservices", version="5.0", lifespan=lifespan)
+
+# RBAC compiled from policies/opa/authz.rego and enforced in-process;
+# decisions go to a batched JSON-lines audit log (stdout -> promtail)
+POLICY = PolicyEngine.from_file()
+AUDIT = AuditLog.from_env()
+
+# Admission control inside the policy check: per-user token buckets (limits per
+# role, ADMISSION_RATE_<ROLE>), shedding with 429. Calls to tkb-service take a
+# slot from a bounded pool + wait queue (TKB_MAX_CONCURRENCY / TKB_QUEUE_SIZE)
+# and are shed with 503; cache hits and coalesced requests never wait for one.
+RATES = RateLimiter.from_env(POLICY)
+TKB_LIMIT = ConcurrencyLimiter.from_env("tkb-service", "TKB")
+app.add_middleware(AdmissionMiddleware, engine=POLICY, rates=RATES)
+app.add_middleware(PolicyMiddleware, engine=POLICY, audit=AUDIT)
+
+# AUTH_MODE=jwt: identity comes from the Keycloak token, verified locally
+# against the realm JWKS, instead of the x-forwarded-* headers
+AUTH = TokenVerifier.from_env("OIDC") if env_str("AUTH_MODE", "headers") == "jwt" else None
+if AUTH is not None:
+    app.add_middleware(AuthMiddleware, verifier=AUTH)
+
+# W3C traceparent in and out: a server span per request with RBAC, handler and
+# tkb-service client spans under it, sampled at TRACE_SAMPLE_RATIO and exported
+# with TRACE_EXPORTER=file|otlp (default: propagate only)
+TRACER = Tracer.from_env("demo-app-v5")
+app.add_middleware(TracingMiddleware, tracer=TRACER)
+
+# /ready turns green only after warmup: TKB connections opened through the
+# tunnel, then the home page, /api/me and /api/tkb (per role, which fills the
+# schedule cache) requested in-process. The home page and /api/me are local,
+# so if they fail the pod stays unready. In stream mode nothing is cached and
+# a schedule may be any size, so /api/tkb is not requested. On SIGTERM /ready
+# turns red, requests are served for LIFECYCLE_DRAIN_DELAY more seconds, then
+# in-flight /api/* calls get until LIFECYCLE_DRAIN_TIMEOUT to finish.
+LIFECYCLE = Lifecycle.from_env()
+LIFECYCLE.add_step("tkb connections", lambda: app.state.tkb.warm(env_int("TKB_WARM_CONNECTIONS", 4)))
+LIFECYCLE.add_self_request(app, "/", engine=POLICY, required=True)
+LIFECYCLE.add_self_request(app, "/api/me", ("sinhvien",), engine=POLICY, required=True)
+if TKB_PROXY_MODE != "stream":
+    LIFECYCLE.add_self_request(app, "/api/tkb", ("sinhvien",), engine=POLICY)
+    LIFECYCLE.add_self_request(app, "/api/tkb", ("giangvien",), engine=POLICY)
+app.add_middleware(LifecycleMiddleware, lifecycle=LIFECYCLE)
+
+# gzip/br/zstd per Accept-Encoding for pages and JSON of COMPRESS_MIN_SIZE bytes or
+# more; compressed variants cached by body digest in a bounded LRU
+# (COMPRESS_CACHE_ENTRIES / COMPRESS_CACHE_BYTES), except per-user private pages;
+# for those the home template's static fragments are cached per encoding instead.
+# Proxied tkb bodies that arrive compressed pass through as they are.
+COMPRESSOR = Compressor.from_env()
+app.add_middleware(CompressionMiddleware, compressor=COMPRESSOR)
+
+# Added last so it wraps everything, including policy denials
+METRICS = MetricsRegistry()
+app.add_middleware(MetricsMiddleware, registry=METRICS)
+
+# Static page shell compiled once at startup; requests only splice in the
+# escaped identity fields.
+HOME_TEMPLATE = Template("""
     <!DOCTYPE html>
     <html>
     <head>
         <title>ZTA Demo - Microservices</title>
         <style>
-            body {{ font-family: Arial, sans-serif; margin: 40px; background: #f5f5f5; }}
-            .container {{ max-width: 800px; margin: 0 auto; background: white; padding: 30px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }}
-            h1 {{ color: #2c3e50; }}
-            .user-info {{ background: #e8f5e9; padding: 15px; border-radius: 5px; margin: 20px 0; }}
-            .api-list {{ background: #e3f2fd; padding: 15px; border-radius: 5px; }}
-            .api-list a {{ display: block; padding: 10px; margin: 5px 0; background: #1976d2; color: white; text-decoration: none; border-radius: 5px; }}
-            .api-list a:hover {{ background: #1565c0; }}
-            .microservice {{ background: #fff3e0; padding: 15px; border-radius: 5px; margin: 20px 0; }}
-            .aws-badge {{ background: #ff9800; color: white; padding: 3px 8px; border-radius: 3px; font-size: 12px; }}
+            body { font-family: Arial, sans-serif; margin: 40px; background: #f5f5f5; }
+            .container { max-width: 800px; margin: 0 auto; background: white; padding: 30px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }
+            h1 { color: #2c3e50; }
+            .user-info { background: #e8f5e9; padding: 15px; border-radius: 5px; margin: 20px 0; }
+            .api-list { background: #e3f2fd; padding: 15px; border-radius: 5px; }
+            .api-list a { display: block; padding: 10px; margin: 5px 0; background: #1976d2; color: white; text-decoration: none; border-radius: 5px; }
+            .api-list a:hover { background: #1565c0; }
+            .microservice { background: #fff3e0; padding: 15px; border-radius: 5px; margin: 20px 0; }
+            .aws-badge { background: #ff9800; color: white; padding: 3px 8px; border-radius: 3px; font-size: 12px; }
         </style>
     </head>
     <body>
@@ -36,8 +146,8 @@ async def home(request: Request):
             
             <div class="user-info">
                 <h3>👤 User Information</h3>
-                <p><strong>User:</strong> {user}</p>
-                <p><strong>Groups:</strong> {groups}</p>
+                <p><strong>User:</strong> {{user}}</p>
+                <p><strong>Groups:</strong> {{groups}}</p>
             </div>
             
             <div class="api-list">
@@ -65,28 +175,34 @@ User → Istio Gateway → OAuth2-Proxy → Keycloak (Auth)
         </div>
     </body>
     </html>
-    """
-    return HTMLResponse(content=html)
+    """)
+
+@app.get("/", response_class=HTMLResponse)
+async def home(request: Request, identity: Identity = Depends(get_identity)):
+    return render_html(request, HOME_TEMPLATE, {
+        "user": identity.user or "anonymous",
+        "groups": identity.groups or "none",
+    })
 
 @app.get("/api/me")
-async def get_me(request: Request):
+async def get_me(identity: Identity = Depends(get_identity)):
     return {
-        "user": request.headers.get("x-forwarded-user", "anonymous"),
-        "email": request.headers.get("x-forwarded-email", ""),
-        "groups": request.headers.get("x-forwarded-groups", ""),
+        "user": identity.user or "anonymous",
+        "email": identity.email or "",
+        "groups": identity.groups or "",
+        "roles": sorted(identity.roles),
         "service": "demo-app",
         "location": "OpenStack On-Premises"
     }
 
 @app.get("/api/giangvien")
-async def giangvien_only(request: Request):
-    groups = request.headers.get("x-forwarded-groups", "")
-    user = request.headers.get("x-forwarded-user", "anonymous")
+async def giangvien_only(identity: Identity = Depends(get_identity)):
+    user = identity.user or "anonymous"
     
-    if "giangvien" not in groups:
+    if not identity.has_role("giangvien"):
         raise HTTPException(
             status_code=403,
-            detail=f"Access denied. User '{user}' with groups '{groups}' is not a giangvien."
+            detail=f"Access denied. User '{user}' with groups '{identity.groups or ''}' is not a giangvien."
         )
     
     return {
@@ -103,11 +219,11 @@ async def giangvien_only(request: Request):
     }
 
 @app.get("/api/sinhvien")
-async def sinhvien_access(request: Request):
-    groups = request.headers.get("x-forwarded-groups", "")
-    user = request.headers.get("x-forwarded-user", "anonymous")
+async def sinhvien_access(identity: Identity = Depends(get_identity)):
+    user = identity.user or "anonymous"
+    is_sinhvien = identity.has_role("sinhvien")
     
-    if "sinhvien" not in groups and "giangvien" not in groups:
+    if not is_sinhvien and not identity.has_role("giangvien"):
         raise HTTPException(
             status_code=403,
             detail=f"Access denied. User '{user}' needs sinhvien or giangvien role."
@@ -116,7 +232,7 @@ async def sinhvien_access(request: Request):
     return {
         "message": "Student Portal",
         "user": user,
-        "role": "sinhvien" if "sinhvien" in groups else "giangvien",
+        "role": "sinhvien" if is_sinhvien else "giangvien",
         "data": {
             "gpa": 3.5,
             "credits": 120,
@@ -125,56 +241,118 @@ async def sinhvien_access(request: Request):
         "location": "OpenStack"
     }
 
+def tkb_unavailable(e: Exception) -> JSONResponse:
+    return JSONResponse(
+        status_code=503,
+        content={
+            "error": "TKB service unavailable",
+            "detail": str(e),
+            "target": TKB_SERVICE_URL,
+            "note": "AWS microservice may be unreachable via WireGuard VPN"
+        }
+    )
+
 # Proxy to TKB microservice on AWS
-@app.get("/api/tkb")
-@app.get("/api/tkb/{path:path}")
-async def proxy_tkb(request: Request, path: str = ""):
+@app.api_route("/api/tkb", methods=PROXY_METHODS)
+@app.api_route("/api/tkb/{path:path}", methods=PROXY_METHODS)
+async def proxy_tkb(request: Request, path: str = "", identity: Identity = Depends(get_identity)):
     """Proxy requests to TKB microservice running on AWS"""
     
-    # Forward headers from oauth2-proxy
+    # Forward the caller identity in the x-forwarded-* form tkb-service reads
     headers = {
-        "x-forwarded-user": request.headers.get("x-forwarded-user", ""),
-        "x-forwarded-groups": request.headers.get("x-forwarded-groups", ""),
-        "x-forwarded-email": request.headers.get("x-forwarded-email", ""),
+        "x-forwarded-user": identity.user or "",
+        "x-forwarded-groups": identity.groups or "",
+        "x-forwarded-email": identity.email or "",
     }
     
-    target_url = f"{TKB_SERVICE_URL}/api/tkb"
-    if path:
-        target_url = f"{TKB_SERVICE_URL}/api/tkb/{path}"
+    target_path = f"/api/tkb/{path}" if path else "/api/tkb"
+    tkb = request.app.state.tkb
+    
+    if TKB_PROXY_MODE == "stream" or request.method != "GET":
+        try:
+            return await tkb.stream(request, target_path,
+                                    identity_headers=headers, response_headers=PROXY_HEADERS)
+        except Overloaded as e:
+            return overloaded_response(e)
+        except httpx.ConnectError as e:
+            return tkb_unavailable(e)
+        except httpx.HTTPError as e:
+            return JSONResponse(status_code=500, content={"error": "Proxy error", "detail": str(e)})
+    
+    async def fetch(etag):
+        # Revalidate with the cached ETag so an unchanged schedule costs a 304
+        upstream_headers = {**headers, "if-none-match": etag} if etag else headers
+        response = await tkb.get(target_path, headers=upstream_headers)
+        return CachedResponse(
+            status=response.status_code,
+            body=response.content,
+            content_type=response.headers.get("content-type"),
+            etag=response.headers.get("etag"),
+            cache_control=response.headers.get("cache-control", ""),
+        )
     
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.get(target_url, headers=headers)
-            
-            data = response.json()
-            # Add proxy info
-            data["_proxy"] = {
-                "proxied_by": "demo-app (OpenStack)",
-                "target_service": "tkb-service (AWS Singapore)",
-                "connection": "WireGuard VPN Tunnel"
-            }
-            return JSONResponse(content=data, status_code=response.status_code)
-            
+        # Schedules differ per role, so the role set is part of the key
+        cached, outcome = await request.app.state.tkb_cache.get((target_path, identity.roles), fetch)
+        
+        # Shallow copy: the parsed body is shared with other requests in the cache
+        data = dict(cached.json())
+        if "user" in data:
+            data["user"] = identity.user
+        # Add proxy info
+        data["_proxy"] = {
+            "proxied_by": "demo-app (OpenStack)",
+            "target_service": "tkb-service (AWS Singapore)",
+            "connection": "WireGuard VPN Tunnel",
+            "cache": outcome
+        }
+        return JSONResponse(content=data, status_code=cached.status, headers={**PROXY_HEADERS, "X-Cache": outcome.upper()})
+        
+    except Overloaded as e:
+        return overloaded_response(e)
     except httpx.ConnectError as e:
-        return JSONResponse(
-            status_code=503,
-            content={
-                "error": "TKB service unavailable",
-                "detail": str(e),
-                "target": TKB_SERVICE_URL,
-                "note": "AWS microservice may be unreachable via WireGuard VPN"
-            }
-        )
+        return tkb_unavailable(e)
     except Exception as e:
         return JSONResponse(
             status_code=500,
             content={"error": "Proxy error", "detail": str(e)}
         )
 
+@app.get("/api/batch")
+async def batch(request: Request):
+    """Several GET /api/* calls (including /api/tkb) in one request: ?items=/api/me,/api/tkb[&stream=1]"""
+    return await handle_batch(request, POLICY, AUDIT)
+
 @app.get("/health")
 async def health():
     return {"status": "healthy", "service": "demo-app", "version": "5.0"}
 
+@app.get("/ready")
+async def ready():
+    """Readiness: 200 once warmed up, 503 while starting or draining"""
+    return LIFECYCLE.response()
+
+@app.get("/internal/stats")
+async def internal_stats(request: Request):
+    """Runtime counters for sizing the upstream pools and cache, per-endpoint LB state"""
+    return {
+        "tkb_upstreams": request.app.state.tkb.stats(),
+        "tkb_cache": request.app.state.tkb_cache.stats(),
+        "identity_cache": identity_cache_info()._asdict(),
+        "policy": POLICY.stats(),
+        "audit": AUDIT.stats(),
+        "admission": {"rates": RATES.stats(), "tkb": TKB_LIMIT.stats()},
+        "auth": AUTH.stats() if AUTH is not None else None,
+        "tracing": TRACER.stats(),
+        "lifecycle": LIFECYCLE.stats(),
+        "compression": COMPRESSOR.stats(),
+    }
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus scrape endpoint"""
+    return Response(METRICS.render(), media_type=METRICS_CONTENT_TYPE)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -1,6 +1,11 @@
 const express = require('express');
+const compression = require('compression');
 const app = express();
 
+// Nén response (gzip/br theo Accept-Encoding) trước khi qua tunnel WireGuard;
+// demo-app gửi Accept-Encoding và chuyển tiếp nguyên bản nén nếu client cũng nhận được
+app.use(compression({ threshold: 1024 }));
+
 // Thời khóa biểu mẫu
 const schedule = {
   "giangvien": {
@@ -0,0 +1,48 @@
+"""Shared runtime building blocks for the ZTA demo apps.
+
+Both FastAPI apps (``k8s/app`` and ``apps/demo-app-v5``) import from this
+package. The Dockerfiles copy it next to ``main.py``; for local runs put
+``projectfinal/apps`` on ``PYTHONPATH``.
+"""
+
+from zta_common.admission import AdmissionMiddleware, ConcurrencyLimiter, RateLimiter
+from zta_common.audit import AuditLog
+from zta_common.auth import AuthMiddleware, TokenVerifier
+from zta_common.balancer import UpstreamBalancer
+from zta_common.cache import ResponseCache
+from zta_common.compression import CompressionMiddleware, Compressor
+from zta_common.identity import Identity, get_identity, identity_from_scope
+from zta_common.lifecycle import Lifecycle, LifecycleMiddleware
+from zta_common.metrics import MetricsMiddleware, MetricsRegistry
+from zta_common.policy import PolicyEngine, PolicyMiddleware
+from zta_common.probe import CircuitBreaker, HealthProber
+from zta_common.tracing import Tracer, TracingMiddleware
+from zta_common.upstream import PoolConfig, UpstreamPool
+
+__all__ = [
+    "AdmissionMiddleware",
+    "AuditLog",
+    "AuthMiddleware",
+    "CircuitBreaker",
+    "CompressionMiddleware",
+    "Compressor",
+    "ConcurrencyLimiter",
+    "HealthProber",
+    "Identity",
+    "Lifecycle",
+    "LifecycleMiddleware",
+    "MetricsMiddleware",
+    "MetricsRegistry",
+    "PolicyEngine",
+    "PolicyMiddleware",
+    "PoolConfig",
+    "RateLimiter",
+    "ResponseCache",
+    "TokenVerifier",
+    "Tracer",
+    "TracingMiddleware",
+    "UpstreamBalancer",
+    "UpstreamPool",
+    "get_identity",
+    "identity_from_scope",
+]
@@ -0,0 +1,280 @@
+"""Admission control: per-identity rate limits and per-upstream concurrency caps.
+
+When the WireGuard link to AWS degrades, every request to an upstream-backed
+route waits on it, and without a bound they pile up until the pod runs out
+of memory. One noisy user can also take the whole shared path.
+
+- Before a request reaches its handler, ``AdmissionMiddleware`` charges the
+  caller's token bucket; limits are per role (the ``role_permissions`` roles
+  of ``authz.rego``, most generous role wins) and an empty bucket is
+  answered with 429 and ``Retry-After``.
+- Each call that actually goes to an upstream takes a slot from that
+  upstream's ``ConcurrencyLimiter`` (``UpstreamBalancer(limiter=...)``), so
+  responses served from a cache or shared with a single-flight call cost
+  none. When all slots are busy the call waits in a bounded FIFO queue for
+  at most ``queue_timeout``; a full queue or an expired wait raises
+  ``Overloaded``, which handlers answer with ``overloaded_response`` (503
+  and ``Retry-After``).
+
+Both checks are plain dict/deque operations with no ``await`` between the
+read and the update, so under a single event loop they need no locks and
+cost O(1) per admitted request. Public endpoints (probes, ``/metrics``) are
+never limited.
+"""
+
+import asyncio
+import contextlib
+import json
+import math
+import time
+from collections import OrderedDict, deque
+from typing import NamedTuple
+
+from starlette.responses import JSONResponse
+
+from zta_common.env import env_float, env_int
+from zta_common.identity import identity_from_scope
+from zta_common.policy import PolicyEngine
+from zta_common.tracing import child_span
+
+
+class RateLimit(NamedTuple):
+    rate: float  # tokens per second; 0 disables the limit
+    burst: float
+
+
+# Requests/s a human session needs is well under these; they only stop scripts and runaway clients.
+DEFAULT_LIMITS = {
+    "admin": RateLimit(50.0, 100.0),
+    "giangvien": RateLimit(30.0, 60.0),
+    "sinhvien": RateLimit(20.0, 40.0),
+}
+DEFAULT_LIMIT = RateLimit(10.0, 20.0)
+
+
+class Overloaded(Exception):
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+    """Token bucket per identity key, refilled lazily on access; the least recently seen keys are evicted."""
+
+    def __init__(self, limits: dict[str, RateLimit], default: RateLimit = DEFAULT_LIMIT,
+                 max_keys: int = 10000, clock=time.monotonic):
+        self.limits = limits
+        self.default = default
+        self.max_keys = max_keys
+        self._clock = clock
+        # key -> [tokens, last refill]
+        self._buckets: OrderedDict = OrderedDict()
+        self._by_roles: dict[frozenset, RateLimit] = {}
+        self.counters = dict.fromkeys(("admitted", "limited", "evictions"), 0)
+
+    @classmethod
+    def from_env(cls, engine: PolicyEngine, prefix: str = "ADMISSION") -> "RateLimiter":
+        """One limit per policy role from ``<PREFIX>_RATE_<ROLE>`` / ``<PREFIX>_BURST_<ROLE>``;
+        ``<PREFIX>_RATE_DEFAULT`` / ``<PREFIX>_BURST_DEFAULT`` for callers with none of them."""
+
+        def read(suffix: str, fallback: RateLimit) -> RateLimit:
+            rate = env_float(f"{prefix}_RATE_{suffix}", fallback.rate)
+            return RateLimit(rate, env_float(f"{prefix}_BURST_{suffix}", max(fallback.burst, rate)))
+
+        limits = {role: read(role.upper(), DEFAULT_LIMITS.get(role, DEFAULT_LIMIT))
+                  for role in engine.role_permissions}
+        return cls(limits, read("DEFAULT", DEFAULT_LIMIT), max_keys=env_int(f"{prefix}_MAX_IDENTITIES", 10000))
+
+    def limit_for(self, roles: frozenset) -> RateLimit:
+        limit = self._by_roles.get(roles)
+        if limit is None:
+            matching = [self.limits[role] for role in roles if role in self.limits]
+            if not matching:
+                limit = self.default
+            elif any(m.rate <= 0 for m in matching):
+                limit = RateLimit(0.0, 0.0)
+            else:
+                limit = max(matching)
+            self._by_roles[roles] = limit
+        return limit
+
+    def acquire(self, key, roles: frozenset) -> float:
+        """Take one token; returns 0 if admitted, else the seconds until a token is available."""
+        rate, burst = self.limit_for(roles)
+        if rate <= 0:
+            self.counters["admitted"] += 1
+            return 0.0
+        now = self._clock()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [burst, now]
+            if len(self._buckets) > self.max_keys:
+                # An evicted caller comes back with a full bucket, which is what idling would give it anyway.
+                self._buckets.popitem(last=False)
+                self.counters["evictions"] += 1
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        if bucket[0] >= 1.0:
+            bucket[0] -= 1.0
+            self.counters["admitted"] += 1
+            return 0.0
+        self.counters["limited"] += 1
+        return (1.0 - bucket[0]) / rate
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "identities": len(self._buckets),
+            "limits": {role: limit._asdict() for role, limit in sorted(self.limits.items())},
+            "default": self.default._asdict(),
+        }
+
+
+class ConcurrencyLimiter:
+    """At most ``max_concurrency`` requests in flight to one upstream, ``queue_size`` more waiting (FIFO)."""
+
+    def __init__(self, name: str, max_concurrency: int = 64, queue_size: int = 128,
+                 queue_timeout: float = 2.0, retry_after: float = 1.0):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self._waiters: deque[asyncio.Future] = deque()
+        self.counters = dict.fromkeys(("admitted", "queued", "shed_queue_full", "shed_timeout"), 0)
+        self.max_queued = 0
+
+    @classmethod
+    def from_env(cls, name: str, prefix: str) -> "ConcurrencyLimiter":
+        """Read ``<PREFIX>_MAX_CONCURRENCY`` (0 = unlimited), ``<PREFIX>_QUEUE_SIZE``,
+        ``<PREFIX>_QUEUE_TIMEOUT`` and ``<PREFIX>_RETRY_AFTER``."""
+        return cls(
+            name,
+            max_concurrency=env_int(f"{prefix}_MAX_CONCURRENCY", 64),
+            queue_size=env_int(f"{prefix}_QUEUE_SIZE", 128),
+            queue_timeout=env_float(f"{prefix}_QUEUE_TIMEOUT", 2.0),
+            retry_after=env_float(f"{prefix}_RETRY_AFTER", 1.0),
+        )
+
+    async def acquire(self) -> None:
+        """Take a slot, waiting in the queue if needed; raises ``Overloaded`` instead of waiting longer."""
+        if self.max_concurrency <= 0 or (self.in_flight < self.max_concurrency and not self._waiters):
+            self.in_flight += 1
+            self.counters["admitted"] += 1
+            return
+        if len(self._waiters) >= self.queue_size:
+            self.counters["shed_queue_full"] += 1
+            raise Overloaded(f"{self.name}: too many requests waiting", self.retry_after)
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self.counters["queued"] += 1
+        self.max_queued = max(self.max_queued, len(self._waiters))
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as the wait ended; give it back.
+                self.release()
+            else:
+                with contextlib.suppress(ValueError):  # release() may already have skipped past it
+                    self._waiters.remove(waiter)
+            if isinstance(e, TimeoutError):
+                self.counters["shed_timeout"] += 1
+                raise Overloaded(f"{self.name}: no capacity within {self.queue_timeout}s", self.retry_after) from None
+            raise
+        self.counters["admitted"] += 1
+
+    async def admit(self) -> None:
+        """``acquire()`` recorded as an ``admission.acquire`` span under the active request."""
+        queued = child_span("admission.acquire", attributes={"peer.service": self.name})
+        try:
+            await self.acquire()
+        except Overloaded as e:
+            if queued is not None:
+                queued.set_error(str(e))
+                queued.end()
+            raise
+        if queued is not None:
+            queued.end()
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """Hold a slot for the duration of the ``async with`` block."""
+        await self.admit()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def release(self) -> None:
+        # Hand the slot straight to the next waiter so in_flight never dips below the cap while others wait.
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            **self.counters,
+            "in_flight": self.in_flight,
+            "waiting": len(self._waiters),
+            "max_queued": self.max_queued,
+            "max_concurrency": self.max_concurrency,
+            "queue_size": self.queue_size,
+            "queue_timeout": self.queue_timeout,
+        }
+
+
+def _retry_after(seconds: float) -> bytes:
+    return str(max(1, math.ceil(seconds))).encode()
+
+
+class AdmissionMiddleware:
+    """ASGI middleware applying ``RateLimiter``.
+
+    Install it inside ``PolicyMiddleware`` so only authorised requests
+    spend tokens; ``/api/batch`` items pass through it as well.
+    """
+
+    def __init__(self, app, engine: PolicyEngine, rates: RateLimiter):
+        self.app = app
+        self.engine = engine
+        self.rates = rates
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self.engine.is_public(scope["method"], scope["path"]):
+            await self.app(scope, receive, send)
+            return
+        identity = identity_from_scope(scope)
+        key = identity.user or (scope.get("client") or ("-",))[0]
+        wait = self.rates.acquire(key, identity.roles)
+        if wait:
+            await _reject(send, 429, "Rate limit exceeded", wait)
+            return
+        await self.app(scope, receive, send)
+
+
+def overloaded_response(e: Overloaded) -> JSONResponse:
+    """503 for a call shed by a ``ConcurrencyLimiter``, in the same shape as the middleware's rejections."""
+    return JSONResponse({"status": "rejected", "error": str(e)}, status_code=503,
+                        headers={"retry-after": _retry_after(e.retry_after).decode()})
+
+
+async def _reject(send, status: int, error: str, retry_after: float) -> None:
+    body = json.dumps({"status": "rejected", "error": error}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", _retry_after(retry_after)),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
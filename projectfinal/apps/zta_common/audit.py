@@ -0,0 +1,224 @@
+"""Non-blocking, batched audit log of RBAC decisions.
+
+Each decision is appended to a bounded in-memory queue as a tuple; a
+background task turns queued records into JSON lines and writes them in
+batches from a worker thread, so a slow stdout pipe (or promtail falling
+behind) never stalls the event loop. Records follow ``audit_decision`` in
+``policies/opa/authz.rego`` (allowed, user, roles, path, method, timestamp
+in ns) plus the response status, latency and trace id.
+
+When the queue is full the ``policy`` decides what gives:
+
+- ``drop_new``: the incoming record is discarded (default);
+- ``drop_oldest``: the oldest queued record is discarded;
+- ``block``: the request waits up to ``block_timeout`` seconds for space,
+  then the record is discarded.
+
+Every discarded record is counted in ``stats()["dropped"]``.
+"""
+
+import asyncio
+import json
+import logging
+import select
+import sys
+import time
+from collections import deque
+from typing import TextIO
+
+from zta_common.env import env_bool, env_float, env_int, env_str
+from zta_common.tracing import SCOPE_KEY as TRACE_SCOPE_KEY
+
+logger = logging.getLogger("zta.audit")
+
+PIPE_BUF = getattr(select, "PIPE_BUF", 512)
+
+DROP_NEW = "drop_new"
+DROP_OLDEST = "drop_oldest"
+BLOCK = "block"
+POLICIES = (DROP_NEW, DROP_OLDEST, BLOCK)
+
+
+def trace_id_from_scope(scope) -> str | None:
+    """Trace id of the request (``TracingMiddleware`` or the W3C ``traceparent``), else Envoy's ``x-request-id``."""
+    context = scope.get(TRACE_SCOPE_KEY)
+    if context is not None:
+        return context.trace_id
+    request_id = None
+    for name, value in scope["headers"]:
+        if name == b"traceparent":
+            parts = value.split(b"-")
+            if len(parts) >= 4 and len(parts[1]) == 32:
+                return parts[1].decode("latin-1")
+        elif name == b"x-request-id" and request_id is None:
+            request_id = value.decode("latin-1")
+    return request_id
+
+
+class AuditLog:
+    # Set by zta_common.launcher when several workers write to the same stdout.
+    shared_stream = False
+
+    def __init__(self, stream: TextIO | None = None, *, max_queue: int = 10_000, batch_size: int = 256,
+                 flush_interval: float = 1.0, policy: str = DROP_NEW, block_timeout: float = 0.05,
+                 include_public: bool = False):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown audit policy '{policy}', expected one of {POLICIES}")
+        self.stream = stream or sys.stdout
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.include_public = include_public
+        self._queue: deque = deque()
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._stopping = False
+        self.counters = dict.fromkeys(("enqueued", "written", "batches", "blocked", "write_errors"), 0)
+        self.dropped = dict.fromkeys(("queue_full", "evicted_oldest", "block_timeout", "write_error"), 0)
+
+    @classmethod
+    def from_env(cls, prefix: str = "AUDIT") -> "AuditLog":
+        """Read ``<PREFIX>_*`` variables; ``AUDIT_FILE`` is a path, or ``-`` for stdout."""
+        path = env_str(f"{prefix}_FILE", "-")
+        stream = sys.stdout if path == "-" else open(path, "a", encoding="utf-8")  # noqa: SIM115
+        return cls(
+            stream,
+            max_queue=env_int(f"{prefix}_QUEUE_SIZE", 10_000),
+            batch_size=env_int(f"{prefix}_BATCH_SIZE", 256),
+            flush_interval=env_float(f"{prefix}_FLUSH_INTERVAL", 1.0),
+            policy=env_str(f"{prefix}_POLICY", DROP_NEW),
+            block_timeout=env_float(f"{prefix}_BLOCK_TIMEOUT", 0.05),
+            include_public=env_bool(f"{prefix}_PUBLIC", False),
+        )
+
+    # -- producer side --------------------------------------------------------
+    async def submit(self, allowed: bool, user: str | None, roles: frozenset, path: str, method: str,
+                     status: int, latency: float, trace_id: str | None) -> bool:
+        """Queue one decision; only the ``block`` policy can suspend the caller."""
+        if len(self._queue) >= self.max_queue:
+            room = await self._wait_for_room() if self.policy == BLOCK else self._make_room()
+            if not room:
+                return False
+        self._queue.append((time.time_ns(), allowed, user, roles, path, method, status, latency, trace_id))
+        self.counters["enqueued"] += 1
+        if len(self._queue) >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    def _make_room(self) -> bool:
+        if self.policy == DROP_OLDEST:
+            self._queue.popleft()
+            self.dropped["evicted_oldest"] += 1
+            return True
+        self.dropped["queue_full"] += 1
+        return False
+
+    async def _wait_for_room(self) -> bool:
+        self.counters["blocked"] += 1
+        self._wakeup.set()
+        deadline = asyncio.get_running_loop().time() + self.block_timeout
+        while len(self._queue) >= self.max_queue:
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                self.dropped["block_timeout"] += 1
+                return False
+            self._space.clear()
+            try:
+                await asyncio.wait_for(self._space.wait(), remaining)
+            except TimeoutError:
+                pass
+        return True
+
+    # -- consumer side --------------------------------------------------------
+    def start(self) -> None:
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run(), name="audit-flush")
+
+    async def stop(self, timeout: float = 5.0) -> None:
+        """Flush what is queued (up to ``timeout`` seconds) and stop the writer."""
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        try:
+            await asyncio.wait_for(self._task, timeout)
+        except TimeoutError:
+            logger.warning("audit flush did not finish in %.1fs; %d records lost", timeout, len(self._queue))
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            if not self._queue and not self._stopping:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+                except TimeoutError:
+                    pass
+            self._wakeup.clear()
+            while self._queue:
+                await self._flush_batch()
+            if self._stopping:
+                return
+
+    async def _flush_batch(self) -> None:
+        n = min(self.batch_size, len(self._queue))
+        batch = [self._queue.popleft() for _ in range(n)]
+        self._space.set()
+        data = "".join(map(_format, batch))
+        try:
+            await asyncio.to_thread(self._write, data)
+        except Exception as e:  # noqa: BLE001 - the audit log must never take the app down
+            self.counters["write_errors"] += 1
+            self.dropped["write_error"] += n
+            logger.warning("audit write failed, %d records dropped: %s", n, e)
+        else:
+            self.counters["written"] += n
+            self.counters["batches"] += 1
+
+    def _write(self, data: str) -> None:
+        # With shared_stream, writes of at most PIPE_BUF bytes ending on a line
+        # boundary are atomic on a pipe, so lines of several workers never
+        # interleave. Records keep non-ASCII names as UTF-8, so the cuts are
+        # made on the encoded bytes; a newline byte is always a character boundary.
+        if self.shared_stream and len(data) * 4 > PIPE_BUF:  # at most 4 UTF-8 bytes per character
+            encoded = data.encode()
+            while len(encoded) > PIPE_BUF:
+                # A single record longer than PIPE_BUF goes out on its own.
+                cut = encoded.rfind(b"\n", 0, PIPE_BUF) + 1 or encoded.find(b"\n", PIPE_BUF) + 1 or len(encoded)
+                self.stream.write(encoded[:cut].decode())
+                self.stream.flush()
+                encoded = encoded[cut:]
+            data = encoded.decode()
+        self.stream.write(data)
+        self.stream.flush()
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "dropped": dict(self.dropped),
+            "dropped_total": sum(self.dropped.values()),
+            "queue_depth": len(self._queue),
+            "max_queue": self.max_queue,
+            "batch_size": self.batch_size,
+            "policy": self.policy,
+            "running": self._task is not None,
+        }
+
+
+def _format(record: tuple) -> str:
+    timestamp, allowed, user, roles, path, method, status, latency, trace_id = record
+    return json.dumps({
+        "event": "audit_decision",
+        "allowed": allowed,
+        "user": user,
+        "roles": sorted(roles),
+        "path": path,
+        "method": method,
+        "timestamp": timestamp,
+        "status": status,
+        "latency_ms": round(latency * 1000, 3),
+        "trace_id": trace_id,
+    }, ensure_ascii=False) + "\n"
@@ -0,0 +1,330 @@
+"""Local verification of Keycloak tokens against the realm JWKS.
+
+The ``x-forwarded-*`` / ``x-auth-request-*`` headers are only as good as the
+network path that set them; anything that reaches the pod without going
+through oauth2-proxy can claim any group. With ``AUTH_MODE=jwt`` the apps
+take the identity from the bearer token instead (oauth2-proxy sends it with
+``--set-authorization-header`` / ``--pass-access-token``) and check its
+signature, issuer and expiry in-process, without a call to Keycloak per
+request:
+
+- the realm JWKS is fetched once and reused for ``ttl``; after that the
+  known keys keep being served while one background refresh runs;
+- a token signed with an unknown ``kid`` (key rotation) triggers a refresh
+  that concurrent requests share, at most once per ``min_refresh_interval``
+  so forged ``kid`` values cannot hammer Keycloak;
+- verified tokens are kept in an LRU keyed on a hash of the token until
+  their ``exp``, so repeat requests skip the RSA check.
+
+Requires PyJWT with the ``crypto`` extra; header mode works without it.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+
+import httpx
+
+from zta_common.env import env_float, env_int, env_list, env_str
+from zta_common.identity import SCOPE_KEY, Identity, parse_roles
+from zta_common.upstream import PoolConfig, UpstreamPool
+
+try:
+    import jwt
+except ImportError:  # pragma: no cover - only AUTH_MODE=jwt needs it
+    jwt = None
+
+logger = logging.getLogger("zta.auth")
+
+DEFAULT_ISSUER = "http://keycloak.172.10.0.190.nip.io:31691/realms/zta"
+JWKS_PATH = "/protocol/openid-connect/certs"
+# Token sources, in order: the ID token oauth2-proxy puts in Authorization, then its access token header.
+TOKEN_HEADERS = (b"authorization", b"x-forwarded-access-token")
+
+
+class AuthError(Exception):
+    """Token rejected; the message is safe to return to the caller."""
+
+
+class JWKSCache:
+    """Signing keys of one realm by ``kid``, fetched through an ``UpstreamPool``."""
+
+    def __init__(self, pool: UpstreamPool, path: str = "/", *, algorithms=("RS256",), ttl: float = 300.0,
+                 min_refresh_interval: float = 10.0, clock=time.monotonic):
+        self.pool = pool
+        self.path = path
+        self.algorithms = frozenset(algorithms)
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self._clock = clock
+        self._keys: dict = {}
+        self._fetched_at: float | None = None
+        self._attempted_at: float | None = None
+        self._refresh: asyncio.Task | None = None
+        self.counters = dict.fromkeys(
+            ("fetches", "fetch_errors", "coalesced", "unknown_kid", "refresh_throttled"), 0)
+
+    def _may_refresh(self, now: float) -> bool:
+        return self._refresh is None and (
+            self._attempted_at is None or now - self._attempted_at >= self.min_refresh_interval)
+
+    def _start_refresh(self) -> asyncio.Task:
+        self._attempted_at = self._clock()
+        task = asyncio.create_task(self._fetch())
+        self._refresh = task
+        task.add_done_callback(self._refresh_done)
+        return task
+
+    def _refresh_done(self, task: asyncio.Task) -> None:
+        self._refresh = None
+        if not task.cancelled() and task.exception() is not None:
+            self.counters["fetch_errors"] += 1
+            logger.warning("JWKS refresh from %s%s failed: %s", self.pool.base_url, self.path, task.exception())
+
+    async def _fetch(self) -> None:
+        response = await self.pool.client.get(self.path)
+        response.raise_for_status()
+        keys = {}
+        for jwk in response.json().get("keys", ()):
+            # Keycloak publishes its encryption key (use=enc, RSA-OAEP) in the same set.
+            if jwk.get("use", "sig") != "sig" or jwk.get("alg", "RS256") not in self.algorithms:
+                continue
+            try:
+                keys[jwk.get("kid")] = jwt.PyJWK(jwk).key
+            except jwt.PyJWKError as e:
+                logger.warning("skipping JWKS key %s: %s", jwk.get("kid"), e)
+        self._keys = keys
+        self._fetched_at = self._clock()
+        self.counters["fetches"] += 1
+
+    async def refresh(self) -> None:
+        """Fetch the key set now, or join the fetch already running."""
+        task = self._refresh
+        if task is None:
+            task = self._start_refresh()
+        else:
+            self.counters["coalesced"] += 1
+        # Shielded so a disconnecting caller does not cancel the fetch for everyone else.
+        await asyncio.shield(task)
+
+    async def get_key(self, kid: str | None):
+        now = self._clock()
+        key = self._keys.get(kid)
+        if key is not None:
+            if now - self._fetched_at >= self.ttl and self._may_refresh(now):
+                self._start_refresh()
+            return key
+        if self._fetched_at is not None:
+            self.counters["unknown_kid"] += 1
+        if self._refresh is None and not self._may_refresh(now):
+            self.counters["refresh_throttled"] += 1
+            raise AuthError("Unknown token signing key")
+        try:
+            await self.refresh()
+        except (httpx.HTTPError, ValueError) as e:
+            raise AuthError("Token signing keys unavailable") from e
+        key = self._keys.get(kid)
+        if key is None:
+            raise AuthError("Unknown token signing key")
+        return key
+
+    def stats(self) -> dict:
+        now = self._clock()
+        return {
+            **self.counters,
+            "url": self.pool.base_url + self.path,
+            "kids": sorted(str(kid) for kid in self._keys),
+            "age_s": round(now - self._fetched_at, 1) if self._fetched_at is not None else None,
+            "ttl": self.ttl,
+            "refreshing": self._refresh is not None,
+        }
+
+
+def _claim(claims: dict, path: str):
+    value = claims
+    for part in path.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def identity_from_claims(claims: dict, roles_claims=("realm_access.roles", "groups")) -> Identity:
+    """Identity with the same fields the header path produces; roles come from ``roles_claims``."""
+    names = []
+    for path in roles_claims:
+        value = _claim(claims, path)
+        if isinstance(value, list):
+            names.extend(str(item) for item in value)
+    groups = ",".join(names) or None
+    return Identity(
+        user=claims.get("preferred_username") or claims.get("sub"),
+        email=claims.get("email"),
+        groups=groups,
+        roles=parse_roles(groups),
+    )
+
+
+class TokenVerifier:
+    def __init__(self, jwks: JWKSCache, issuer: str, *, audience: str | None = None,
+                 algorithms=("RS256",), leeway: float = 30.0, cache_size: int = 10000,
+                 roles_claims=("realm_access.roles", "groups"), clock=time.time):
+        if jwt is None:
+            raise RuntimeError("token verification needs PyJWT: pip install 'pyjwt[crypto]'")
+        self.jwks = jwks
+        self.issuer = issuer
+        self.audience = audience
+        self.algorithms = list(algorithms)
+        self.leeway = leeway
+        self.cache_size = cache_size
+        self.roles_claims = tuple(roles_claims)
+        self._clock = clock
+        # token digest -> (exp, identity)
+        self._verified: OrderedDict = OrderedDict()
+        self.counters = dict.fromkeys(("hits", "misses", "expired", "evictions", "rejected"), 0)
+
+    @classmethod
+    def from_env(cls, prefix: str) -> "TokenVerifier":
+        """Read ``<PREFIX>_ISSUER``, ``<PREFIX>_JWKS_URL``, ``<PREFIX>_AUDIENCE``, ``<PREFIX>_JWKS_*``,
+        ``<PREFIX>_CACHE_SIZE``, ``<PREFIX>_LEEWAY`` and ``<PREFIX>_ROLES_CLAIMS``."""
+        issuer = env_str(f"{prefix}_ISSUER", DEFAULT_ISSUER).rstrip("/")
+        algorithms = env_list(f"{prefix}_ALGORITHMS", ["RS256"])
+        jwks_url = httpx.URL(env_str(f"{prefix}_JWKS_URL", issuer + JWKS_PATH))
+        pool = UpstreamPool("keycloak-jwks", str(jwks_url.copy_with(path="/", query=None)),
+                            PoolConfig.from_env(prefix))
+        jwks = JWKSCache(
+            pool, jwks_url.raw_path.decode("ascii"),
+            algorithms=algorithms,
+            ttl=env_float(f"{prefix}_JWKS_TTL", 300.0),
+            min_refresh_interval=env_float(f"{prefix}_JWKS_MIN_REFRESH", 10.0),
+        )
+        return cls(
+            jwks, issuer,
+            audience=env_str(f"{prefix}_AUDIENCE", "") or None,
+            algorithms=algorithms,
+            leeway=env_float(f"{prefix}_LEEWAY", 30.0),
+            cache_size=env_int(f"{prefix}_CACHE_SIZE", 10000),
+            roles_claims=env_list(f"{prefix}_ROLES_CLAIMS", ["realm_access.roles", "groups"]),
+        )
+
+    async def start(self) -> None:
+        """Open the JWKS pool and prime the key set; Keycloak being down is not fatal here."""
+        await self.jwks.pool.start()
+        try:
+            await self.jwks.refresh()
+        except (httpx.HTTPError, ValueError):
+            pass
+
+    async def aclose(self) -> None:
+        await self.jwks.pool.aclose()
+
+    async def verify(self, token: str) -> Identity:
+        """Identity for a valid token; raises ``AuthError`` otherwise."""
+        digest = hashlib.blake2b(token.encode(), digest_size=16).digest()
+        entry = self._verified.get(digest)
+        if entry is not None:
+            if self._clock() < entry[0]:
+                self._verified.move_to_end(digest)
+                self.counters["hits"] += 1
+                return entry[1]
+            del self._verified[digest]
+            self.counters["expired"] += 1
+        self.counters["misses"] += 1
+        try:
+            identity, exp = await self._verify(token)
+        except AuthError:
+            self.counters["rejected"] += 1
+            raise
+        self._verified[digest] = (exp, identity)
+        if len(self._verified) > self.cache_size:
+            self._verified.popitem(last=False)
+            self.counters["evictions"] += 1
+        return identity
+
+    async def _verify(self, token: str) -> tuple[float, Identity]:
+        try:
+            header = jwt.get_unverified_header(token)
+        except jwt.InvalidTokenError:
+            raise AuthError("Malformed token") from None
+        if header.get("alg") not in self.algorithms:
+            raise AuthError("Token algorithm not allowed")
+        key = await self.jwks.get_key(header.get("kid"))
+        try:
+            claims = jwt.decode(
+                token, key, algorithms=self.algorithms, issuer=self.issuer, audience=self.audience,
+                leeway=self.leeway,
+                options={"require": ["exp", "iss"], "verify_aud": self.audience is not None},
+            )
+        except jwt.ExpiredSignatureError:
+            raise AuthError("Token expired") from None
+        except jwt.InvalidTokenError as e:
+            raise AuthError(f"Invalid token: {e}") from None
+        return identity_from_claims(claims, self.roles_claims), float(claims["exp"])
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "cached": len(self._verified),
+            "cache_size": self.cache_size,
+            "issuer": self.issuer,
+            "jwks": self.jwks.stats(),
+        }
+
+
+def token_from_scope(scope) -> str | None:
+    values = dict.fromkeys(TOKEN_HEADERS)
+    for name, value in scope["headers"]:
+        if name in values and values[name] is None:
+            values[name] = value
+    authorization = values[b"authorization"]
+    if authorization is not None:
+        scheme, _, credentials = authorization.decode("latin-1").partition(" ")
+        if scheme.lower() == "bearer" and credentials.strip():
+            return credentials.strip()
+    access_token = values[b"x-forwarded-access-token"]
+    return access_token.decode("latin-1") if access_token else None
+
+
+_ANONYMOUS = Identity(None, None, None, frozenset())
+
+
+class AuthMiddleware:
+    """ASGI middleware resolving the identity from a verified token (outside ``PolicyMiddleware``).
+
+    Requests without a token are anonymous - the identity headers are never
+    consulted - so ``PolicyMiddleware`` answers 401 for protected paths as
+    before. A token that fails verification is rejected here with 401.
+    """
+
+    def __init__(self, app, verifier: TokenVerifier):
+        self.app = app
+        self.verifier = verifier
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        token = token_from_scope(scope)
+        if token is None:
+            scope[SCOPE_KEY] = _ANONYMOUS
+            await self.app(scope, receive, send)
+            return
+        try:
+            scope[SCOPE_KEY] = await self.verifier.verify(token)
+        except AuthError as e:
+            body = json.dumps({"status": "denied", "error": str(e), "path": scope["path"]}).encode()
+            await send({
+                "type": "http.response.start",
+                "status": 401,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                    (b"www-authenticate", b'Bearer error="invalid_token"'),
+                ],
+            })
+            await send({"type": "http.response.body", "body": body})
+            return
+        await self.app(scope, receive, send)
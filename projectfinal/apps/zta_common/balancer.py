@@ -0,0 +1,322 @@
+"""Latency-aware load balancing with hedged GETs across several upstream endpoints.
+
+One slow or dead node behind the WireGuard tunnel should not set the tail
+latency of the whole feature. Each endpoint gets its own ``UpstreamPool``
+and ``HealthProber`` (active health), and every proxied call feeds back
+into the same circuit breaker (passive health) and into an EWMA of its
+latency.
+
+- Requests go to the healthy endpoint with the lowest ``ewma * (in_flight + 1)``
+  ("peak EWMA"), so a node that is fast but already busy is not piled on.
+  Endpoints with an open breaker are only used when nothing else is left.
+- A transport error fails over to the next endpoint; for non-idempotent
+  methods only when the request never left (``ConnectError``).
+- With a ``limiter``, each call holds one of its slots (a streamed call
+  until its body is relayed); hedges and failovers share the caller's slot.
+- GETs are hedged: if the first attempt has not answered after the chosen
+  endpoint's ``hedge_percentile`` latency, the same request goes to the
+  next-best endpoint, the first response wins and the other is cancelled.
+  Hedges are capped at ``hedge_budget`` of all requests.
+"""
+
+import asyncio
+import contextlib
+import logging
+import time
+from collections import deque
+
+import httpx
+from starlette.requests import Request
+from starlette.responses import StreamingResponse
+
+from zta_common.admission import ConcurrencyLimiter
+from zta_common.env import env_bool, env_float, env_str
+from zta_common.metrics import UpstreamMetrics
+from zta_common.probe import CLOSED, CircuitBreaker, HealthProber, percentile
+from zta_common.proxy import stream_upstream
+from zta_common.upstream import PoolConfig, UpstreamPool
+
+logger = logging.getLogger("zta.balancer")
+
+# Latency samples kept per endpoint for the hedge delay; re-sorted every RECOMPUTE_EVERY observations.
+LATENCY_WINDOW = 256
+RECOMPUTE_EVERY = 32
+# Cold-start: hedge only once an endpoint has this many samples.
+MIN_SAMPLES = 20
+
+
+class Endpoint:
+    def __init__(self, url: str, pool: UpstreamPool, prober: HealthProber, *, decay: float = 0.3,
+                 failure_penalty: float = 1.0):
+        self.url = url
+        self.pool = pool
+        self.prober = prober
+        self.decay = decay
+        self.failure_penalty = failure_penalty
+        self.ewma: float | None = None
+        self.in_flight = 0
+        self.latencies: deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self._ordered: list[float] = []
+        self._since_sort = 0
+        self.counters = dict.fromkeys(("requests", "failures", "cancelled", "hedges_sent", "hedges_won"), 0)
+
+    @property
+    def breaker(self) -> CircuitBreaker:
+        return self.prober.breaker
+
+    @property
+    def healthy(self) -> bool:
+        # Half-open trials belong to the active prober; requests only use closed breakers.
+        return self.breaker.state == CLOSED
+
+    def score(self) -> float:
+        return (self.ewma or 0.0) * (self.in_flight + 1)
+
+    def _update_ewma(self, sample: float) -> None:
+        self.ewma = sample if self.ewma is None else self.decay * sample + (1 - self.decay) * self.ewma
+
+    def observe(self, seconds: float, ok: bool) -> None:
+        self._update_ewma(seconds if ok else max(seconds, self.failure_penalty))
+        if ok:
+            self.breaker.record_success()
+            self.latencies.append(seconds)
+            self._since_sort += 1
+        else:
+            self.counters["failures"] += 1
+            self.breaker.record_failure()
+
+    def observe_cancelled(self, seconds: float) -> None:
+        # A hedge loser took at least this long; without it a slow node would keep its low EWMA.
+        self.counters["cancelled"] += 1
+        self._update_ewma(seconds)
+
+    def latency_percentile(self, q: float) -> float | None:
+        if len(self.latencies) < MIN_SAMPLES:
+            return None
+        if self._since_sort >= RECOMPUTE_EVERY or not self._ordered:
+            self._ordered = sorted(self.latencies)
+            self._since_sort = 0
+        return percentile(self._ordered, q)
+
+    def snapshot(self) -> dict:
+        p50 = self.latency_percentile(0.50)
+        p95 = self.latency_percentile(0.95)
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "ewma_ms": round(self.ewma * 1000, 2) if self.ewma is not None else None,
+            "in_flight": self.in_flight,
+            "p50_ms": round(p50 * 1000, 2) if p50 is not None else None,
+            "p95_ms": round(p95 * 1000, 2) if p95 is not None else None,
+            **self.counters,
+            "probe": self.prober.snapshot(),
+            "pool": self.pool.stats(),
+        }
+
+
+class UpstreamBalancer:
+    def __init__(self, name: str, endpoints: list[Endpoint], *, hedge: bool = True,
+                 hedge_percentile: float = 0.95, hedge_min_delay: float = 0.01,
+                 hedge_max_delay: float = 1.0, hedge_budget: float = 0.1,
+                 limiter: ConcurrencyLimiter | None = None):
+        if not endpoints:
+            raise ValueError(f"{name}: no upstream endpoints configured")
+        self.name = name
+        self.endpoints = endpoints
+        self.hedge = hedge and len(endpoints) > 1
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_max_delay = hedge_max_delay
+        self.hedge_budget = hedge_budget
+        self.limiter = limiter
+        self.counters = dict.fromkeys(("requests", "failovers", "hedges", "hedges_won", "hedges_over_budget"), 0)
+
+    @classmethod
+    def from_env(cls, name: str, urls: list[str], prefix: str,
+                 metrics: UpstreamMetrics | None = None,
+                 limiter: ConcurrencyLimiter | None = None) -> "UpstreamBalancer":
+        """One pool + prober per URL, configured from ``<PREFIX>_POOL_*``, ``<PREFIX>_PROBE_*``,
+        ``<PREFIX>_BREAKER_*``, ``<PREFIX>_LB_*`` and ``<PREFIX>_HEDGE_*`` variables."""
+        config = PoolConfig.from_env(prefix)
+        health_path = env_str(f"{prefix}_HEALTH_PATH", "/health")
+        endpoints = []
+        for url in urls:
+            pool = UpstreamPool(name, url, config, metrics=metrics)
+            prober = HealthProber.from_env(f"{name}@{url}", health_path, pool, prefix)
+            endpoints.append(Endpoint(
+                pool.base_url, pool, prober,
+                decay=env_float(f"{prefix}_LB_EWMA_DECAY", 0.3),
+                failure_penalty=env_float(f"{prefix}_LB_FAILURE_PENALTY", config.read_timeout / 10),
+            ))
+        return cls(
+            name, endpoints,
+            hedge=env_bool(f"{prefix}_HEDGE", True),
+            hedge_percentile=env_float(f"{prefix}_HEDGE_PERCENTILE", 0.95),
+            hedge_min_delay=env_float(f"{prefix}_HEDGE_MIN_DELAY", 0.01),
+            hedge_max_delay=env_float(f"{prefix}_HEDGE_MAX_DELAY", 1.0),
+            hedge_budget=env_float(f"{prefix}_HEDGE_BUDGET", 0.1),
+            limiter=limiter,
+        )
+
+    async def start(self) -> None:
+        for endpoint in self.endpoints:
+            await endpoint.pool.start()
+            endpoint.prober.start()
+
+    async def aclose(self) -> None:
+        for endpoint in self.endpoints:
+            await endpoint.prober.stop()
+            await endpoint.pool.aclose()
+
+    async def warm(self, connections: int) -> dict[str, int]:
+        """Pre-open ``connections`` keep-alive connections per endpoint via its health path."""
+        warmed = await asyncio.gather(*(e.pool.warm(connections, e.prober.url) for e in self.endpoints))
+        return {e.url: n for e, n in zip(self.endpoints, warmed)}
+
+    def ranked(self) -> list[Endpoint]:
+        """Healthy endpoints by score, then the unhealthy ones as a last resort."""
+        return sorted(self.endpoints, key=lambda e: (not e.healthy, e.score()))
+
+    def hedge_delay(self, endpoint: Endpoint) -> float | None:
+        delay = endpoint.latency_percentile(self.hedge_percentile)
+        if delay is None:
+            return None
+        return min(max(delay, self.hedge_min_delay), self.hedge_max_delay)
+
+    async def _attempt(self, endpoint: Endpoint, method: str, path: str, **kwargs) -> httpx.Response:
+        endpoint.in_flight += 1
+        endpoint.counters["requests"] += 1
+        started = time.perf_counter()
+        try:
+            response = await endpoint.pool.client.request(method, path, **kwargs)
+        except asyncio.CancelledError:
+            endpoint.observe_cancelled(time.perf_counter() - started)
+            raise
+        except httpx.TransportError:
+            endpoint.observe(time.perf_counter() - started, ok=False)
+            raise
+        finally:
+            endpoint.in_flight -= 1
+        endpoint.observe(time.perf_counter() - started, ok=response.status_code < 500)
+        return response
+
+    async def request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        """Send one buffered request, failing over on transport errors (hedged for GET).
+
+        Raises ``Overloaded`` when the limiter sheds it.
+        """
+        async with self.limiter.slot() if self.limiter is not None else contextlib.nullcontext():
+            self.counters["requests"] += 1
+            candidates = self.ranked()
+            if method == "GET" and self.hedge:
+                return await self._hedged(candidates, method, path, **kwargs)
+            return await self._failover(candidates, method, path, **kwargs)
+
+    async def get(self, path: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", path, **kwargs)
+
+    async def _failover(self, candidates: list[Endpoint], method: str, path: str, **kwargs) -> httpx.Response:
+        retry_on = httpx.TransportError if method in ("GET", "HEAD", "OPTIONS") else httpx.ConnectError
+        error = None
+        for i, endpoint in enumerate(candidates):
+            if i:
+                self.counters["failovers"] += 1
+            try:
+                return await self._attempt(endpoint, method, path, **kwargs)
+            except retry_on as e:
+                error = e
+                logger.info("%s: %s failed (%s), trying next endpoint", self.name, endpoint.url, e)
+        raise error
+
+    async def _hedged(self, candidates: list[Endpoint], method: str, path: str, **kwargs) -> httpx.Response:
+        primary = candidates[0]
+        delay = self.hedge_delay(primary)
+        if delay is None or len(candidates) < 2:
+            return await self._failover(candidates, method, path, **kwargs)
+        tasks = {asyncio.ensure_future(self._attempt(primary, method, path, **kwargs)): primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                if self.counters["hedges"] >= self.hedge_budget * self.counters["requests"]:
+                    self.counters["hedges_over_budget"] += 1
+                else:
+                    backup = candidates[1]
+                    self.counters["hedges"] += 1
+                    backup.counters["hedges_sent"] += 1
+                    tasks[asyncio.ensure_future(self._attempt(backup, method, path, **kwargs))] = backup
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = tasks[task]
+                        if winner is not primary:
+                            self.counters["hedges_won"] += 1
+                            winner.counters["hedges_won"] += 1
+                        return task.result()
+                    error = task.exception()
+            # Every attempt failed: keep going down the list like an unhedged request.
+            rest = [e for e in candidates if e not in tasks.values()]
+            if rest and isinstance(error, httpx.TransportError):
+                self.counters["failovers"] += 1
+                return await self._failover(rest, method, path, **kwargs)
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def stream(self, request: Request, path: str, **kwargs) -> StreamingResponse:
+        """``stream_upstream`` against the best endpoint, failing over only before anything was sent.
+
+        Raises ``Overloaded`` when the limiter sheds it; otherwise the slot is
+        held until the upstream response is closed.
+        """
+        if self.limiter is None:
+            return await self._stream(request, path, **kwargs)
+        await self.limiter.admit()
+        try:
+            return await self._stream(request, path, on_close=self.limiter.release, **kwargs)
+        except BaseException:
+            self.limiter.release()
+            raise
+
+    async def _stream(self, request: Request, path: str, **kwargs) -> StreamingResponse:
+        self.counters["requests"] += 1
+        error = None
+        for i, endpoint in enumerate(self.ranked()):
+            if i:
+                self.counters["failovers"] += 1
+            endpoint.in_flight += 1
+            endpoint.counters["requests"] += 1
+            started = time.perf_counter()
+            try:
+                response = await stream_upstream(request, endpoint.pool.client, path, **kwargs)
+            except httpx.ConnectError as e:
+                endpoint.observe(time.perf_counter() - started, ok=False)
+                error = e
+                continue
+            except httpx.TransportError:
+                endpoint.observe(time.perf_counter() - started, ok=False)
+                raise
+            finally:
+                endpoint.in_flight -= 1
+            # Time to response headers; the body is relayed afterwards.
+            endpoint.observe(time.perf_counter() - started, ok=response.status_code < 500)
+            return response
+        raise error
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            **self.counters,
+            "hedging": {
+                "enabled": self.hedge,
+                "percentile": self.hedge_percentile,
+                "min_delay_s": self.hedge_min_delay,
+                "max_delay_s": self.hedge_max_delay,
+                "budget": self.hedge_budget,
+            },
+            "endpoints": [endpoint.snapshot() for endpoint in self.endpoints],
+        }
@@ -0,0 +1,200 @@
+"""``/api/batch``: several GET sub-resources in one round-trip.
+
+Every browser fetch crosses the Istio gateway and oauth2-proxy again, so a
+dashboard with three widgets paid for authentication three times. A batch
+request is authenticated and its identity resolved once; each item is then
+checked against the in-process ``PolicyEngine`` with those roles and
+dispatched straight into the app below ``PolicyMiddleware`` (no new HTTP
+request, no second policy pass). Items run concurrently, each under its own
+timeout, and report their own status code; an item that fails or outgrows
+``MAX_ITEM_BYTES`` fails alone, and any upstream body it was streaming is
+closed.
+
+By default the response is one JSON document with every item. With
+``?stream=1`` (or ``Accept: application/x-ndjson``) each item is written as
+an NDJSON line as soon as it finishes, so one slow upstream does not hold
+back the rest.
+"""
+
+import asyncio
+import json
+import logging
+import math
+import time
+
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+
+from zta_common.audit import AuditLog, trace_id_from_scope
+from zta_common.env import env_float, env_int
+from zta_common.identity import identity_from_scope
+from zta_common.policy import PolicyEngine, PolicyMiddleware
+from zta_common.proxy import CLOSE_SCOPE_KEY
+from zta_common.tracing import span
+
+logger = logging.getLogger("zta.batch")
+
+BATCH_PATH = "/api/batch"
+MAX_ITEMS = env_int("BATCH_MAX_ITEMS", 16)
+ITEM_TIMEOUT = env_float("BATCH_ITEM_TIMEOUT", 5.0)
+MAX_ITEM_BYTES = env_int("BATCH_MAX_ITEM_BYTES", 1024 * 1024)
+NDJSON = "application/x-ndjson"
+
+# Scope keys a sub-request inherits; routing state of the batch request itself is not copied.
+_INHERITED = ("asgi", "http_version", "scheme", "server", "client", "root_path", "headers", "app", "state",
+              "zta.identity")
+
+
+class _ItemTooLarge(Exception):
+    pass
+
+
+def inner_app(app):
+    """The ASGI app ``PolicyMiddleware`` wraps (exception handling + router)."""
+    layer = app.middleware_stack
+    while layer is not None and not isinstance(layer, PolicyMiddleware):
+        layer = getattr(layer, "app", None)
+    if layer is None:
+        raise RuntimeError("in-process dispatch requires PolicyMiddleware to be installed")
+    return layer.app
+
+
+def parse_items(request: Request) -> list[str]:
+    """``?items=/api/a,/api/b`` and/or repeated ``?items=`` values, in order."""
+    items = []
+    for value in request.query_params.getlist("items"):
+        items.extend(item.strip() for item in value.split(",") if item.strip())
+    return items
+
+
+def _item_error(index: int, path: str, status: int, error: str, started: float) -> dict:
+    return {"index": index, "path": path, "status": status, "body": {"error": error},
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 2)}
+
+
+async def dispatch(inner, scope: dict, path: str) -> tuple[int, str, bytes]:
+    """GET ``path`` on ``inner`` in-process, as the identity in ``scope``; returns (status, content type, body)."""
+    route_path, _, query = path.partition("?")
+    sub_scope = {key: scope[key] for key in _INHERITED if key in scope}
+    # Items are parsed here, not by the browser: ask for identity bodies (a proxied
+    # upstream body is then decoded) and let CompressionMiddleware encode the batch.
+    headers = [(name, value) for name, value in sub_scope.get("headers", ()) if name != b"accept-encoding"]
+    headers.append((b"accept-encoding", b"identity"))
+    sub_scope.update(type="http", method="GET", path=route_path, raw_path=route_path.encode(),
+                     query_string=query.encode(), headers=headers)
+    status = 500
+    content_type = ""
+    chunks: list[bytes] = []
+    size = 0
+    request_sent = False
+    finished = asyncio.Event()
+
+    async def receive():
+        # An empty body once; after that only a disconnect once the response is complete,
+        # which is what StreamingResponse's disconnect listener waits for.
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await finished.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status, content_type, size
+        if message["type"] == "http.response.start":
+            status = message["status"]
+            for name, value in message.get("headers", ()):
+                if name == b"content-type":
+                    content_type = value.decode("latin-1")
+        elif message["type"] == "http.response.body":
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > MAX_ITEM_BYTES:
+                raise _ItemTooLarge(f"Response larger than {MAX_ITEM_BYTES} bytes")
+            chunks.append(chunk)
+            if not message.get("more_body", False):
+                finished.set()
+
+    try:
+        await inner(sub_scope, receive, send)
+    finally:
+        # A streamed body abandoned half-way (too large, timed out) still holds its upstream connection.
+        for close in sub_scope.get(CLOSE_SCOPE_KEY, ()):
+            await close()
+    return status, content_type, b"".join(chunks)
+
+
+async def run_item(request: Request, engine: PolicyEngine, audit: AuditLog | None, index: int, path: str,
+                   timeout: float) -> dict:
+    started = time.perf_counter()
+    route_path = path.partition("?")[0]
+    if not route_path.startswith("/api/") or route_path.rstrip("/") == BATCH_PATH:
+        return _item_error(index, path, 400, "Batch items must be /api/ paths other than /api/batch", started)
+    identity = identity_from_scope(request.scope)
+    allowed = engine.allow(identity.roles, "GET", route_path)
+    if not allowed:
+        status = 403 if identity.authenticated else 401
+        result = _item_error(index, path, status, engine.reason(identity.authenticated), started)
+    else:
+        with span("batch.item", attributes={"url.path": route_path}) as item_span:
+            try:
+                status, content_type, body = await asyncio.wait_for(
+                    dispatch(inner_app(request.app), request.scope, path), timeout)
+                if content_type.startswith("application/json"):
+                    payload = json.loads(body) if body else None
+                else:
+                    payload = body.decode("utf-8", "replace")
+            except TimeoutError:
+                result = _item_error(index, path, 504, f"Timed out after {timeout}s", started)
+            except _ItemTooLarge as e:
+                result = _item_error(index, path, 502, str(e), started)
+            except Exception:  # noqa: BLE001 - one broken item must not fail the whole batch
+                logger.exception("batch item %s failed", path)
+                result = _item_error(index, path, 500, "Internal Server Error", started)
+            else:
+                result = {"index": index, "path": path, "status": status, "body": payload,
+                          "elapsed_ms": round((time.perf_counter() - started) * 1000, 2)}
+            if item_span is not None:
+                item_span.attributes["http.response.status_code"] = result["status"]
+    if audit is not None:
+        await audit.submit(allowed and result["status"] not in (401, 403), identity.user, identity.roles,
+                           route_path, "GET", result["status"], time.perf_counter() - started,
+                           trace_id_from_scope(request.scope))
+    return result
+
+
+async def handle_batch(request: Request, engine: PolicyEngine, audit: AuditLog | None = None):
+    """Endpoint body for ``GET /api/batch?items=...``; see the module docstring."""
+    started = time.perf_counter()
+    items = parse_items(request)
+    if not items:
+        return JSONResponse({"error": "No items; use ?items=/api/a,/api/b"}, status_code=400)
+    if len(items) > MAX_ITEMS:
+        return JSONResponse({"error": f"At most {MAX_ITEMS} items per batch"}, status_code=400)
+    try:
+        timeout = float(request.query_params.get("timeout", ITEM_TIMEOUT))
+    except ValueError:
+        timeout = math.nan
+    if not (math.isfinite(timeout) and timeout > 0):
+        return JSONResponse({"error": "timeout must be a positive number of seconds"}, status_code=400)
+    timeout = min(timeout, ITEM_TIMEOUT)
+
+    stream = request.query_params.get("stream") in ("1", "true") or NDJSON in request.headers.get("accept", "")
+    if not stream:
+        results = await asyncio.gather(*(run_item(request, engine, audit, i, path, timeout)
+                                         for i, path in enumerate(items)))
+        return JSONResponse({"items": results, "elapsed_ms": round((time.perf_counter() - started) * 1000, 2)})
+
+    async def lines():
+        tasks = [asyncio.ensure_future(run_item(request, engine, audit, i, path, timeout))
+                 for i, path in enumerate(items)]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield json.dumps(await task, ensure_ascii=False).encode() + b"\n"
+            yield json.dumps({"done": True, "items": len(items),
+                              "elapsed_ms": round((time.perf_counter() - started) * 1000, 2)}).encode() + b"\n"
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(lines(), media_type=NDJSON)
@@ -0,0 +1,199 @@
+"""Bounded TTL response cache with stale-while-revalidate and single-flight.
+
+Used in front of cross-cloud upstreams whose data changes rarely (the TKB
+schedule). Callers choose the key; for anything identity-dependent the key
+must include the caller's role set so different roles never share entries.
+
+- fresh entries are served directly (``hit``);
+- entries past ``ttl`` but within ``stale_ttl`` are served immediately while
+  one background refresh runs (``stale``);
+- otherwise exactly one upstream fetch runs per key and concurrent callers
+  wait for it (``miss`` for the leader, ``coalesced`` for the rest);
+- refreshes send the stored ETag so the upstream can answer 304;
+- ``max_bytes`` counts each body, its parsed JSON (kept on the entry for
+  ``json()``) and a fixed per-entry overhead.
+"""
+
+import asyncio
+import json
+import logging
+import sys
+import time
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+
+from zta_common.env import env_float, env_int
+
+logger = logging.getLogger("zta.cache")
+
+# Rough per-entry bookkeeping cost, added to the body size for the byte budget.
+ENTRY_OVERHEAD = 512
+
+
+def _deep_size(obj) -> int:
+    """Approximate bytes held by a parsed JSON value (containers plus their contents)."""
+    size, stack = 0, [obj]
+    while stack:
+        item = stack.pop()
+        size += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, list):
+            stack.extend(item)
+    return size
+
+
+@dataclass
+class CachedResponse:
+    status: int
+    body: bytes
+    content_type: str | None = None
+    etag: str | None = None
+    cache_control: str = ""
+    _json: object = field(default=None, repr=False)
+    _json_size: int | None = field(default=None, repr=False)
+
+    @property
+    def cacheable(self) -> bool:
+        return self.status == 200 and "no-store" not in self.cache_control.lower()
+
+    def json(self):
+        """Parsed body, decoded once per entry. Treat the result as read-only."""
+        if self._json is None:
+            self._json = json.loads(self.body)
+        return self._json
+
+    def parsed_size(self) -> int:
+        """Memory the parsed body holds, counted against the cache's byte budget.
+
+        A JSON body is parsed here, when the entry is stored, so the estimate is
+        known before ``json()`` keeps the result alive for the entry's lifetime."""
+        if self._json_size is None:
+            self._json_size = 0
+            if "json" in (self.content_type or "").lower():
+                try:
+                    self._json_size = _deep_size(self.json())
+                except ValueError:
+                    pass
+        return self._json_size
+
+
+class _Entry:
+    __slots__ = ("response", "fresh_until", "stale_until", "size")
+
+    def __init__(self, response: CachedResponse, fresh_until: float, stale_until: float):
+        self.response = response
+        self.fresh_until = fresh_until
+        self.stale_until = stale_until
+        self.size = len(response.body) + response.parsed_size() + ENTRY_OVERHEAD
+
+
+# fetch(etag) -> response; a 304 response means "the entry for this etag is still valid".
+Fetcher = Callable[[str | None], Awaitable[CachedResponse]]
+
+
+class ResponseCache:
+    def __init__(self, ttl: float = 30.0, stale_ttl: float = 300.0, max_entries: int = 1024,
+                 max_bytes: int = 8 * 1024 * 1024, clock=time.monotonic):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._clock = clock
+        self._entries: OrderedDict = OrderedDict()
+        self._inflight: dict = {}
+        self._bytes = 0
+        self.counters = dict.fromkeys(
+            ("hits", "stale_hits", "misses", "coalesced", "revalidated", "evictions", "refresh_errors"), 0)
+
+    @classmethod
+    def from_env(cls, prefix: str) -> "ResponseCache":
+        """Read ``<PREFIX>_CACHE_*`` variables, e.g. ``TKB_CACHE_TTL``; a TTL of 0 disables caching."""
+        return cls(
+            ttl=env_float(f"{prefix}_CACHE_TTL", 30.0),
+            stale_ttl=env_float(f"{prefix}_CACHE_STALE", 300.0),
+            max_entries=env_int(f"{prefix}_CACHE_MAX_ENTRIES", 1024),
+            max_bytes=env_int(f"{prefix}_CACHE_MAX_BYTES", 8 * 1024 * 1024),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_entries > 0
+
+    async def get(self, key, fetch: Fetcher) -> tuple[CachedResponse, str]:
+        """Return ``(response, outcome)``; outcome is hit, stale, miss, coalesced or bypass."""
+        if not self.enabled:
+            return await fetch(None), "bypass"
+        now = self._clock()
+        entry = self._entries.get(key)
+        if entry is not None:
+            if now < entry.fresh_until:
+                self._entries.move_to_end(key)
+                self.counters["hits"] += 1
+                return entry.response, "hit"
+            if now < entry.stale_until:
+                self._entries.move_to_end(key)
+                self.counters["stale_hits"] += 1
+                if key not in self._inflight:
+                    self._start_fetch(key, fetch, entry).add_done_callback(self._log_refresh_error)
+                return entry.response, "stale"
+        task = self._inflight.get(key)
+        if task is not None:
+            self.counters["coalesced"] += 1
+            return await asyncio.shield(task), "coalesced"
+        self.counters["misses"] += 1
+        # The fetch runs as its own task so a disconnecting leader can't cancel it for the waiters.
+        return await asyncio.shield(self._start_fetch(key, fetch, entry)), "miss"
+
+    def _start_fetch(self, key, fetch: Fetcher, previous: _Entry | None) -> asyncio.Task:
+        task = asyncio.create_task(self._fetch(key, fetch, previous))
+        self._inflight[key] = task
+        task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return task
+
+    async def _fetch(self, key, fetch: Fetcher, previous: _Entry | None) -> CachedResponse:
+        response = await fetch(previous.response.etag if previous is not None else None)
+        if response.status == 304 and previous is not None:
+            self.counters["revalidated"] += 1
+            response = previous.response
+        if response.cacheable:
+            self._store(key, response)
+        return response
+
+    def _store(self, key, response: CachedResponse) -> None:
+        now = self._clock()
+        entry = _Entry(response, now + self.ttl, now + self.ttl + self.stale_ttl)
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= old.size
+        if entry.size > self.max_bytes:
+            return
+        self._entries[key] = entry
+        self._bytes += entry.size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.size
+            self.counters["evictions"] += 1
+
+    def _log_refresh_error(self, task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            self.counters["refresh_errors"] += 1
+            logger.warning("background refresh failed: %s", task.exception())
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "inflight": len(self._inflight),
+            "ttl": self.ttl,
+            "stale_ttl": self.stale_ttl,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+        }
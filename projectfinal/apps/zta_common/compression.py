@@ -0,0 +1,353 @@
+"""Response compression with content negotiation, and the upstream half of it.
+
+Pages and JSON left the apps uncompressed, and proxied ``/api/tkb`` bodies
+crossed the WireGuard tunnel uncompressed. This module covers both legs:
+
+- ``CompressionMiddleware`` compresses complete responses of a compressible
+  type once they reach ``min_size`` bytes, with the best coding the client
+  accepts (``Accept-Encoding`` q-values, ties broken by server preference:
+  zstd, br, gzip). Brotli and zstd are used when the ``brotli`` /
+  ``zstandard`` packages are installed (``httpx[brotli,zstd]``), gzip always.
+  Responses that already carry ``Content-Encoding`` (a proxied upstream
+  body) and streamed responses (NDJSON batches, stream-mode proxying) are
+  passed through untouched.
+- compressed variants are cached by body digest, so a body sent again byte
+  for byte is compressed once. The key is the whole body, so every distinct
+  body is its own entry. Responses marked ``Cache-Control: private`` (the
+  per-user home pages) are never cached: there would be one entry per user,
+  and repeat views are answered 304 from their ETag anyway. The other
+  per-user bodies, such as a JSON schedule carrying the caller's name, still
+  take an entry each; the LRU is bounded by ``cache_entries`` and
+  ``cache_bytes``, so they only push out colder entries. Bodies over
+  ``cache_max_body`` and ``no-store`` responses are not cached either.
+  Hashing a body costs a small fraction of compressing it.
+- a templated page (``templates.render_html``) arrives with its pieces. For
+  gzip and zstd the static fragments are compressed once per encoding and
+  cached like any variant, and the page is spliced per request: zstd frames
+  concatenate, and gzip is one member whose deflate stream is the cached
+  fragments (each ended by a sync flush) with the fields between them as
+  stored blocks. Brotli streams cannot be spliced, so a br page is
+  compressed whole and not cached.
+- ``upstream_accept_encoding`` asks an upstream for every coding httpx can
+  decode, preferring the ones the client accepts, so a proxied body can be
+  relayed still compressed; ``accepts`` tells the proxy when it has to
+  decode instead.
+"""
+
+import asyncio
+import gzip
+import hashlib
+import struct
+import time
+import zlib
+from collections import OrderedDict
+
+from starlette.datastructures import Headers, MutableHeaders
+
+from zta_common.env import env_int, env_list
+from zta_common.templates import FRAGMENTS_KEY
+
+# Server preference when the client accepts several codings equally.
+PREFERENCE = ("zstd", "br", "gzip")
+
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript", "application/xml",
+                      "image/svg+xml", "application/problem+json")
+
+
+def _available(encoding: str) -> bool:
+    try:
+        if encoding == "br":
+            import brotli  # noqa: F401
+        elif encoding == "zstd":
+            import zstandard  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+AVAILABLE = tuple(encoding for encoding in PREFERENCE if _available(encoding))
+# What httpx can decode for the proxy; deflate is decodable but never preferred.
+DECODABLE = AVAILABLE + ("deflate",)
+# Default for upstream clients: any compressed body is decoded by httpx.
+UPSTREAM_ACCEPT_ENCODING = ", ".join(DECODABLE)
+# Codings whose output can be assembled from separately compressed pieces.
+SPLICEABLE = ("gzip", "zstd")
+# gzip member header: deflate, no flags, mtime 0, no extra flags, unknown OS.
+_GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+# Empty final deflate block (fixed Huffman, end-of-block only).
+_DEFLATE_END = b"\x03\x00"
+
+
+def parse_accept_encoding(header: str | None) -> dict[str, float]:
+    """``"gzip;q=0.8, br"`` -> ``{"gzip": 0.8, "br": 1.0}``; malformed q-values count as 0."""
+    accepted = {}
+    for item in (header or "").split(","):
+        coding, _, params = item.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+def _q(accepted: dict[str, float], coding: str) -> float:
+    return accepted.get(coding, accepted.get("*", 0.0))
+
+
+def negotiate(header: str | None, offered: tuple[str, ...] = AVAILABLE) -> str | None:
+    """The coding in ``offered`` with the highest q in ``header``; None means identity."""
+    accepted = parse_accept_encoding(header)
+    best, best_q = None, 0.0
+    for coding in offered:
+        q = _q(accepted, coding)
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def accepts(header: str | None, content_encoding: str) -> bool:
+    """Whether a client sending ``header`` can take a body with ``content_encoding`` (possibly stacked)."""
+    accepted = parse_accept_encoding(header)
+    return all(_q(accepted, coding.strip().lower()) > 0
+               for coding in content_encoding.split(",") if coding.strip().lower() != "identity")
+
+
+def upstream_accept_encoding(client_header: str | None) -> str:
+    """``Accept-Encoding`` for an upstream: codings the client takes at q=1, the rest still decodable at 0.5."""
+    accepted = parse_accept_encoding(client_header)
+    return ", ".join(coding if _q(accepted, coding) > 0 else f"{coding};q=0.5" for coding in DECODABLE)
+
+
+class Compressor:
+    """Negotiation, the codecs and a bounded LRU cache of compressed variants keyed by body digest."""
+
+    def __init__(self, *, min_size: int = 1024, encodings: tuple[str, ...] = AVAILABLE, gzip_level: int = 6,
+                 brotli_quality: int = 4, zstd_level: int = 3, cache_bytes: int = 8 * 1024 * 1024,
+                 cache_entries: int = 1024, cache_max_body: int = 256 * 1024, thread_min_size: int = 64 * 1024):
+        self.min_size = min_size
+        self.encodings = tuple(e for e in encodings if e in AVAILABLE)
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.zstd_level = zstd_level
+        self.cache_bytes = cache_bytes
+        self.cache_entries = cache_entries
+        self.cache_max_body = cache_max_body
+        self.thread_min_size = thread_min_size
+        self._variants: OrderedDict[tuple[bytes, str], bytes] = OrderedDict()
+        self._cached_bytes = 0
+        self._field_zstd = None
+        self.counters = dict.fromkeys((
+            "responses", "compressed", "spliced", "cache_hits", "cache_evictions", "identity", "too_small",
+            "not_compressible", "streamed", "already_encoded", "bytes_in", "bytes_out",
+        ), 0)
+        self.by_encoding = dict.fromkeys(self.encodings, 0)
+        self.compress_seconds = 0.0
+
+    @classmethod
+    def from_env(cls, prefix: str = "COMPRESS") -> "Compressor":
+        """Read ``<PREFIX>_MIN_SIZE``, ``<PREFIX>_ENCODINGS`` (preference order), ``<PREFIX>_GZIP_LEVEL``,
+        ``<PREFIX>_BROTLI_QUALITY``, ``<PREFIX>_ZSTD_LEVEL``, ``<PREFIX>_CACHE_BYTES`` and
+        ``<PREFIX>_CACHE_ENTRIES`` (0 disables the variant cache), ``<PREFIX>_CACHE_MAX_BODY`` and
+        ``<PREFIX>_THREAD_MIN_SIZE``."""
+        d = cls()
+        return cls(
+            min_size=env_int(f"{prefix}_MIN_SIZE", d.min_size),
+            encodings=tuple(env_list(f"{prefix}_ENCODINGS", list(PREFERENCE))),
+            gzip_level=env_int(f"{prefix}_GZIP_LEVEL", d.gzip_level),
+            brotli_quality=env_int(f"{prefix}_BROTLI_QUALITY", d.brotli_quality),
+            zstd_level=env_int(f"{prefix}_ZSTD_LEVEL", d.zstd_level),
+            cache_bytes=env_int(f"{prefix}_CACHE_BYTES", d.cache_bytes),
+            cache_entries=env_int(f"{prefix}_CACHE_ENTRIES", d.cache_entries),
+            cache_max_body=env_int(f"{prefix}_CACHE_MAX_BODY", d.cache_max_body),
+            thread_min_size=env_int(f"{prefix}_THREAD_MIN_SIZE", d.thread_min_size),
+        )
+
+    def choose(self, accept_encoding: str | None) -> str | None:
+        return negotiate(accept_encoding, self.encodings) if self.encodings else None
+
+    @staticmethod
+    def compressible(content_type: str | None) -> bool:
+        return bool(content_type) and content_type.lower().startswith(COMPRESSIBLE_TYPES)
+
+    def _encode(self, body: bytes, encoding: str) -> bytes:
+        if encoding == "gzip":
+            return gzip.compress(body, self.gzip_level, mtime=0)
+        if encoding == "br":
+            import brotli
+            return brotli.compress(body, quality=self.brotli_quality)
+        import zstandard
+        return zstandard.ZstdCompressor(level=self.zstd_level).compress(body)
+
+    def _encode_fragment(self, fragment: bytes, encoding: str) -> bytes:
+        """A static fragment as a splice piece: raw deflate ending on a byte boundary, or a zstd frame."""
+        if encoding == "gzip":
+            deflate = zlib.compressobj(self.gzip_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+            return deflate.compress(fragment) + deflate.flush(zlib.Z_SYNC_FLUSH)
+        return self._encode(fragment, encoding)
+
+    def _cache_key(self, body: bytes, encoding: str) -> tuple[bytes, str] | None:
+        if self.cache_bytes and self.cache_entries and len(body) <= self.cache_max_body:
+            return hashlib.blake2b(body, digest_size=16).digest(), encoding
+        return None
+
+    def _cache_get(self, key: tuple[bytes, str] | None) -> bytes | None:
+        cached = self._variants.get(key) if key is not None else None
+        if cached is not None:
+            self._variants.move_to_end(key)
+            self.counters["cache_hits"] += 1
+        return cached
+
+    def _cache_put(self, key: tuple[bytes, str] | None, compressed: bytes) -> None:
+        if key is None:
+            return
+        self._variants[key] = compressed
+        self._cached_bytes += len(compressed)
+        while self._cached_bytes > self.cache_bytes or len(self._variants) > self.cache_entries:
+            _, evicted = self._variants.popitem(last=False)
+            self._cached_bytes -= len(evicted)
+            self.counters["cache_evictions"] += 1
+
+    async def compress(self, body: bytes, encoding: str, cacheable: bool = True) -> bytes:
+        """``body`` in ``encoding``, from the variant cache when an identical body was compressed before."""
+        key = self._cache_key(body, encoding) if cacheable else None
+        cached = self._cache_get(key)
+        if cached is not None:
+            return cached
+        started = time.perf_counter()
+        if len(body) >= self.thread_min_size:
+            # zlib, brotli and zstd release the GIL; big bodies should not stall the loop.
+            compressed = await asyncio.to_thread(self._encode, body, encoding)
+        else:
+            compressed = self._encode(body, encoding)
+        self.compress_seconds += time.perf_counter() - started
+        self._cache_put(key, compressed)
+        return compressed
+
+    def compress_fragments(self, parts: list[bytes], encoding: str) -> bytes:
+        """``b"".join(parts)`` in a ``SPLICEABLE`` encoding, from cached forms of the static (even) parts."""
+        started = time.perf_counter()
+        if encoding == "gzip":
+            out, crc, size = [_GZIP_HEADER], 0, 0
+        else:
+            out = []
+        for index, part in enumerate(parts):
+            if not part:
+                continue
+            if index % 2 == 0:
+                key = self._cache_key(part, encoding + ";fragment")
+                piece = self._cache_get(key)
+                if piece is None:
+                    piece = self._encode_fragment(part, encoding)
+                    self._cache_put(key, piece)
+            elif encoding == "gzip" and len(part) < 128:
+                # A short field goes in as a non-final stored block; no compressor needed.
+                piece = b"\x00" + struct.pack("<HH", len(part), len(part) ^ 0xFFFF) + part
+            elif encoding == "gzip":
+                piece = self._encode_fragment(part, encoding)
+            else:
+                if self._field_zstd is None:
+                    import zstandard
+                    self._field_zstd = zstandard.ZstdCompressor(level=self.zstd_level)
+                piece = self._field_zstd.compress(part)
+            out.append(piece)
+            if encoding == "gzip":
+                crc = zlib.crc32(part, crc)
+                size += len(part)
+        if encoding == "gzip":
+            out.append(_DEFLATE_END + struct.pack("<II", crc, size & 0xFFFFFFFF))
+        self.counters["spliced"] += 1
+        self.compress_seconds += time.perf_counter() - started
+        return b"".join(out)
+
+    def stats(self) -> dict:
+        c = self.counters
+        return {
+            **c,
+            "ratio": round(c["bytes_out"] / c["bytes_in"], 3) if c["bytes_in"] else None,
+            "by_encoding": self.by_encoding,
+            "compress_ms": round(self.compress_seconds * 1000, 2),
+            "cache": {"entries": len(self._variants), "max_entries": self.cache_entries,
+                      "bytes": self._cached_bytes, "max_bytes": self.cache_bytes},
+            "config": {"min_size": self.min_size, "encodings": list(self.encodings), "gzip_level": self.gzip_level,
+                       "brotli_quality": self.brotli_quality, "zstd_level": self.zstd_level},
+        }
+
+
+class CompressionMiddleware:
+    """Compresses complete responses per ``Accept-Encoding``; streamed and pre-encoded bodies pass through."""
+
+    def __init__(self, app, compressor: Compressor):
+        self.app = app
+        self.compressor = compressor
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        compressor = self.compressor
+        counters = compressor.counters
+        encoding = compressor.choose(Headers(scope=scope).get("accept-encoding"))
+        head_request = scope["method"] == "HEAD"
+        start = None
+        decided = False
+
+        async def send_compressed(message):
+            nonlocal start, decided
+            if decided:
+                await send(message)
+                return
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            decided = True
+            counters["responses"] += 1
+            headers = MutableHeaders(raw=list(start.get("headers", ())))
+            start["headers"] = headers.raw
+            if "content-encoding" in headers:
+                counters["already_encoded"] += 1
+            elif (head_request or start["status"] < 200 or start["status"] in (204, 304)
+                  or not compressor.compressible(headers.get("content-type"))
+                  or "no-transform" in headers.get("cache-control", "")):
+                counters["not_compressible"] += 1
+            else:
+                headers.add_vary_header("Accept-Encoding")
+                body = message.get("body", b"")
+                if message.get("more_body", False):
+                    counters["streamed"] += 1
+                elif encoding is None:
+                    counters["identity"] += 1
+                elif len(body) < compressor.min_size:
+                    counters["too_small"] += 1
+                else:
+                    cache_control = headers.get("cache-control", "")
+                    parts = message.get(FRAGMENTS_KEY)
+                    if (parts is not None and encoding in SPLICEABLE
+                            and sum(len(part) for part in parts) == len(body)):
+                        compressed = compressor.compress_fragments(parts, encoding)
+                    else:
+                        compressed = await compressor.compress(
+                            body, encoding,
+                            cacheable="no-store" not in cache_control and "private" not in cache_control)
+                    counters["compressed"] += 1
+                    counters["bytes_in"] += len(body)
+                    counters["bytes_out"] += len(compressed)
+                    compressor.by_encoding[encoding] += 1
+                    headers["content-encoding"] = encoding
+                    headers["content-length"] = str(len(compressed))
+                    etag = headers.get("etag")
+                    if etag and not etag.startswith("W/"):
+                        # The bytes differ from the identity representation.
+                        headers["etag"] = "W/" + etag
+                    message = {**message, "body": compressed}
+            await send(start)
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
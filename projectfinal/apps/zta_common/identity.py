@@ -0,0 +1,108 @@
+"""Caller identity parsed from the headers oauth2-proxy injects.
+
+oauth2-proxy forwards the user either as ``x-forwarded-*`` (``--pass-user-headers``)
+or ``x-auth-request-*`` (``--set-xauthrequest``). The fallback chains and
+the groups split are done once per distinct header combination: results are
+memoized in a bounded LRU keyed on the raw header values, so the hot path is
+a single pass over the ASGI header list and a cache hit.
+"""
+
+from functools import lru_cache
+
+from starlette.requests import Request
+
+from zta_common.env import env_int
+
+# Earlier names win.
+USER_HEADERS = (
+    b"x-forwarded-preferred-username",
+    b"x-auth-request-preferred-username",
+    b"x-forwarded-user",
+    b"x-auth-request-user",
+)
+EMAIL_HEADERS = (b"x-forwarded-email", b"x-auth-request-email")
+GROUPS_HEADERS = (b"x-forwarded-groups", b"x-auth-request-groups")
+
+_ORDER = USER_HEADERS + EMAIL_HEADERS + GROUPS_HEADERS
+_INDEX = {name: i for i, name in enumerate(_ORDER)}
+_N_USER = len(USER_HEADERS)
+_N_EMAIL = len(EMAIL_HEADERS)
+
+SCOPE_KEY = "zta.identity"
+
+
+class Identity:
+    """Immutable caller identity. ``roles`` holds exact, normalised role names."""
+
+    __slots__ = ("user", "email", "groups", "roles")
+
+    def __init__(self, user: str | None, email: str | None, groups: str | None, roles: frozenset):
+        object.__setattr__(self, "user", user)
+        object.__setattr__(self, "email", email)
+        object.__setattr__(self, "groups", groups)
+        object.__setattr__(self, "roles", roles)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Identity is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("Identity is immutable")
+
+    def __repr__(self) -> str:
+        return f"Identity(user={self.user!r}, email={self.email!r}, roles={sorted(self.roles)!r})"
+
+    @property
+    def authenticated(self) -> bool:
+        return self.user is not None
+
+    def has_role(self, role: str) -> bool:
+        return role in self.roles
+
+
+def parse_roles(groups: str | None) -> frozenset:
+    """``"giangvien, /Sinhvien"`` -> ``{"giangvien", "sinhvien"}`` (Keycloak group paths lose the slash)."""
+    if not groups:
+        return frozenset()
+    roles = (item.strip().lstrip("/").lower() for item in groups.split(","))
+    return frozenset(role for role in roles if role)
+
+
+def _first(values: tuple) -> str | None:
+    for value in values:
+        if value:
+            return value.decode("latin-1")
+    return None
+
+
+@lru_cache(maxsize=env_int("IDENTITY_CACHE_SIZE", 4096))
+def _build(raw: tuple) -> Identity:
+    groups = _first(raw[_N_USER + _N_EMAIL:])
+    return Identity(
+        user=_first(raw[:_N_USER]),
+        email=_first(raw[_N_USER:_N_USER + _N_EMAIL]),
+        groups=groups,
+        roles=parse_roles(groups),
+    )
+
+
+def identity_from_scope(scope) -> Identity:
+    """Resolve (and stash on the scope) the identity for an ASGI request."""
+    identity = scope.get(SCOPE_KEY)
+    if identity is None:
+        raw = [None] * len(_ORDER)
+        for name, value in scope["headers"]:
+            i = _INDEX.get(name)
+            if i is not None and raw[i] is None:
+                raw[i] = value
+        identity = _build(tuple(raw))
+        scope[SCOPE_KEY] = identity
+    return identity
+
+
+async def get_identity(request: Request) -> Identity:
+    """FastAPI dependency: ``identity: Identity = Depends(get_identity)``."""
+    return identity_from_scope(request.scope)
+
+
+def cache_info():
+    return _build.cache_info()
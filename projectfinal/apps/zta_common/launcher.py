@@ -0,0 +1,390 @@
+"""Container entrypoint: pre-forking uvicorn workers sized from the cgroup limits.
+
+    python -m zta_common.launcher main:app --host 0.0.0.0 --port 8000
+
+A bare ``uvicorn main:app`` runs one process whatever CPU the pod gets, so
+HTML rendering, JSON encoding and compression all share one core and the
+default thread pools. The launcher:
+
+- reads the cgroup CPU quota (v2 ``cpu.max``, v1 ``cpu.cfs_quota_us``) and
+  memory limit, bounded by the CPU affinity mask, and picks the worker count
+  (one per CPU, as many as ``LAUNCHER_WORKER_MEMORY_MB`` fits in the memory
+  limit) and each worker's thread pool size; ``WEB_CONCURRENCY`` and
+  ``LAUNCHER_THREADS`` override them;
+- imports the app (and ``LAUNCHER_PRELOAD``, modules the app only imports
+  on first use) once in the parent, binds the socket there, then forks the
+  workers, which share the imported modules copy-on-write and only run the
+  lifespan startup instead of re-importing FastAPI;
+- runs each worker on uvloop with the httptools parser when they are
+  installed (``uvicorn`` ``loop``/``http`` "auto");
+- recycles a worker after ``LAUNCHER_MAX_REQUESTS`` requests (plus up to
+  ``LAUNCHER_MAX_REQUESTS_JITTER`` so they do not all restart together) by
+  forking a fresh one from the preloaded parent. The worker first answers
+  with ``Connection: close`` until its clients have gone (at most
+  ``LAUNCHER_RECYCLE_GRACE`` seconds), so no request is sent on a
+  keep-alive connection that is being shut;
+- forwards SIGTERM/SIGINT to the workers, which drain as usual
+  (``Lifecycle``), and exits once they are gone.
+
+Workers warm up (``Lifecycle``) before they accept connections, so a
+recycled worker never takes cold traffic or turns the pod's ``/ready`` red.
+``/metrics`` is summed over all workers (``MetricsRegistry.shared_dir``).
+Everything else is per worker: ``/internal/stats``, the response caches and
+the per-user rate limits (``ADMISSION_RATE_<ROLE>`` is per worker, so the
+pod allows up to workers x the rate).
+"""
+
+import argparse
+import asyncio
+import importlib
+import logging
+import math
+import os
+import random
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+from zta_common.env import env_bool, env_float, env_int, env_list, env_str
+
+logger = logging.getLogger("zta.launcher")
+
+CGROUP_ROOT = Path("/sys/fs/cgroup")
+# uvicorn's exit code when the app fails to start; the launcher stops instead of respawning.
+STARTUP_FAILURE = 3
+# Imported on first use (httpx transports, anyio streams), i.e. in the lifespan of every
+# worker otherwise; httpcore alone pulls in trio.
+PRELOAD = ("httpcore", "anyio._core._sockets", "anyio._core._streams")
+
+
+def _read(path: Path) -> str | None:
+    try:
+        return path.read_text().strip()
+    except OSError:
+        return None
+
+
+def cgroup_cpu_limit(root: Path = CGROUP_ROOT) -> float | None:
+    """CPUs the cgroup quota allows (e.g. 1.5), or None when unlimited."""
+    v2 = _read(root / "cpu.max")
+    if v2 is not None:
+        quota, _, period = v2.partition(" ")
+        if quota != "max":
+            return int(quota) / int(period or 100000)
+        return None
+    quota, period = _read(root / "cpu" / "cpu.cfs_quota_us"), _read(root / "cpu" / "cpu.cfs_period_us")
+    if quota and period and int(quota) > 0:
+        return int(quota) / int(period)
+    return None
+
+
+def cgroup_memory_limit(root: Path = CGROUP_ROOT) -> int | None:
+    """Memory limit in bytes, or None when unlimited."""
+    value = _read(root / "memory.max") or _read(root / "memory" / "memory.limit_in_bytes")
+    if value is None or value == "max":
+        return None
+    limit = int(value)
+    # cgroup v1 reports "unlimited" as a page-aligned huge number.
+    return None if limit >= 1 << 60 else limit
+
+
+@dataclass(frozen=True)
+class Plan:
+    cpus: float
+    memory_limit_mb: int | None
+    workers: int
+    threads: int
+    max_requests: int
+    max_requests_jitter: int
+    recycle_grace: float
+    loop: str
+    http: str
+
+    @classmethod
+    def from_env(cls, prefix: str = "LAUNCHER", root: Path = CGROUP_ROOT) -> "Plan":
+        """Size from the cgroup; ``WEB_CONCURRENCY``, ``<PREFIX>_THREADS``, ``<PREFIX>_WORKER_MEMORY_MB``,
+        ``<PREFIX>_MAX_WORKERS``, ``<PREFIX>_THREADS_PER_CPU``, ``<PREFIX>_MAX_REQUESTS`` (0 = never recycle),
+        ``<PREFIX>_MAX_REQUESTS_JITTER`` and ``<PREFIX>_RECYCLE_GRACE`` adjust it."""
+        affinity = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+        quota = cgroup_cpu_limit(root)
+        cpus = min(affinity, quota) if quota else affinity
+        memory = cgroup_memory_limit(root)
+        workers = max(1, math.ceil(cpus))
+        if memory is not None:
+            workers = min(workers, max(1, memory // (env_int(f"{prefix}_WORKER_MEMORY_MB", 128) << 20)))
+        workers = env_int("WEB_CONCURRENCY", min(workers, env_int(f"{prefix}_MAX_WORKERS", 8)))
+        # Threads only run blocking calls (file writes, sync handlers, big compressions): a few per CPU.
+        per_worker = max(cpus / workers, 1.0)
+        threads = env_int(f"{prefix}_THREADS", max(4, min(40, math.ceil(per_worker * env_int(
+            f"{prefix}_THREADS_PER_CPU", 8)))))
+        return cls(
+            cpus=round(cpus, 2),
+            memory_limit_mb=memory >> 20 if memory is not None else None,
+            workers=workers,
+            threads=threads,
+            max_requests=env_int(f"{prefix}_MAX_REQUESTS", 50_000),
+            max_requests_jitter=env_int(f"{prefix}_MAX_REQUESTS_JITTER", 5_000),
+            recycle_grace=env_float(f"{prefix}_RECYCLE_GRACE", 2.0),
+            loop="uvloop" if _importable("uvloop") else "asyncio",
+            http="httptools" if _importable("httptools") else "h11",
+        )
+
+
+def bind_socket(host: str, port: int) -> socket.socket:
+    """Listening socket for the workers to share, made like asyncio's own (``create_server(host, port)``).
+
+    ``uvicorn.Config.bind_socket`` and ``socket.create_server`` leave ``proto``
+    at 0. Accepted sockets inherit it, and asyncio only sets TCP_NODELAY on
+    ``IPPROTO_TCP`` sockets, so every response would wait on Nagle's algorithm.
+    """
+    family, kind, proto, _, address = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM,
+                                                         flags=socket.AI_PASSIVE)[0]
+    sock = socket.socket(family, kind, proto)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if family == socket.AF_INET6:
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+    sock.bind(address)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _importable(name: str) -> bool:
+    try:
+        __import__(name)
+    except ImportError:
+        return False
+    return True
+
+
+class _Recycling:
+    """Passes requests through; once ``closing``, responses also close their connection."""
+
+    def __init__(self, app):
+        self.app = app
+        self.closing = False
+
+    async def __call__(self, scope, receive, send):
+        if not self.closing or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_closing(message):
+            if message["type"] == "http.response.start":
+                message = {**message, "headers": [*message.get("headers", ()), (b"connection", b"close")]}
+            await send(message)
+
+        await self.app(scope, receive, send_closing)
+
+
+class Launcher:
+    def __init__(self, app: str, plan: Plan, *, host: str = "0.0.0.0", port: int = 8000,
+                 graceful_timeout: float | None = 30.0, log_level: str = "info", access_log: bool = False,
+                 preload: tuple[str, ...] = PRELOAD):
+        self.app = app
+        self.preload = preload
+        self.plan = plan
+        self.host = host
+        self.port = port
+        self.graceful_timeout = graceful_timeout
+        self.log_level = log_level
+        self.access_log = access_log
+        self.workers: dict[int, float] = {}  # pid -> fork time
+        self.stopping = False
+        self.respawns = 0
+        self.shared_dir: str | None = None
+
+    def _config(self, app):
+        import uvicorn
+
+        # Per-worker jitter: recycled workers do not all leave at the same moment.
+        return uvicorn.Config(
+            app, host=self.host, port=self.port, loop=self.plan.loop, http=self.plan.http,
+            lifespan="on", log_level=self.log_level, access_log=self.access_log,
+            limit_max_requests=self.plan.max_requests or None,
+            limit_max_requests_jitter=self.plan.max_requests_jitter if self.plan.max_requests else 0,
+            timeout_graceful_shutdown=self.graceful_timeout,
+        )
+
+    def run(self) -> int:
+        from uvicorn.importer import import_from_string
+
+        from zta_common.audit import AuditLog
+        from zta_common.lifecycle import Lifecycle
+        from zta_common.metrics import MetricsRegistry
+
+        started = time.perf_counter()
+        app = import_from_string(self.app)  # preload: workers inherit the imported app
+        for module in self.preload:
+            try:
+                importlib.import_module(module)
+            except ImportError as e:
+                logger.warning("cannot preload %s: %s", module, e)
+        config = self._config(_Recycling(app))
+        config.load()  # protocol and lifespan classes, imported once here instead of in every worker
+        sock = bind_socket(self.host, self.port)
+        logger.info("preloaded %s in %.2fs; %s", self.app, time.perf_counter() - started, asdict(self.plan))
+        self.shared_dir = tempfile.mkdtemp(prefix="zta-metrics-", dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+        # Workers warm up before they accept, export metrics for the others to sum
+        # and keep their audit lines whole on the shared stdout.
+        Lifecycle.warm_before_serving = True
+        MetricsRegistry.shared_dir = self.shared_dir
+        AuditLog.shared_stream = self.plan.workers > 1
+
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, self._on_signal)
+        try:
+            for _ in range(self.plan.workers):
+                self._spawn(config, sock)
+            return self._supervise(config, sock)
+        finally:
+            sock.close()
+            shutil.rmtree(self.shared_dir, ignore_errors=True)
+
+    def _spawn(self, config, sock) -> None:
+        forked = time.monotonic()
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                code = _serve(config, sock, self.plan, forked)
+            except SystemExit as e:  # uvicorn exits with STARTUP_FAILURE when the lifespan fails
+                code = e.code if isinstance(e.code, int) else 1
+            except BaseException:  # noqa: BLE001 - a worker must never return into the supervisor loop
+                logger.exception("worker %d crashed", os.getpid())
+            finally:
+                os._exit(code)
+        self.workers[pid] = forked
+
+    def _supervise(self, config, sock) -> int:
+        exit_code = 0
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            spawned = self.workers.pop(pid, None)
+            if spawned is None:
+                continue
+            code = os.waitstatus_to_exitcode(status)
+            if self.stopping:
+                continue
+            if code == STARTUP_FAILURE:
+                logger.error("worker %d failed to start; stopping", pid)
+                exit_code = STARTUP_FAILURE
+                self._on_signal(signal.SIGTERM, None)
+                continue
+            if code != 0:
+                logger.warning("worker %d exited with %d after %.0fs", pid, code, time.monotonic() - spawned)
+                # A worker that crashes right away would otherwise respawn in a tight loop.
+                if time.monotonic() - spawned < 1.0:
+                    time.sleep(1.0)
+            else:
+                logger.info("worker %d recycled after %.0fs", pid, time.monotonic() - spawned)
+            self.respawns += 1
+            self._spawn(config, sock)
+        logger.info("all workers stopped (%d respawned)", self.respawns)
+        return exit_code
+
+    def _on_signal(self, sig, frame) -> None:
+        # Each worker drains on its own SIGTERM; a second signal is passed on as well.
+        self.stopping = True
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+
+def _serve(config, sock, plan: Plan, forked: float) -> int:
+    """Worker body, after fork: default signal handlers, sized thread pools, uvicorn on the shared socket."""
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, signal.SIG_DFL)
+    random.seed()  # the forked PRNG state is identical in every worker
+
+    import uvicorn
+
+    from zta_common.metrics import MetricsRegistry
+
+    recycling: _Recycling = config.app
+
+    class Worker(uvicorn.Server):
+        closing_since: float | None = None
+
+        async def startup(self, sockets=None):
+            # Runs after the lifespan startup, i.e. after the warmup.
+            await super().startup(sockets)
+            if not self.should_exit:
+                logger.info("worker %d serving %.0f ms after fork", os.getpid(), (time.monotonic() - forked) * 1000)
+
+        async def on_tick(self, counter: int) -> bool:
+            if self.closing_since is None:
+                if not await super().on_tick(counter) or self.should_exit:
+                    return self.should_exit
+                # Request limit reached: let clients leave before the listener and idle connections close.
+                self.closing_since = time.monotonic()
+                self.limit_max_requests = None
+                recycling.closing = True
+                return False
+            if await super().on_tick(counter):
+                return True
+            return not self.server_state.connections or time.monotonic() - self.closing_since >= plan.recycle_grace
+
+        async def shutdown(self, sockets=None):
+            await super().shutdown(sockets)
+            # Before uvicorn re-raises SIGTERM: the last second of metrics would be lost.
+            MetricsRegistry.export_pending()
+
+    server = Worker(config)
+
+    async def main():
+        import anyio.to_thread
+
+        # Sync endpoints and run_in_threadpool (anyio), asyncio.to_thread (audit, compression).
+        anyio.to_thread.current_default_thread_limiter().total_tokens = plan.threads
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=plan.threads, thread_name_prefix="zta-worker"))
+        await server.serve(sockets=[sock])
+
+    with asyncio.Runner(loop_factory=config.get_loop_factory()) as runner:
+        runner.run(main())
+    return 0 if server.started else STARTUP_FAILURE
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("app", nargs="?", default=env_str("LAUNCHER_APP", "main:app"))
+    parser.add_argument("--host", default=env_str("LAUNCHER_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=env_int("LAUNCHER_PORT", 8000))
+    parser.add_argument("--timeout-graceful-shutdown", type=float,
+                        default=env_float("LAUNCHER_GRACEFUL_TIMEOUT", 30.0),
+                        help="seconds uvicorn waits for open connections after the drain")
+    parser.add_argument("--log-level", default=env_str("LAUNCHER_LOG_LEVEL", "info"))
+    parser.add_argument("--access-log", action="store_true", default=env_bool("LAUNCHER_ACCESS_LOG", False))
+    parser.add_argument("--dry-run", action="store_true", help="print the sizing plan and exit")
+    args = parser.parse_args(argv)
+
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter("%(levelname)s:     [%(name)s] %(message)s"))
+    zta = logging.getLogger("zta")
+    zta.addHandler(handler)
+    zta.setLevel(logging.INFO)
+    zta.propagate = False
+
+    plan = Plan.from_env()
+    if args.dry_run:
+        print(asdict(plan))
+        return 0
+    sys.path.insert(0, os.getcwd())
+    return Launcher(args.app, plan, host=args.host, port=args.port, graceful_timeout=args.timeout_graceful_shutdown,
+                    log_level=args.log_level, access_log=args.access_log,
+                    preload=tuple(env_list("LAUNCHER_PRELOAD", list(PRELOAD)))).run()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
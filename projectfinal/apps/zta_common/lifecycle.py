@@ -0,0 +1,289 @@
+"""Warm-start readiness and graceful drain.
+
+``/health`` answers as soon as the process runs, so a new pod used to take
+traffic while its first requests still paid for TCP handshakes across the
+WireGuard tunnel, empty caches and cold policy memos, and a terminated pod
+dropped the ``/api/tkb`` calls it was proxying. ``Lifecycle`` splits that:
+
+- startup: registered warmup steps (pre-open upstream connections, prime
+  caches, in-process self-requests through the app below
+  ``PolicyMiddleware``) run in the background once the server listens;
+  ``/ready`` answers 503 until they are done, then 200. Under the launcher
+  each worker warms up before it accepts instead (``warm_before_serving``). A failed or
+  timed-out step is reported in ``/ready`` but does not hold the pod back:
+  a pod that cannot reach AWS still serves everything else, and keeping it
+  unready would turn a tunnel outage into a full outage. Steps added with
+  ``required=True`` (self-requests that touch nothing remote) are the
+  exception: their failure means the pod itself is broken, so it is logged
+  as an error and ``/ready`` stays 503 (``failed``); under the launcher the
+  worker's startup fails instead;
+- SIGTERM: ``/ready`` turns 503 at once and responses carry
+  ``Connection: close``, while requests keep being served for
+  ``drain_delay`` seconds so the endpoint removal reaches every proxy. Then
+  uvicorn's own handler runs: the listener closes and idle connections are
+  shut. In-flight requests on the tracked prefixes get until
+  ``drain_timeout`` (counted from SIGTERM) to finish, after which they are
+  cancelled. The outcome is logged and kept in ``stats()["drain"]``.
+
+Set the pod's ``terminationGracePeriodSeconds`` above
+``drain_delay + drain_timeout``.
+"""
+
+import asyncio
+import json
+import logging
+import signal
+import time
+from collections.abc import Awaitable, Callable
+
+from starlette.responses import JSONResponse
+
+from zta_common.batch import dispatch, inner_app
+from zta_common.env import env_float, env_list
+from zta_common.identity import SCOPE_KEY as IDENTITY_SCOPE_KEY
+from zta_common.identity import Identity
+
+logger = logging.getLogger("zta.lifecycle")
+
+STARTING, WARMING, READY, FAILED, DRAINING = "starting", "warming", "ready", "failed", "draining"
+
+WARMUP_USER = "zta-warmup"
+
+
+class Lifecycle:
+    # Set by ``zta_common.launcher`` in its workers: the shared socket already
+    # has warm workers behind it, so a new one only accepts once warm.
+    warm_before_serving = False
+
+    def __init__(self, *, warmup_timeout: float = 15.0, drain_delay: float = 5.0, drain_timeout: float = 25.0,
+                 tracked: tuple[str, ...] = ("/api/",)):
+        self.warmup_timeout = warmup_timeout
+        self.drain_delay = drain_delay
+        self.drain_timeout = drain_timeout
+        self.tracked = tracked
+        self.state = STARTING
+        self.warmup: dict[str, dict] = {}
+        self.drain: dict | None = None
+        self._steps: list[tuple[str, Callable[[], Awaitable], bool]] = []
+        self._in_flight: set[asyncio.Task] = set()
+        self._task: asyncio.Task | None = None
+        self._drain_task: asyncio.Task | None = None
+        self._previous_handler = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._started = time.monotonic()
+        self.counters = dict.fromkeys(("tracked", "served_while_draining", "cancelled"), 0)
+
+    @classmethod
+    def from_env(cls, prefix: str = "LIFECYCLE") -> "Lifecycle":
+        """Read ``<PREFIX>_WARMUP_TIMEOUT``, ``<PREFIX>_DRAIN_DELAY``, ``<PREFIX>_DRAIN_TIMEOUT`` and
+        ``<PREFIX>_TRACKED`` (comma-separated path prefixes whose in-flight requests are drained)."""
+        return cls(
+            warmup_timeout=env_float(f"{prefix}_WARMUP_TIMEOUT", 15.0),
+            drain_delay=env_float(f"{prefix}_DRAIN_DELAY", 5.0),
+            drain_timeout=env_float(f"{prefix}_DRAIN_TIMEOUT", 25.0),
+            tracked=tuple(env_list(f"{prefix}_TRACKED", ["/api/"])),
+        )
+
+    # -- warmup ---------------------------------------------------------------
+    def add_step(self, name: str, step: Callable[[], Awaitable], required: bool = False) -> None:
+        """Run ``await step()`` during warmup; its return value is reported in ``/ready``.
+
+        If a ``required`` step fails, the pod never turns ready.
+        """
+        self._steps.append((name, step, required))
+
+    def add_self_request(self, app, path: str, roles: tuple[str, ...] = (), engine=None,
+                         required: bool = False) -> None:
+        """GET ``path`` in-process as a synthetic user with ``roles``.
+
+        The request enters below ``PolicyMiddleware`` (it is never audited), but
+        runs the real handler, so per-role caches, upstream connections and
+        lazily built objects are filled. With ``engine`` the RBAC decision for
+        the same ``(roles, GET, path)`` is memoized first.
+        """
+        identity = Identity(WARMUP_USER if roles else None, None, ",".join(roles) or None, frozenset(roles))
+
+        async def self_request():
+            if app.middleware_stack is None:
+                # Nothing served yet (in-process harnesses enter the lifespan directly):
+                # build the stack as the first request would.
+                app.middleware_stack = app.build_middleware_stack()
+            if engine is not None:
+                engine.allow(identity.roles, "GET", path.partition("?")[0])
+            scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "scheme": "http",
+                     "server": ("warmup", 80), "client": ("127.0.0.1", 0), "root_path": "", "headers": [],
+                     "app": app, "state": {}, IDENTITY_SCOPE_KEY: identity}
+            status, _, _ = await dispatch(inner_app(app), scope, path)
+            if status >= 500:
+                raise RuntimeError(f"HTTP {status}")
+            return status
+
+        label = f"GET {path}" + (f" as {','.join(roles)}" if roles else "")
+        self.add_step(label, self_request, required)
+
+    async def start(self) -> None:
+        """Call at the end of the lifespan startup: installs the SIGTERM handler and starts the warmup.
+
+        With ``warm_before_serving`` the warmup finishes before this returns,
+        i.e. before the server accepts connections, and a failed required
+        step raises ``RuntimeError``.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._started = time.monotonic()
+        try:
+            self._previous_handler = signal.signal(signal.SIGTERM, self._on_sigterm)
+        except ValueError:  # not the main thread (in-process tests): no drain on SIGTERM
+            logger.info("not in the main thread; SIGTERM drain disabled")
+        self.state = WARMING
+        if self.warm_before_serving:
+            await self._warm()
+            if self.state == FAILED:
+                raise RuntimeError("required warmup step(s) failed")
+        else:
+            self._task = asyncio.create_task(self._warm(), name="warmup")
+
+    async def _warm(self) -> None:
+        deadline = time.monotonic() + self.warmup_timeout
+        failed = []
+        for name, step, required in self._steps:
+            started = time.perf_counter()
+            try:
+                result = await asyncio.wait_for(step(), max(0.0, deadline - time.monotonic()))
+            except Exception as e:  # noqa: BLE001 - reported on /ready, never fatal
+                outcome = {"ok": False, "error": str(e) or type(e).__name__}
+                if required:
+                    failed.append(name)
+                    logger.error("required warmup step '%s' failed: %s", name, outcome["error"])
+                else:
+                    logger.warning("warmup step '%s' failed: %s", name, outcome["error"])
+            else:
+                outcome = {"ok": True, "result": result}
+            outcome["ms"] = round((time.perf_counter() - started) * 1000, 2)
+            self.warmup[name] = outcome
+        if self.state != WARMING:
+            return
+        if failed:
+            self.state = FAILED
+            logger.error("not ready: required warmup step(s) failed: %s", ", ".join(failed))
+        else:
+            self.state = READY
+            logger.info("ready after %.2fs warmup", time.monotonic() - self._started)
+
+    # -- readiness ------------------------------------------------------------
+    @property
+    def ready(self) -> bool:
+        return self.state == READY
+
+    def response(self) -> JSONResponse:
+        """``/ready``: 200 once warm, 503 while starting, warming, failed or draining."""
+        body = {"status": self.state, "warmup": self.warmup}
+        if self.drain is not None:
+            body["drain"] = self.drain
+        return JSONResponse(body, status_code=200 if self.ready else 503)
+
+    # -- drain ----------------------------------------------------------------
+    def _on_sigterm(self, sig, frame) -> None:
+        if self.state == DRAINING:
+            # A second SIGTERM skips the rest of the drain.
+            self._hand_over(sig, frame)
+            return
+        self._loop.call_soon_threadsafe(self._begin_drain, sig)
+
+    def _begin_drain(self, sig) -> None:
+        self.state = DRAINING
+        self.drain = {"started_at": time.time(), "in_flight_at_sigterm": len(self._in_flight)}
+        logger.warning("SIGTERM: not ready; serving %.1fs more, then draining %d in-flight request(s)",
+                    self.drain_delay, len(self._in_flight))
+        self._drain_task = asyncio.create_task(self._drain(sig), name="drain")
+
+    def _hand_over(self, sig, frame=None) -> None:
+        previous = self._previous_handler
+        if callable(previous):
+            previous(sig, frame)
+        else:
+            signal.signal(signal.SIGTERM, previous or signal.SIG_DFL)
+            signal.raise_signal(sig)
+
+    async def _drain(self, sig) -> None:
+        started = time.monotonic()
+        await asyncio.sleep(self.drain_delay)
+        # uvicorn: stop accepting, close idle connections, wait for the busy ones.
+        self._hand_over(sig)
+        in_flight = len(self._in_flight)
+        deadline = started + self.drain_timeout
+        while self._in_flight and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        cancelled = len(self._in_flight)
+        for task in list(self._in_flight):
+            task.cancel()
+        self.counters["cancelled"] += cancelled
+        self.drain.update({
+            "in_flight_at_close": in_flight,
+            "drained": in_flight - cancelled,
+            "cancelled": cancelled,
+            "served_while_draining": self.counters["served_while_draining"],
+            "duration_s": round(time.monotonic() - started, 3),
+        })
+        logger.warning("drain finished: %s", json.dumps(self.drain))
+
+    async def stop(self) -> None:
+        """Call first in the lifespan shutdown: stops the warmup, lets the drain record its outcome
+        and restores the SIGTERM handler."""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+        if self._drain_task is not None:
+            # uvicorn has already waited for the connections, so this only finishes the bookkeeping.
+            try:
+                await asyncio.wait_for(self._drain_task, 1.0)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                pass
+        if self._previous_handler is not None:
+            signal.signal(signal.SIGTERM, self._previous_handler)
+            self._previous_handler = None
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            **self.counters,
+            "in_flight": len(self._in_flight),
+            "uptime_s": round(time.monotonic() - self._started, 1),
+            "warmup": self.warmup,
+            "drain": self.drain,
+            "config": {"warmup_timeout": self.warmup_timeout, "drain_delay": self.drain_delay,
+                       "drain_timeout": self.drain_timeout, "tracked": list(self.tracked)},
+        }
+
+
+class LifecycleMiddleware:
+    """Tracks in-flight requests on ``Lifecycle.tracked`` prefixes; adds ``Connection: close`` while draining."""
+
+    def __init__(self, app, lifecycle: Lifecycle):
+        self.app = app
+        self.lifecycle = lifecycle
+
+    async def __call__(self, scope, receive, send):
+        lifecycle = self.lifecycle
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if lifecycle.state == DRAINING:
+            lifecycle.counters["served_while_draining"] += 1
+
+            async def send_closing(message):
+                if message["type"] == "http.response.start":
+                    message["headers"] = [*message.get("headers", ()), (b"connection", b"close")]
+                await send(message)
+
+            send_ = send_closing
+        else:
+            send_ = send
+        if not scope["path"].startswith(lifecycle.tracked):
+            await self.app(scope, receive, send_)
+            return
+        task = asyncio.current_task()
+        lifecycle._in_flight.add(task)
+        lifecycle.counters["tracked"] += 1
+        try:
+            await self.app(scope, receive, send_)
+        finally:
+            lifecycle._in_flight.discard(task)
@@ -0,0 +1,374 @@
+"""Low-overhead Prometheus metrics for the FastAPI apps and their upstreams.
+
+Istio and oauth2-proxy only see the request from outside; these series
+separate the app's own handler time from time spent waiting on the
+cross-cloud upstreams. Every series is created up front (routes are
+enumerated once at startup) with a fixed bucket array, so recording an
+observation is a bisect and a few integer increments - no dicts, lists or
+label strings are built per request. ``render()`` produces the Prometheus
+text exposition format.
+
+Under ``zta_common.launcher`` the pod runs several worker processes behind
+one port, and a scrape lands on any one of them. Each worker then exports
+its series to a file in ``shared_dir`` (a second after a change, at most
+once a second) and ``render()`` serves the sum over all workers. Series of
+exited workers are folded into ``retired.prom``, so counters stay monotonic
+across worker recycling; their in-flight gauges are dropped.
+"""
+
+import asyncio
+import fcntl
+import os
+import time
+import weakref
+from bisect import bisect_left
+
+import httpx
+from starlette.routing import Match
+
+# Seconds. Tuned for a LAN hop plus a WireGuard crossing to Singapore.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATUS_CLASSES = ("1xx", "2xx", "3xx", "4xx", "5xx")
+
+UNMATCHED = "<unmatched>"
+# Anything else is reported as OTHER so clients can't create unbounded series.
+KNOWN_METHODS = frozenset(("GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"))
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+EXPORT_INTERVAL = 1.0
+RETIRED = "retired.prom"
+
+
+def _label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _status_index(status: int) -> int:
+    return min(max(status // 100, 1), 5) - 1
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: tuple = LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: str, out: list) -> None:
+        sep = "," if labels else ""
+        block = f"{{{labels}}}" if labels else ""
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            out.append(f'{name}_bucket{{{labels}{sep}le="{bound}"}} {cumulative}')
+        out.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {self.count}')
+        out.append(f"{name}_sum{block} {self.sum}")
+        out.append(f"{name}_count{block} {self.count}")
+
+
+class _Series:
+    """Counts by status class plus a latency histogram for one label set."""
+
+    __slots__ = ("labels", "by_class", "latency")
+
+    def __init__(self, labels: str):
+        self.labels = labels
+        self.by_class = [0] * len(STATUS_CLASSES)
+        self.latency = Histogram()
+
+    def observe(self, status: int, seconds: float) -> None:
+        self.by_class[_status_index(status)] += 1
+        self.latency.observe(seconds)
+
+
+class UpstreamMetrics:
+    """Latency, outcome and in-flight gauge for one upstream (``aws``, ``tkb-service``)."""
+
+    __slots__ = ("name", "series", "errors", "in_flight")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.series = _Series(f'upstream="{_label_value(name)}"')
+        self.errors = 0
+        self.in_flight = 0
+
+    def observe(self, status: int | None, seconds: float) -> None:
+        if status is None:
+            self.errors += 1
+            self.series.latency.observe(seconds)
+        else:
+            self.series.observe(status, seconds)
+
+
+def _parse(text: str, totals: dict[str, float], *, gauges: bool = True) -> None:
+    """Add the samples of an exposition to ``totals``; without ``gauges`` in-flight gauges are skipped."""
+    for line in text.splitlines():
+        if not line or line[0] == "#":
+            continue
+        key, _, value = line.rpartition(" ")
+        name = key.partition("{")[0]
+        if name.endswith("_in_flight") and not gauges:
+            continue
+        if name.endswith("_process_start_time_seconds"):
+            totals[key] = min(totals.get(key, float(value)), float(value))
+        else:
+            totals[key] = totals.get(key, 0) + float(value)
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class MetricsRegistry:
+    # Set by zta_common.launcher in its workers: export to, and sum over, this directory.
+    shared_dir: str | None = None
+    _instances: "weakref.WeakSet[MetricsRegistry]" = weakref.WeakSet()
+
+    def __init__(self, prefix: str = "zta"):
+        self.prefix = prefix
+        self.in_flight = 0
+        self._routes: dict[tuple[str, str], _Series] = {}
+        self._upstreams: dict[str, UpstreamMetrics] = {}
+        self._app_routes = ()
+        self._static_paths: dict[str, str] = {}
+        self.started = time.time()
+        self._export_pid: int | None = None
+        self._export_path: str | None = None
+        self._export_handle: asyncio.TimerHandle | None = None
+        self._instances.add(self)
+
+    @classmethod
+    def export_pending(cls) -> None:
+        """Write out exports still waiting for their timer; the launcher calls it as a worker shuts down."""
+        for registry in list(cls._instances):
+            if registry._export_handle is not None:
+                registry._export_handle.cancel()
+                registry._export()
+
+    # -- registration (startup only) ---------------------------------------
+    def register_routes(self, routes) -> None:
+        """Preallocate a series for every (route template, method) the app serves."""
+        self._app_routes = tuple(route for route in routes if hasattr(route, "path"))
+        for route in self._app_routes:
+            path = route.path
+            if "{" not in path:
+                self._static_paths[path] = path
+            for method in getattr(route, "methods", None) or ():
+                self._series(path, method)
+
+    def upstream(self, name: str) -> UpstreamMetrics:
+        if name not in self._upstreams:
+            self._upstreams[name] = UpstreamMetrics(name)
+        return self._upstreams[name]
+
+    def _series(self, route: str, method: str) -> _Series:
+        key = (route, method)
+        series = self._routes.get(key)
+        if series is None:
+            series = self._routes[key] = _Series(f'route="{_label_value(route)}",method="{_label_value(method)}"')
+        return series
+
+    # -- hot path -----------------------------------------------------------
+    def route_of(self, scope) -> str:
+        route = scope.get("route")
+        if route is not None:
+            return route.path
+        # Requests answered before routing (policy denials, 404/405) have no
+        # route in scope; a PARTIAL match is a known path with the wrong method.
+        path = self._static_paths.get(scope["path"])
+        if path is not None:
+            return path
+        for candidate in self._app_routes:
+            if candidate.matches(scope)[0] != Match.NONE:
+                return candidate.path
+        return UNMATCHED
+
+    def observe_request(self, scope, status: int, seconds: float) -> None:
+        method = scope["method"]
+        series = self._routes.get((self.route_of(scope), method))
+        if series is None:
+            # Only reachable for 404/405s; bounded by routes x KNOWN_METHODS.
+            series = self._series(self.route_of(scope), method if method in KNOWN_METHODS else "OTHER")
+        series.observe(status, seconds)
+        if self.shared_dir is not None and self._export_handle is None:
+            self._export_handle = asyncio.get_running_loop().call_later(EXPORT_INTERVAL, self._export)
+
+    # -- exposition ---------------------------------------------------------
+    def render(self) -> bytes:
+        """This process's series, or with ``shared_dir`` the sum over every worker."""
+        local = self._render_local()
+        if self.shared_dir is None:
+            return local
+        self._export(local)
+        totals: dict[str, float] = {}
+        for name in self._collect_retired():
+            try:
+                with open(os.path.join(self.shared_dir, name)) as f:
+                    _parse(f.read(), totals)
+            except FileNotFoundError:  # exited and retired by another worker meanwhile
+                continue
+        # Every worker forks from the same preloaded app, so they share one set of series.
+        out = []
+        for line in local.decode().splitlines():
+            if line and line[0] != "#":
+                key = line.rpartition(" ")[0]
+                line = f"{key} {_number(totals.get(key, 0.0))}"
+            out.append(line)
+        out.append("")
+        return "\n".join(out).encode()
+
+    def _export(self, text: bytes | None = None) -> None:
+        self._export_handle = None
+        if self._export_pid != os.getpid():
+            # A pid may come back after a recycle; the fork time keeps the files apart.
+            self._export_pid = os.getpid()
+            self._export_path = os.path.join(self.shared_dir, f"{self._export_pid}-{time.time_ns()}.prom")
+        tmp = self._export_path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(text if text is not None else self._render_local())
+        os.replace(tmp, self._export_path)
+
+    def _collect_retired(self) -> list[str]:
+        """Fold the files of exited workers into ``RETIRED``; returns the files to sum."""
+        with open(os.path.join(self.shared_dir, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            names, dead = [], []
+            for name in os.listdir(self.shared_dir):
+                if name.endswith(".prom") and name != RETIRED:
+                    (names if _alive(int(name.partition("-")[0])) else dead).append(name)
+            retired = os.path.join(self.shared_dir, RETIRED)
+            if dead:
+                totals: dict[str, float] = {}
+                for name in [RETIRED, *dead]:
+                    try:
+                        with open(os.path.join(self.shared_dir, name)) as f:
+                            _parse(f.read(), totals, gauges=False)
+                    except FileNotFoundError:
+                        pass
+                with open(retired + ".tmp", "w") as f:
+                    f.write("".join(f"{key} {_number(value)}\n" for key, value in totals.items()))
+                os.replace(retired + ".tmp", retired)
+                for name in dead:
+                    os.unlink(os.path.join(self.shared_dir, name))
+            if os.path.exists(retired):
+                names.append(RETIRED)
+        return names
+
+    def _render_local(self) -> bytes:
+        p = self.prefix
+        out = [
+            f"# HELP {p}_http_requests_total HTTP requests handled by the app, by route and status class.",
+            f"# TYPE {p}_http_requests_total counter",
+        ]
+        for series in self._routes.values():
+            for cls, count in zip(STATUS_CLASSES, series.by_class):
+                out.append(f'{p}_http_requests_total{{{series.labels},status_class="{cls}"}} {count}')
+        out += [
+            f"# HELP {p}_http_request_duration_seconds Time from request start to the last body byte.",
+            f"# TYPE {p}_http_request_duration_seconds histogram",
+        ]
+        for series in self._routes.values():
+            series.latency.render(f"{p}_http_request_duration_seconds", series.labels, out)
+        out += [
+            f"# HELP {p}_http_requests_in_flight Requests currently being handled.",
+            f"# TYPE {p}_http_requests_in_flight gauge",
+            f"{p}_http_requests_in_flight {self.in_flight}",
+            f"# HELP {p}_upstream_requests_total Calls to cross-cloud upstreams, by status class.",
+            f"# TYPE {p}_upstream_requests_total counter",
+        ]
+        for up in self._upstreams.values():
+            for cls, count in zip(STATUS_CLASSES, up.series.by_class):
+                out.append(f'{p}_upstream_requests_total{{{up.series.labels},status_class="{cls}"}} {count}')
+            out.append(f'{p}_upstream_requests_total{{{up.series.labels},status_class="error"}} {up.errors}')
+        out += [
+            f"# HELP {p}_upstream_request_duration_seconds Time until upstream response headers (or failure).",
+            f"# TYPE {p}_upstream_request_duration_seconds histogram",
+        ]
+        for up in self._upstreams.values():
+            up.series.latency.render(f"{p}_upstream_request_duration_seconds", up.series.labels, out)
+        out += [
+            f"# HELP {p}_upstream_requests_in_flight Upstream calls currently waiting for a response.",
+            f"# TYPE {p}_upstream_requests_in_flight gauge",
+        ]
+        for up in self._upstreams.values():
+            out.append(f"{p}_upstream_requests_in_flight{{{up.series.labels}}} {up.in_flight}")
+        out += [
+            f"# HELP {p}_process_start_time_seconds Start time of the process since unix epoch.",
+            f"# TYPE {p}_process_start_time_seconds gauge",
+            f"{p}_process_start_time_seconds {self.started}",
+        ]
+        out.append("")
+        return "\n".join(out).encode()
+
+
+class MetricsMiddleware:
+    """Outermost ASGI middleware: in-flight gauge plus per-route count/latency."""
+
+    def __init__(self, app, registry: MetricsRegistry):
+        self.app = app
+        self.registry = registry
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        registry = self.registry
+        status = 500
+        started = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        registry.in_flight += 1
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            registry.in_flight -= 1
+            registry.observe_request(scope, status, time.perf_counter() - started)
+
+
+class MeteredTransport(httpx.AsyncBaseTransport):
+    """Wraps an httpx transport and records per-upstream latency, outcome and in-flight calls.
+
+    Latency is measured to the response headers; streamed bodies are not included.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, metrics: UpstreamMetrics):
+        self._transport = transport
+        self.metrics = metrics
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        metrics = self.metrics
+        status = None
+        started = time.perf_counter()
+        metrics.in_flight += 1
+        try:
+            response = await self._transport.handle_async_request(request)
+            status = response.status_code
+            return response
+        finally:
+            metrics.in_flight -= 1
+            metrics.observe(status, time.perf_counter() - started)
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
@@ -0,0 +1,271 @@
+"""In-process RBAC engine compiled from ``policies/opa/authz.rego``.
+
+Asking an OPA sidecar on every request adds a network hop, so the apps load
+the same ``role_permissions`` / ``public_endpoints`` data and evaluate
+``allow`` locally. Paths are compiled into a segment trie; each node holds a
+per-role method bitmask for the exact path and for a trailing ``/*``
+wildcard. Decisions are memoized per ``(roles, method, path)``.
+
+The Rego file stays the source of truth: both objects are plain JSON
+literals there, so they are extracted verbatim. A ``.json`` file with the
+same two top-level keys (``opa eval -f raw data.zta.authz``) works too.
+"""
+
+import json
+import os
+import re
+import time
+from functools import lru_cache
+from pathlib import Path
+
+from zta_common.audit import AuditLog, trace_id_from_scope
+from zta_common.env import env_int
+from zta_common.identity import identity_from_scope
+from zta_common.tracing import child_span, span
+
+_HERE = Path(__file__).resolve().parent
+# Docker images copy the policy to /app/policies; in the repo it lives in policies/opa.
+DEFAULT_POLICY_PATHS = (
+    _HERE.parent / "policies" / "authz.rego",
+    _HERE.parents[1] / "policies" / "opa" / "authz.rego",
+)
+
+METHOD_BITS = {
+    "GET": 1 << 0,
+    "POST": 1 << 1,
+    "PUT": 1 << 2,
+    "DELETE": 1 << 3,
+    "PATCH": 1 << 4,
+    "HEAD": 1 << 5,
+    "OPTIONS": 1 << 6,
+}
+
+# Pseudo-role under which public_endpoints are compiled; every caller has it.
+PUBLIC = "*"
+NO_ROLES = frozenset()
+
+REASON_NO_ROLE = "Access denied: User does not have required role"
+REASON_UNAUTHENTICATED = "Access denied: User not authenticated"
+
+
+class PolicyError(Exception):
+    pass
+
+
+def load_policy_data(path: str | os.PathLike) -> dict:
+    """Return ``{"role_permissions": ..., "public_endpoints": ...}`` from a Rego or JSON file."""
+    text = Path(path).read_text(encoding="utf-8")
+    if str(path).endswith(".json"):
+        data = json.loads(text)
+        return {key: data[key] for key in ("role_permissions", "public_endpoints")}
+    return {key: _rego_literal(text, key) for key in ("role_permissions", "public_endpoints")}
+
+
+def _rego_literal(text: str, name: str):
+    match = re.search(rf"^{name}\s*:=\s*\{{", text, re.MULTILINE)
+    if match is None:
+        raise PolicyError(f"'{name}' not found in policy")
+    start = match.end() - 1
+    depth = 0
+    for i in range(start, len(text)):
+        if text[i] == "{":
+            depth += 1
+        elif text[i] == "}":
+            depth -= 1
+            if depth == 0:
+                body = "\n".join(
+                    line for line in text[start:i + 1].splitlines() if not line.strip().startswith("#")
+                )
+                try:
+                    return json.loads(body)
+                except json.JSONDecodeError as e:
+                    raise PolicyError(f"'{name}' is not a plain JSON literal: {e}") from e
+    raise PolicyError(f"unterminated '{name}' literal")
+
+
+def _segments(path: str) -> list[str]:
+    # "/" -> [""], "/api/x" -> ["api", "x"], "/api/x/" -> ["api", "x", ""]
+    return path.split("/")[1:]
+
+
+def _method_mask(methods) -> int:
+    mask = 0
+    for method in methods:
+        try:
+            mask |= METHOD_BITS[method.upper()]
+        except KeyError:
+            raise PolicyError(f"unknown HTTP method '{method}'") from None
+    return mask
+
+
+class _Node:
+    __slots__ = ("children", "exact", "wildcard")
+
+    def __init__(self):
+        self.children: dict[str, _Node] = {}
+        self.exact: dict[str, int] = {}
+        self.wildcard: dict[str, int] = {}
+
+
+class PolicyEngine:
+    def __init__(self, role_permissions: dict, public_endpoints: dict, cache_size: int = 8192):
+        self.role_permissions = role_permissions
+        self.public_endpoints = public_endpoints
+        self._root = _Node()
+        for role, permissions in role_permissions.items():
+            for pattern, methods in permissions.items():
+                self._add(role, pattern, methods)
+        for pattern, methods in public_endpoints.items():
+            self._add(PUBLIC, pattern, methods)
+        self._cached = lru_cache(maxsize=cache_size)(self._evaluate)
+
+    @classmethod
+    def from_file(cls, path: str | os.PathLike | None = None, cache_size: int | None = None) -> "PolicyEngine":
+        """Load ``path``, ``$POLICY_FILE`` or the first existing default location."""
+        path = path or os.getenv("POLICY_FILE")
+        if path is None:
+            path = next((p for p in DEFAULT_POLICY_PATHS if p.exists()), None)
+            if path is None:
+                raise PolicyError("no policy file found; set POLICY_FILE")
+        if cache_size is None:
+            cache_size = env_int("POLICY_CACHE_SIZE", 8192)
+        return cls(**load_policy_data(path), cache_size=cache_size)
+
+    def _add(self, role: str, pattern: str, methods) -> None:
+        mask = _method_mask(methods)
+        if pattern == "/*":
+            node, table = self._root, "wildcard"
+        elif pattern.endswith("/*"):
+            node, table = self._walk(pattern[:-2]), "wildcard"
+        else:
+            node, table = self._walk(pattern), "exact"
+        masks = getattr(node, table)
+        masks[role] = masks.get(role, 0) | mask
+
+    def _walk(self, path: str) -> _Node:
+        node = self._root
+        for segment in _segments(path):
+            node = node.children.setdefault(segment, _Node())
+        return node
+
+    @staticmethod
+    def _grants(masks: dict, roles: frozenset, bit: int) -> bool:
+        for role, mask in masks.items():
+            if mask & bit and (role == PUBLIC or role in roles):
+                return True
+        return False
+
+    def _evaluate(self, roles: frozenset, method: str, path: str) -> bool:
+        bit = METHOD_BITS.get(method, 0)
+        if not bit:
+            return False
+        node = self._root
+        if node.wildcard and self._grants(node.wildcard, roles, bit):
+            return True
+        for segment in _segments(path):
+            node = node.children.get(segment)
+            if node is None:
+                return False
+            if node.wildcard and self._grants(node.wildcard, roles, bit):
+                return True
+        return self._grants(node.exact, roles, bit)
+
+    def allow(self, roles: frozenset, method: str, path: str) -> bool:
+        return self._cached(roles, method, path)
+
+    def is_public(self, method: str, path: str) -> bool:
+        return self._cached(NO_ROLES, method, path)
+
+    def evaluate_uncached(self, roles: frozenset, method: str, path: str) -> bool:
+        return self._evaluate(roles, method, path)
+
+    @staticmethod
+    def reason(authenticated: bool) -> str:
+        return REASON_NO_ROLE if authenticated else REASON_UNAUTHENTICATED
+
+    def stats(self) -> dict:
+        info = self._cached.cache_info()
+        return {
+            "roles": sorted(self.role_permissions),
+            "cache": info._asdict(),
+        }
+
+
+def _json_response_start(status: int, body: bytes) -> dict:
+    return {
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+        ],
+    }
+
+
+class PolicyMiddleware:
+    """ASGI middleware enforcing ``PolicyEngine.allow`` before any route runs.
+
+    Unauthenticated callers get 401, authenticated callers without a
+    matching role get 403; the body carries the Rego ``reason`` text.
+    With an ``audit`` log, every decision on a non-public endpoint is
+    queued there together with the final status and latency.
+    """
+
+    def __init__(self, app, engine: PolicyEngine, audit: AuditLog | None = None):
+        self.app = app
+        self.engine = engine
+        self.audit = audit
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        identity = identity_from_scope(scope)
+        method, path = scope["method"], scope["path"]
+        rbac = child_span("rbac.evaluate")
+        allowed = self.engine.allow(identity.roles, method, path)
+        if rbac is not None:
+            rbac.attributes.update({"rbac.allowed": allowed, "rbac.roles": ",".join(sorted(identity.roles)),
+                                    "enduser.id": identity.user or ""})
+            rbac.end()
+        audit = self.audit
+        if audit is None or (not audit.include_public and self.engine.is_public(method, path)):
+            if allowed:
+                with span("handler"):
+                    await self.app(scope, receive, send)
+            else:
+                await self._deny(identity, scope, send)
+            return
+
+        status = 500
+        started = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            if allowed:
+                with span("handler"):
+                    await self.app(scope, receive, send_with_status)
+            else:
+                await self._deny(identity, scope, send_with_status)
+        finally:
+            # Handlers may still refuse (api_giangvien checks the role itself).
+            allowed = allowed and status not in (401, 403)
+            await audit.submit(allowed, identity.user, identity.roles, path, method, status,
+                               time.perf_counter() - started, trace_id_from_scope(scope))
+
+    async def _deny(self, identity, scope, send) -> None:
+        status = 403 if identity.authenticated else 401
+        body = json.dumps({
+            "status": "denied",
+            "error": self.engine.reason(identity.authenticated),
+            "user": identity.user,
+            "path": scope["path"],
+            "method": scope["method"],
+        }, ensure_ascii=False).encode()
+        await send(_json_response_start(status, body))
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,184 @@
+"""Background health probing with a circuit breaker.
+
+Endpoints that report on a remote dependency (``/api/aws``) answer from the
+prober's in-memory history instead of making a blocking call per request.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass
+
+import httpx
+
+from zta_common.env import env_float, env_int
+from zta_common.tracing import Tracer
+from zta_common.upstream import UpstreamPool
+
+logger = logging.getLogger("zta.probe")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """Opens after ``failure_threshold`` consecutive failures, half-opens after ``reset_timeout`` seconds."""
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 30.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+
+    def allow(self) -> bool:
+        if self.state == OPEN and self._clock() - self.opened_at >= self.reset_timeout:
+            # Let exactly one trial call through.
+            self.state = HALF_OPEN
+            return True
+        return self.state == CLOSED
+
+    def record_success(self) -> None:
+        self.state = CLOSED
+        self.consecutive_failures = 0
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != OPEN:
+                self.trips += 1
+            self.state = OPEN
+            self.opened_at = self._clock()
+
+    def snapshot(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "trips": self.trips,
+        }
+
+
+@dataclass(frozen=True, slots=True)
+class ProbeSample:
+    at: float
+    ok: bool
+    status_code: int | None
+    rtt: float
+    error: str | None = None
+
+
+def percentile(ordered: list[float], q: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class HealthProber:
+    """Polls ``url`` every ``interval`` seconds and keeps the last ``history`` samples."""
+
+    def __init__(self, name: str, url: str, pool: UpstreamPool, *, interval: float = 5.0,
+                 timeout: float = 5.0, history: int = 120, breaker: CircuitBreaker | None = None,
+                 tracer: Tracer | None = None):
+        self.name = name
+        self.url = url
+        self.pool = pool
+        self.interval = interval
+        self.timeout = timeout
+        self.samples: deque[ProbeSample] = deque(maxlen=history)
+        self.breaker = breaker or CircuitBreaker()
+        self.skipped = 0
+        # Each probe is its own trace, so a traced upstream shows the tunnel RTT too.
+        self.tracer = tracer
+        self._task: asyncio.Task | None = None
+
+    @classmethod
+    def from_env(cls, name: str, url: str, pool: UpstreamPool, prefix: str,
+                 tracer: Tracer | None = None) -> "HealthProber":
+        """Read ``<PREFIX>_PROBE_*`` / ``<PREFIX>_BREAKER_*`` variables, e.g. ``AWS_PROBE_INTERVAL``."""
+        return cls(
+            name, url, pool,
+            interval=env_float(f"{prefix}_PROBE_INTERVAL", 5.0),
+            timeout=env_float(f"{prefix}_PROBE_TIMEOUT", 5.0),
+            history=env_int(f"{prefix}_PROBE_HISTORY", 120),
+            breaker=CircuitBreaker(
+                failure_threshold=env_int(f"{prefix}_BREAKER_FAILURES", 3),
+                reset_timeout=env_float(f"{prefix}_BREAKER_RESET", 30.0),
+            ),
+            tracer=tracer,
+        )
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name=f"probe-{self.name}")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            started = time.perf_counter()
+            try:
+                await self.probe_once()
+            except Exception as e:
+                # Anything _probe does not expect (an invalid URL, a closed client) must not
+                # end the loop and leave /api/aws serving a frozen snapshot.
+                logger.exception("probe %s failed", self.name)
+                self._record_failure(started, e)
+            await asyncio.sleep(self.interval)
+
+    async def probe_once(self) -> ProbeSample | None:
+        if not self.breaker.allow():
+            self.skipped += 1
+            return None
+        if self.tracer is None:
+            return await self._probe()
+        with self.tracer.trace(f"probe {self.name}", attributes={"url.full": self.url}):
+            return await self._probe()
+
+    async def _probe(self) -> ProbeSample:
+        started = time.perf_counter()
+        try:
+            response = await self.pool.client.get(self.url, timeout=self.timeout)
+        except (httpx.HTTPError, OSError) as e:
+            return self._record_failure(started, e)
+        sample = ProbeSample(time.time(), True, response.status_code, time.perf_counter() - started)
+        self.breaker.record_success()
+        self.samples.append(sample)
+        return sample
+
+    def _record_failure(self, started: float, error: Exception) -> ProbeSample:
+        sample = ProbeSample(time.time(), False, None, time.perf_counter() - started, str(error) or type(error).__name__)
+        self.breaker.record_failure()
+        self.samples.append(sample)
+        return sample
+
+    def snapshot(self) -> dict:
+        last = self.samples[-1] if self.samples else None
+        rtts = sorted(s.rtt for s in self.samples if s.ok)
+        latency = {}
+        if rtts:
+            latency = {
+                "samples": len(rtts),
+                "p50_ms": round(percentile(rtts, 0.50) * 1000, 2),
+                "p95_ms": round(percentile(rtts, 0.95) * 1000, 2),
+                "p99_ms": round(percentile(rtts, 0.99) * 1000, 2),
+            }
+        return {
+            "ok": bool(last and last.ok) and self.breaker.state != OPEN,
+            "last_status_code": last.status_code if last else None,
+            "last_error": last.error if last else None,
+            "last_rtt_ms": round(last.rtt * 1000, 2) if last else None,
+            "last_checked_age_s": round(time.time() - last.at, 1) if last else None,
+            "latency": latency,
+            "breaker": self.breaker.snapshot(),
+            "skipped_while_open": self.skipped,
+        }
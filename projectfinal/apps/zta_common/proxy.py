@@ -0,0 +1,109 @@
+"""Streaming reverse-proxy passthrough.
+
+Forwards any method and request body to an upstream and relays the
+response chunks as they arrive, without buffering or re-serialising the
+body. Memory use stays flat whatever the payload size, and non-JSON
+responses pass through unchanged. Proxy metadata travels in response
+headers instead of the body.
+
+The upstream is asked for a compressed body (the tunnel is the narrow
+link). When the client accepts the coding the upstream picked, the bytes
+are relayed still compressed; otherwise they are decoded on the way.
+"""
+
+from collections.abc import Callable, Iterable
+
+import httpx
+from starlette.background import BackgroundTask
+from starlette.requests import Request
+from starlette.responses import StreamingResponse
+
+from zta_common.compression import accepts, upstream_accept_encoding
+
+# Scope key under which streamed responses register their close(); in-process
+# callers that stop reading early (batch items, warmup) await each one.
+CLOSE_SCOPE_KEY = "zta.close"
+
+# RFC 9110 section 7.6.1: connection-specific headers a proxy must not forward.
+HOP_BY_HOP = frozenset((
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "proxy-connection",
+    "te", "trailer", "transfer-encoding", "upgrade",
+))
+
+# Never sent across the cloud boundary: the upstream gets the resolved
+# identity headers instead of the caller's session cookie or bearer token.
+REQUEST_DROP = HOP_BY_HOP | {"host", "cookie", "authorization"}
+
+
+def filter_headers(items: list[tuple[str, str]], drop: Iterable[str] = HOP_BY_HOP,
+                   skip_prefixes: tuple = ()) -> list[tuple[str, str]]:
+    """Copy header pairs minus hop-by-hop ones and anything the ``Connection`` header names."""
+    dropped = set(drop)
+    for name, value in items:
+        if name.lower() == "connection":
+            dropped.update(token.strip().lower() for token in value.split(","))
+    return [
+        (name, value) for name, value in items
+        if name.lower() not in dropped and not name.lower().startswith(skip_prefixes)
+    ]
+
+
+def _has_body(request: Request) -> bool:
+    return "content-length" in request.headers or "transfer-encoding" in request.headers
+
+
+async def stream_upstream(request: Request, client: httpx.AsyncClient, path: str, *,
+                          identity_headers: dict[str, str],
+                          response_headers: dict[str, str] | None = None,
+                          on_close: Callable[[], object] | None = None) -> StreamingResponse:
+    """Send ``request`` to ``path`` on ``client`` and stream the upstream response back.
+
+    Caller-supplied ``x-forwarded-*`` / ``x-auth-request-*`` headers are
+    replaced by ``identity_headers``. A compressed upstream body the client
+    accepts is relayed raw and keeps its ``content-encoding``/``content-length``;
+    any other coding is decoded and sent without them. ``on_close`` is
+    called once, after the upstream response is closed.
+    """
+    client_accept = request.headers.get("accept-encoding")
+    headers = filter_headers(request.headers.items(), REQUEST_DROP | {"accept-encoding"},
+                             skip_prefixes=("x-forwarded-", "x-auth-request-"))
+    headers.extend(identity_headers.items())
+    headers.append(("accept-encoding", upstream_accept_encoding(client_accept)))
+    upstream_request = client.build_request(
+        request.method,
+        path,
+        params=request.query_params,
+        headers=headers,
+        content=request.stream() if _has_body(request) else None,
+    )
+    upstream = await client.send(upstream_request, stream=True)
+    content_encoding = upstream.headers.get("content-encoding")
+    passthrough = not content_encoding or accepts(client_accept, content_encoding)
+    chunks = upstream.aiter_raw if passthrough else upstream.aiter_bytes
+
+    async def close():
+        nonlocal on_close
+        try:
+            await upstream.aclose()
+        finally:
+            if on_close is not None:
+                callback, on_close = on_close, None
+                callback()
+
+    async def relay():
+        try:
+            async for chunk in chunks():
+                yield chunk
+        finally:
+            await close()
+
+    # close() also runs as a background task in case the client goes away
+    # before the first chunk; it is idempotent.
+    request.scope.setdefault(CLOSE_SCOPE_KEY, []).append(close)
+    response = StreamingResponse(relay(), status_code=upstream.status_code,
+                                 background=BackgroundTask(close))
+    drop = HOP_BY_HOP if passthrough else HOP_BY_HOP | {"content-encoding", "content-length"}
+    headers = filter_headers(upstream.headers.multi_items(), drop)
+    headers.extend((response_headers or {}).items())
+    response.raw_headers.extend((name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers)
+    return response
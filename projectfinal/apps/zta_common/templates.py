@@ -0,0 +1,94 @@
+"""Precompiled HTML templates with strong ETags.
+
+The home pages are several kilobytes of static markup around a handful of
+identity fields. ``Template`` splits the source once into encoded byte
+fragments; a render only HTML-escapes the fields and joins the pieces.
+Placeholders are written ``{{name}}``; every other brace is literal.
+
+A rendered page also hands its pieces to ``CompressionMiddleware`` on the
+body message (``FRAGMENTS_KEY``): the static fragments are the same for
+every user, so their compressed forms are cached once per encoding and only
+the escaped fields are encoded per request.
+"""
+
+import hashlib
+import html
+import re
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+_PLACEHOLDER = re.compile(r"\{\{\s*(\w+)\s*\}\}")
+
+# Identity-dependent pages may only be cached by the browser, and must be
+# revalidated on every view so a logout/role change is seen immediately.
+CACHE_CONTROL = "private, no-cache"
+
+# Body message key carrying the rendered pieces: static fragments at even
+# indexes, escaped field values at odd ones.
+FRAGMENTS_KEY = "zta.fragments"
+
+
+class Template:
+    __slots__ = ("source", "digest", "fields", "_static", "_names")
+
+    def __init__(self, source: str):
+        parts = _PLACEHOLDER.split(source)
+        self.source = source
+        self.digest = hashlib.blake2b(source.encode(), digest_size=8).digest()
+        self._static = [part.encode() for part in parts[0::2]]
+        self._names = parts[1::2]
+        self.fields = tuple(dict.fromkeys(self._names))
+
+    def render(self, fields: dict) -> bytes:
+        return b"".join(self.render_parts(fields))
+
+    def render_parts(self, fields: dict) -> list[bytes]:
+        """The page as pieces: static fragments at even indexes, escaped fields between them."""
+        out = [self._static[0]]
+        for name, static in zip(self._names, self._static[1:]):
+            out.append(html.escape(str(fields[name])).encode())
+            out.append(static)
+        return out
+
+    def etag(self, fields: dict) -> str:
+        """Strong validator over the template source and the field values."""
+        h = hashlib.blake2b(self.digest, digest_size=12)
+        for name in self.fields:
+            h.update(str(fields[name]).encode())
+            h.update(b"\0")
+        return f'"{h.hexdigest()}"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """``If-None-Match`` uses weak comparison, so ``W/`` prefixes are ignored."""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+class FragmentResponse(Response):
+    """HTML response whose body message also carries its pieces under ``FRAGMENTS_KEY``."""
+
+    media_type = "text/html"
+
+    def __init__(self, parts: list[bytes], headers: dict):
+        super().__init__(b"".join(parts), headers=headers)
+        self.parts = parts
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        await send({"type": "http.response.body", "body": self.body, FRAGMENTS_KEY: self.parts})
+
+
+def render_html(request: Request, template: Template, fields: dict) -> Response:
+    """Render ``template`` or answer 304 when the client already holds this variant."""
+    etag = template.etag(fields)
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return FragmentResponse(template.render_parts(fields), headers)
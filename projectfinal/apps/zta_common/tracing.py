@@ -0,0 +1,526 @@
+"""Lightweight distributed tracing with W3C ``traceparent`` propagation.
+
+A slow ``/api/tkb`` call can be spent in the demo app, on the WireGuard
+tunnel or inside ``tkb-service``; spans on both sides of the hop, joined
+by one trace id, tell them apart. ``TracingMiddleware`` accepts the
+caller's ``traceparent`` (or starts a new trace) and opens a server span
+for the request. Inside it:
+
+- ``PolicyMiddleware`` records ``rbac.evaluate`` and wraps the rest of the
+  request in ``handler``; an upstream call behind a ``ConcurrencyLimiter``
+  adds ``admission.acquire``;
+- every ``UpstreamPool`` sends through ``TracingTransport``, which opens a
+  client span per outbound request (hedges included) and sets
+  ``traceparent`` on it, so ``tkb-service`` continues the same trace.
+
+``/api/aws`` answers from the AWS health probe and makes no call of its
+own; the probe starts one trace per check (``Tracer.trace``) instead.
+
+The active span lives in a ``ContextVar``, so tasks spawned by a request
+(``/api/batch`` items, hedged GETs) inherit it without any plumbing.
+
+Sampling is decided once per trace at the edge: an incoming sampled flag
+is honoured, otherwise the trace id is compared against ``sample_ratio``
+(the OpenTelemetry ``TraceIdRatioBased`` rule, so every service that uses
+the same ratio keeps the same traces). Unsampled requests still get ids
+and propagate ``traceparent`` with the flag cleared, but record nothing;
+that path costs an id and a ``ContextVar`` set per request.
+
+Finished spans go to ``SpanExporter``: a bounded queue drained in batches
+by a background task, like ``AuditLog``. Batches are encoded as
+OTLP/JSON ``ExportTraceServiceRequest`` documents and either appended to a
+file, one per line (the format the OpenTelemetry Collector's
+``otlpjsonfile`` receiver reads), or POSTed to an OTLP/HTTP endpoint.
+"""
+
+import asyncio
+import contextlib
+import json
+import logging
+import random
+import sys
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import NamedTuple, TextIO
+
+import httpx
+
+from zta_common.env import env_bool, env_float, env_int, env_str
+
+logger = logging.getLogger("zta.tracing")
+
+# Per-request SpanContext in the ASGI scope, next to identity.SCOPE_KEY.
+SCOPE_KEY = "zta.trace"
+
+# OTLP span kinds
+INTERNAL, SERVER, CLIENT = 1, 2, 3
+# OTLP status codes
+STATUS_OK, STATUS_ERROR = 1, 2
+
+# Probes and scrapes would be most of the spans and none of the insight.
+UNTRACED_PATHS = frozenset(("/health", "/ready", "/metrics"))
+
+_HEX = frozenset("0123456789abcdef")
+_LOW_64 = (1 << 64) - 1
+
+
+class SpanContext(NamedTuple):
+    trace_id: str  # 32 lowercase hex digits
+    span_id: str  # 16 lowercase hex digits
+    sampled: bool
+
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+
+def parse_traceparent(value: bytes | str) -> SpanContext | None:
+    """``SpanContext`` of a W3C ``traceparent`` header, or None if it is malformed."""
+    if isinstance(value, bytes):
+        value = value.decode("latin-1")
+    parts = value.strip().split("-")
+    if len(parts) < 4:
+        return None
+    version, trace_id, span_id, flags = parts[:4]
+    if (len(version) != 2 or version == "ff" or len(trace_id) != 32 or len(span_id) != 16 or len(flags) != 2
+            or not _HEX.issuperset(version + trace_id + span_id + flags)):
+        return None
+    # Version 00 has exactly four fields; later versions may append more.
+    if version == "00" and len(parts) != 4:
+        return None
+    if trace_id == "0" * 32 or span_id == "0" * 16:
+        return None
+    return SpanContext(trace_id, span_id, bool(int(flags, 16) & 1))
+
+
+def _new_span_id() -> str:
+    return f"{random.getrandbits(64) or 1:016x}"
+
+
+class Span:
+    """One timed operation. Unsampled spans (``tracer`` is None) only carry ids for propagation."""
+
+    __slots__ = ("tracer", "name", "kind", "context", "parent_id", "start_ns", "end_ns", "attributes",
+                 "status", "message")
+
+    def __init__(self, tracer: "Tracer | None", name: str, kind: int, context: SpanContext,
+                 parent_id: str | None, attributes: dict | None = None):
+        self.tracer = tracer
+        self.name = name
+        self.kind = kind
+        self.context = context
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns() if tracer is not None else 0
+        self.end_ns = 0
+        self.attributes = attributes if attributes is not None else {}
+        self.status = 0
+        self.message = ""
+
+    @property
+    def recording(self) -> bool:
+        return self.tracer is not None
+
+    def child(self, name: str, kind: int = INTERNAL, attributes: dict | None = None) -> "Span":
+        context = SpanContext(self.context.trace_id, _new_span_id(), self.context.sampled)
+        return Span(self.tracer, name, kind, context, self.context.span_id, attributes)
+
+    def set_error(self, message: str) -> None:
+        self.status = STATUS_ERROR
+        self.message = message
+
+    def end(self) -> None:
+        if self.tracer is not None and not self.end_ns:
+            self.end_ns = time.time_ns()
+            self.tracer.exporter.submit(self)
+
+
+_current: ContextVar[Span | None] = ContextVar("zta_span", default=None)
+
+
+def current_span() -> Span | None:
+    return _current.get()
+
+
+def child_span(name: str, kind: int = INTERNAL, attributes: dict | None = None) -> Span | None:
+    """Start a leaf span under the active one; None (and no cost) when the request is not sampled.
+
+    The caller must ``end()`` it. Use ``span()`` when the work inside should nest under it.
+    """
+    parent = _current.get()
+    if parent is None or parent.tracer is None:
+        return None
+    return parent.child(name, kind, attributes)
+
+
+class span:
+    """Run the block in a child span of the active one, and make it the active span meanwhile.
+
+    A class rather than a generator: the unsampled path is a ``ContextVar`` read and two calls.
+    """
+
+    __slots__ = ("span", "_token")
+
+    def __init__(self, name: str, kind: int = INTERNAL, attributes: dict | None = None):
+        self.span = child_span(name, kind, attributes)
+        self._token = None
+
+    def __enter__(self) -> Span | None:
+        if self.span is not None:
+            self._token = _current.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if self.span is not None:
+            if exc_type is not None:
+                self.span.set_error(exc_type.__name__)
+            _current.reset(self._token)
+            self.span.end()
+
+
+# -- export -----------------------------------------------------------------
+def _attribute(key: str, value) -> dict:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+def _encode_span(s: Span) -> dict:
+    out = {
+        "traceId": s.context.trace_id,
+        "spanId": s.context.span_id,
+        "name": s.name,
+        "kind": s.kind,
+        "startTimeUnixNano": str(s.start_ns),
+        "endTimeUnixNano": str(s.end_ns),
+        "attributes": [_attribute(k, v) for k, v in s.attributes.items()],
+        "status": {"code": s.status, "message": s.message} if s.status else {},
+    }
+    if s.parent_id:
+        out["parentSpanId"] = s.parent_id
+    return out
+
+
+def encode_otlp(spans: list[Span], resource: dict) -> dict:
+    """OTLP/JSON ``ExportTraceServiceRequest`` for one batch."""
+    return {"resourceSpans": [{
+        "resource": {"attributes": [_attribute(k, v) for k, v in resource.items()]},
+        "scopeSpans": [{"scope": {"name": "zta_common.tracing"}, "spans": [_encode_span(s) for s in spans]}],
+    }]}
+
+
+class FileSink:
+    """Appends one OTLP/JSON document per batch, one per line; written from a worker thread."""
+
+    def __init__(self, stream: TextIO):
+        self.stream = stream
+
+    async def export(self, payload: bytes) -> None:
+        await asyncio.to_thread(self._write, payload)
+
+    def _write(self, payload: bytes) -> None:
+        self.stream.write(payload.decode() + "\n")
+        self.stream.flush()
+
+    async def aclose(self) -> None:
+        if self.stream not in (sys.stdout, sys.stderr):
+            self.stream.close()
+
+
+class OtlpHttpSink:
+    """POSTs batches to an OTLP/HTTP collector (``<endpoint>/v1/traces``, JSON encoding)."""
+
+    def __init__(self, endpoint: str, timeout: float = 5.0):
+        # Imported here: upstream.py installs TracingTransport from this module.
+        from zta_common.upstream import PoolConfig, UpstreamPool
+        config = PoolConfig(max_connections=2, max_keepalive_connections=2, read_timeout=timeout)
+        self.pool = UpstreamPool("otel-collector", endpoint, config)
+
+    async def export(self, payload: bytes) -> None:
+        await self.pool.start()
+        response = await self.pool.client.post("/v1/traces", content=payload,
+                                               headers={"content-type": "application/json"})
+        response.raise_for_status()
+
+    async def aclose(self) -> None:
+        await self.pool.aclose()
+
+
+class SpanExporter:
+    """Bounded queue of finished spans, exported in batches by a background task; full means dropped."""
+
+    def __init__(self, sink, resource: dict, *, max_queue: int = 20_000, batch_size: int = 512,
+                 flush_interval: float = 2.0):
+        self.sink = sink
+        self.resource = resource
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: deque[Span] = deque()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._stopping = False
+        self.counters = dict.fromkeys(("submitted", "exported", "batches", "dropped", "export_errors"), 0)
+
+    def submit(self, s: Span) -> None:
+        if len(self._queue) >= self.max_queue:
+            self.counters["dropped"] += 1
+            return
+        self._queue.append(s)
+        self.counters["submitted"] += 1
+        if len(self._queue) >= self.batch_size:
+            self._wakeup.set()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run(), name="trace-export")
+
+    async def stop(self, timeout: float = 5.0) -> None:
+        """Export what is queued (up to ``timeout`` seconds), stop the task and close the sink."""
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            try:
+                await asyncio.wait_for(self._task, timeout)
+            except TimeoutError:
+                logger.warning("trace export did not finish in %.1fs; %d spans lost", timeout, len(self._queue))
+            self._task = None
+        await self.sink.aclose()
+
+    async def flush(self) -> None:
+        while self._queue:
+            await self._export_batch()
+
+    async def _run(self) -> None:
+        while True:
+            if not self._queue and not self._stopping:
+                with contextlib.suppress(TimeoutError):
+                    await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            self._wakeup.clear()
+            await self.flush()
+            if self._stopping:
+                return
+
+    async def _export_batch(self) -> None:
+        n = min(self.batch_size, len(self._queue))
+        batch = [self._queue.popleft() for _ in range(n)]
+        payload = json.dumps(encode_otlp(batch, self.resource), separators=(",", ":")).encode()
+        try:
+            await self.sink.export(payload)
+        except Exception as e:  # noqa: BLE001 - tracing must never take the app down
+            self.counters["export_errors"] += 1
+            self.counters["dropped"] += n
+            logger.warning("trace export failed, %d spans dropped: %s", n, e)
+        else:
+            self.counters["exported"] += n
+            self.counters["batches"] += 1
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "queue_depth": len(self._queue),
+            "max_queue": self.max_queue,
+            "batch_size": self.batch_size,
+            "sink": type(self.sink).__name__,
+            "running": self._task is not None,
+        }
+
+
+class Tracer:
+    """Makes the sampling decision and starts root spans; ``exporter`` None means propagate only."""
+
+    def __init__(self, service: str, exporter: SpanExporter | None = None, *, sample_ratio: float = 0.05,
+                 parent_based: bool = True):
+        self.service = service
+        self.exporter = exporter
+        self.sample_ratio = min(max(sample_ratio, 0.0), 1.0)
+        self.parent_based = parent_based
+        # Sampled iff the low 64 bits of the trace id fall under this bound.
+        self._bound = int(self.sample_ratio * (1 << 64))
+        self.counters = dict.fromkeys(("traces", "continued", "sampled"), 0)
+
+    @classmethod
+    def from_env(cls, service: str, prefix: str = "TRACE") -> "Tracer":
+        """Read ``<PREFIX>_EXPORTER`` (``none``, ``file`` or ``otlp``), ``<PREFIX>_FILE`` (path or ``-``),
+        ``<PREFIX>_OTLP_ENDPOINT``, ``<PREFIX>_SAMPLE_RATIO``, ``<PREFIX>_PARENT_BASED``,
+        ``<PREFIX>_SERVICE_NAME`` and the ``<PREFIX>_QUEUE_SIZE`` / ``_BATCH_SIZE`` / ``_FLUSH_INTERVAL`` knobs."""
+        service = env_str(f"{prefix}_SERVICE_NAME", service)
+        kind = env_str(f"{prefix}_EXPORTER", "none").lower()
+        if kind == "file":
+            path = env_str(f"{prefix}_FILE", "-")
+            sink = FileSink(sys.stdout if path == "-" else open(path, "a", encoding="utf-8"))  # noqa: SIM115
+        elif kind == "otlp":
+            sink = OtlpHttpSink(env_str(f"{prefix}_OTLP_ENDPOINT", "http://otel-collector:4318"))
+        elif kind == "none":
+            sink = None
+        else:
+            raise ValueError(f"unknown {prefix}_EXPORTER '{kind}', expected none, file or otlp")
+        exporter = None
+        if sink is not None:
+            exporter = SpanExporter(
+                sink, {"service.name": service},
+                max_queue=env_int(f"{prefix}_QUEUE_SIZE", 20_000),
+                batch_size=env_int(f"{prefix}_BATCH_SIZE", 512),
+                flush_interval=env_float(f"{prefix}_FLUSH_INTERVAL", 2.0),
+            )
+        return cls(service, exporter, sample_ratio=env_float(f"{prefix}_SAMPLE_RATIO", 0.05),
+                   parent_based=env_bool(f"{prefix}_PARENT_BASED", True))
+
+    def start(self) -> None:
+        if self.exporter is not None:
+            self.exporter.start()
+
+    async def aclose(self) -> None:
+        if self.exporter is not None:
+            await self.exporter.stop()
+
+    def start_span(self, name: str, kind: int = SERVER, parent: SpanContext | None = None,
+                   attributes: dict | None = None) -> Span:
+        """Root span of this service for one request, continuing ``parent`` if there is one."""
+        if parent is None:
+            self.counters["traces"] += 1
+            bits = random.getrandbits(128) or 1
+            trace_id = f"{bits:032x}"
+            sampled = bits & _LOW_64 < self._bound
+        else:
+            self.counters["continued"] += 1
+            trace_id = parent.trace_id
+            sampled = parent.sampled if self.parent_based else int(trace_id[16:], 16) < self._bound
+        recording = sampled and self.exporter is not None
+        if recording:
+            self.counters["sampled"] += 1
+        context = SpanContext(trace_id, _new_span_id(), sampled)
+        return Span(self if recording else None, name, kind, context,
+                    parent.span_id if parent is not None else None, attributes)
+
+    @contextlib.contextmanager
+    def trace(self, name: str, kind: int = INTERNAL, attributes: dict | None = None):
+        """Run the block as a new trace rooted in this span (background work outside any request)."""
+        root = self.start_span(name, kind, None, attributes)
+        token = _current.set(root)
+        try:
+            yield root
+        except BaseException as e:
+            root.set_error(type(e).__name__)
+            raise
+        finally:
+            _current.reset(token)
+            root.end()
+
+    def stats(self) -> dict:
+        return {
+            "service": self.service,
+            **self.counters,
+            "sample_ratio": self.sample_ratio,
+            "parent_based": self.parent_based,
+            "exporter": self.exporter.stats() if self.exporter is not None else None,
+        }
+
+
+class TracingMiddleware:
+    """Outer ASGI middleware: continues or starts the trace and records the server span.
+
+    The span is named ``<METHOD> <route template>`` once routing is done, so
+    ``/api/tkb/{path}`` requests share one name.
+    """
+
+    def __init__(self, app, tracer: Tracer, untraced: frozenset = UNTRACED_PATHS):
+        self.app = app
+        self.tracer = tracer
+        self.untraced = untraced
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.untraced:
+            await self.app(scope, receive, send)
+            return
+        parent = None
+        for name, value in scope["headers"]:
+            if name == b"traceparent":
+                parent = parse_traceparent(value)
+                break
+        method = scope["method"]
+        root = self.tracer.start_span(method, SERVER, parent)
+        scope[SCOPE_KEY] = root.context
+        token = _current.set(root)
+        if root.tracer is None:
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                _current.reset(token)
+            return
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        except BaseException as e:
+            root.set_error(type(e).__name__)
+            raise
+        finally:
+            _current.reset(token)
+            route = scope.get("route")
+            route = getattr(route, "path", None) or scope["path"]
+            root.name = f"{method} {route}"
+            root.attributes.update({
+                "http.request.method": method,
+                "http.route": route,
+                "url.path": scope["path"],
+                "http.response.status_code": status,
+            })
+            if status >= 500 and not root.status:
+                root.set_error(f"HTTP {status}")
+            root.end()
+
+
+class TracingTransport(httpx.AsyncBaseTransport):
+    """Wraps an httpx transport: client span per request and ``traceparent`` on the wire.
+
+    Outside a request (background probes, JWKS refreshes) requests pass
+    through untouched. Like ``MeteredTransport``, the span ends at the
+    response headers; a streamed body is not included.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, name: str):
+        self._transport = transport
+        self.name = name
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        parent = _current.get()
+        if parent is None:
+            return await self._transport.handle_async_request(request)
+        if parent.tracer is None:
+            request.headers["traceparent"] = parent.context.traceparent()
+            return await self._transport.handle_async_request(request)
+        s = parent.child(f"{request.method} {self.name}", CLIENT, {
+            "http.request.method": request.method,
+            "server.address": request.url.host,
+            "server.port": request.url.port or (443 if request.url.scheme == "https" else 80),
+            "url.path": request.url.path,
+            "peer.service": self.name,
+        })
+        request.headers["traceparent"] = s.context.traceparent()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException as e:
+            s.set_error(type(e).__name__)
+            raise
+        else:
+            s.attributes["http.response.status_code"] = response.status_code
+            if response.status_code >= 500:
+                s.set_error(f"HTTP {response.status_code}")
+            return response
+        finally:
+            s.end()
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
@@ -1,29 +1,108 @@
-from fastapi import FastAPI, Header, Response, Request
+from contextlib import asynccontextmanager
+from fastapi import Depends, FastAPI, Response, Request
 from fastapi.responses import HTMLResponse
+import json
 import os
 
-app = FastAPI()
+from zta_common import (
+    AdmissionMiddleware, AuditLog, AuthMiddleware, CompressionMiddleware, Compressor, HealthProber, Identity, Lifecycle,
+    LifecycleMiddleware, MetricsMiddleware, MetricsRegistry, PolicyEngine, PolicyMiddleware, PoolConfig, RateLimiter,
+    TokenVerifier, Tracer, TracingMiddleware, UpstreamPool, get_identity,
+)
+from zta_common.batch import handle_batch
+from zta_common.env import env_int, env_str
+from zta_common.identity import cache_info as identity_cache_info
+from zta_common.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+from zta_common.templates import Template, render_html
 
 AWS_URL = os.getenv("AWS_URL", "http://10.10.1.10:8080/")
 
-# ═══════════════════════════════════════════════════════════════════════════
-# TRANG CHỦ - Giao diện web đẹp để demo cho thầy
-# ═══════════════════════════════════════════════════════════════════════════
-@app.get("/", response_class=HTMLResponse)
-def home(request: Request):
-    # Lấy headers - oauth2-proxy dùng x-forwarded-*
-    headers = dict(request.headers)
-    username = headers.get("x-forwarded-preferred-username") or headers.get("x-forwarded-user")
-    email = headers.get("x-forwarded-email")
-    groups = headers.get("x-forwarded-groups") or ""
-    
-    # Xác định role từ groups header
-    is_giangvien = "giangvien" in groups.lower() if groups else False
-    is_sinhvien = "sinhvien" in groups.lower() if groups else False
-    role_display = "Giảng viên 👨‍🏫" if is_giangvien else ("Sinh viên 👨‍🎓" if is_sinhvien else "Khách")
-    role_color = "#28a745" if is_giangvien else ("#007bff" if is_sinhvien else "#6c757d")
-    
-    html_content = f"""
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Kiểm tra AWS định kỳ ở background; /api/aws chỉ đọc kết quả trong bộ nhớ
+    METRICS.register_routes(app.routes)
+    app.state.aws = UpstreamPool("aws", AWS_URL, PoolConfig.from_env("AWS"), metrics=METRICS.upstream("aws"))
+    await app.state.aws.start()
+    app.state.aws_prober = HealthProber.from_env("aws", AWS_URL, app.state.aws, "AWS", tracer=TRACER)
+    app.state.aws_prober.start()
+    if AUTH is not None:
+        await AUTH.start()
+    AUDIT.start()
+    TRACER.start()
+    # /ready = 503 cho tới khi chạy xong các bước warmup bên dưới
+    await LIFECYCLE.start()
+    try:
+        yield
+    finally:
+        await LIFECYCLE.stop()
+        await app.state.aws_prober.stop()
+        await app.state.aws.aclose()
+        if AUTH is not None:
+            await AUTH.aclose()
+        await AUDIT.stop()
+        await TRACER.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
+
+# RBAC từ policies/opa/authz.rego, đánh giá ngay trong app (không cần gọi OPA).
+# Mỗi quyết định được ghi vào audit log (JSON lines, ghi theo batch ở background)
+POLICY = PolicyEngine.from_file()
+AUDIT = AuditLog.from_env()
+
+# Giới hạn tốc độ theo user (token bucket, mức theo role: ADMISSION_RATE_<ROLE>), trả 429 + Retry-After.
+# /api/aws chỉ đọc kết quả probe nên không cần giới hạn số request đồng thời tới AWS
+RATES = RateLimiter.from_env(POLICY)
+app.add_middleware(AdmissionMiddleware, engine=POLICY, rates=RATES)
+app.add_middleware(PolicyMiddleware, engine=POLICY, audit=AUDIT)
+
+# AUTH_MODE=jwt: lấy identity từ token Keycloak (verify chữ ký bằng JWKS của realm,
+# cache theo token) thay vì tin header x-forwarded-groups
+AUTH = TokenVerifier.from_env("OIDC") if env_str("AUTH_MODE", "headers") == "jwt" else None
+if AUTH is not None:
+    app.add_middleware(AuthMiddleware, verifier=AUTH)
+
+# Tracing: nhận/tạo W3C traceparent, span cho request, RBAC, handler và probe AWS.
+# Lấy mẫu TRACE_SAMPLE_RATIO; TRACE_EXPORTER=file|otlp để xuất span (mặc định chỉ truyền traceparent)
+TRACER = Tracer.from_env("zta-demo-app")
+app.add_middleware(TracingMiddleware, tracer=TRACER)
+
+# Readiness: /ready chỉ trả 200 sau khi warmup xong (mở sẵn kết nối tới AWS, có kết quả
+# probe đầu tiên, gọi thử trang chủ và các API trong process; nếu trang chủ hoặc API nội bộ lỗi
+# thì pod không bao giờ ready). Khi nhận SIGTERM: /ready = 503,
+# vẫn phục vụ thêm LIFECYCLE_DRAIN_DELAY giây rồi chờ request /api/* đang chạy (LIFECYCLE_DRAIN_TIMEOUT)
+LIFECYCLE = Lifecycle.from_env()
+
+
+async def warm_aws():
+    await app.state.aws.warm(env_int("AWS_WARM_CONNECTIONS", 2), AWS_URL)
+    if not app.state.aws_prober.samples:
+        await app.state.aws_prober.probe_once()
+    return app.state.aws_prober.snapshot()["ok"]
+
+
+LIFECYCLE.add_step("aws", warm_aws)
+LIFECYCLE.add_self_request(app, "/", engine=POLICY, required=True)
+LIFECYCLE.add_self_request(app, "/api/sinhvien", ("sinhvien",), engine=POLICY, required=True)
+LIFECYCLE.add_self_request(app, "/api/giangvien", ("giangvien",), engine=POLICY, required=True)
+LIFECYCLE.add_self_request(app, "/api/aws", ("sinhvien",), engine=POLICY)
+app.add_middleware(LifecycleMiddleware, lifecycle=LIFECYCLE)
+
+# Nén gzip/br/zstd theo Accept-Encoding cho HTML/JSON từ COMPRESS_MIN_SIZE byte trở lên;
+# bản nén được cache theo digest của body (LRU, giới hạn COMPRESS_CACHE_ENTRIES / COMPRESS_CACHE_BYTES);
+# trang chủ theo từng user (Cache-Control: private) không cache nguyên body: phần tĩnh của template được
+# nén sẵn một lần cho mỗi encoding (gzip/zstd), mỗi request chỉ nén các trường user rồi ghép lại
+COMPRESSOR = Compressor.from_env()
+app.add_middleware(CompressionMiddleware, compressor=COMPRESSOR)
+
+# Metrics thêm sau cùng để bọc ngoài cùng, đếm cả request bị policy từ chối
+METRICS = MetricsRegistry()
+app.add_middleware(MetricsMiddleware, registry=METRICS)
+
+# Phần tĩnh của trang chủ được compile một lần khi khởi động;
+# mỗi request chỉ escape + ghép các trường {{...}} của user.
+HOME_TEMPLATE = Template("""
     <!DOCTYPE html>
     <html lang="vi">
     <head>
@@ -33,17 +112,17 @@ def home(request: Request):
         <link href="https://cdn.jsdelivr.net/npm/bulma@0.9.4/css/bulma.min.css" rel="stylesheet">
         <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css">
         <style>
-            body {{ background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); min-height: 100vh; }}
-            .hero {{ background: transparent; }}
-            .box {{ border-radius: 15px; box-shadow: 0 10px 30px rgba(0,0,0,0.2); }}
-            .card {{ border-radius: 15px; transition: transform 0.3s; }}
-            .card:hover {{ transform: translateY(-5px); }}
-            .tag {{ font-size: 1rem; }}
-            .user-info {{ background: linear-gradient(135deg, #f093fb 0%, #f5576c 100%); color: white; border-radius: 10px; padding: 20px; }}
-            .api-card {{ cursor: pointer; }}
-            .result-box {{ background: #1a1a2e; color: #0f0; font-family: monospace; border-radius: 10px; padding: 15px; min-height: 100px; }}
-            .denied {{ color: #ff4757; }}
-            .allowed {{ color: #2ed573; }}
+            body { background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); min-height: 100vh; }
+            .hero { background: transparent; }
+            .box { border-radius: 15px; box-shadow: 0 10px 30px rgba(0,0,0,0.2); }
+            .card { border-radius: 15px; transition: transform 0.3s; }
+            .card:hover { transform: translateY(-5px); }
+            .tag { font-size: 1rem; }
+            .user-info { background: linear-gradient(135deg, #f093fb 0%, #f5576c 100%); color: white; border-radius: 10px; padding: 20px; }
+            .api-card { cursor: pointer; }
+            .result-box { background: #1a1a2e; color: #0f0; font-family: monospace; border-radius: 10px; padding: 15px; min-height: 100px; }
+            .denied { color: #ff4757; }
+            .allowed { color: #2ed573; }
         </style>
     </head>
     <body>
@@ -67,13 +146,13 @@ def home(request: Request):
                                     <div class="column">
                                         <p class="is-size-5">
                                             <i class="fas fa-user-circle fa-2x"></i>
-                                            <strong style="margin-left: 10px;">Xin chào, {username or 'Khách'}!</strong>
+                                            <strong style="margin-left: 10px;">Xin chào, {{username}}!</strong>
                                         </p>
-                                        <p><i class="fas fa-envelope"></i> Email: {email or 'N/A'}</p>
+                                        <p><i class="fas fa-envelope"></i> Email: {{email}}</p>
                                     </div>
                                     <div class="column has-text-right">
-                                        <span class="tag is-large" style="background: {role_color}; color: white;">
-                                            {role_display}
+                                        <span class="tag is-large" style="background: {{role_color}}; color: white;">
+                                            {{role_display}}
                                         </span>
                                     </div>
                                 </div>
@@ -152,43 +231,92 @@ def home(request: Request):
         </section>
         
         <script>
-            async function callApi(endpoint, resultId) {{
+            // Cả 3 ô được lấy bằng 1 request /api/batch (NDJSON): ô nào xong trước hiện trước
+            const CARDS = { '/api/sinhvien': 'result1', '/api/giangvien': 'result2', '/api/aws': 'result3' };
+
+            function showResult(resultId, status, data) {
                 const resultBox = document.getElementById(resultId);
-                resultBox.innerHTML = '<i class="fas fa-spinner fa-spin"></i> Đang gọi API...';
-                
-                try {{
-                    const response = await fetch(endpoint);
-                    const data = await response.json();
-                    
-                    if (response.status === 403) {{
-                        resultBox.innerHTML = '<span class="denied"><i class="fas fa-ban"></i> 403 FORBIDDEN - ' + data.error + '</span>';
-                    }} else {{
-                        resultBox.innerHTML = '<span class="allowed"><i class="fas fa-check-circle"></i> ' + JSON.stringify(data, null, 2) + '</span>';
-                    }}
-                }} catch (err) {{
-                    resultBox.innerHTML = '<span class="denied"><i class="fas fa-exclamation-triangle"></i> Error: ' + err.message + '</span>';
-                }}
-            }}
+                if (status === 403) {
+                    resultBox.innerHTML = '<span class="denied"><i class="fas fa-ban"></i> 403 FORBIDDEN - ' + data.error + '</span>';
+                } else if (status >= 400) {
+                    resultBox.innerHTML = '<span class="denied"><i class="fas fa-exclamation-triangle"></i> ' + status + ' - ' + (data && data.error) + '</span>';
+                } else {
+                    resultBox.innerHTML = '<span class="allowed"><i class="fas fa-check-circle"></i> ' + JSON.stringify(data, null, 2) + '</span>';
+                }
+            }
+
+            async function loadBatch(endpoints) {
+                for (const endpoint of endpoints) {
+                    document.getElementById(CARDS[endpoint]).innerHTML = '<i class="fas fa-spinner fa-spin"></i> Đang gọi API...';
+                }
+                try {
+                    const response = await fetch('/api/batch?stream=1&items=' + endpoints.map(encodeURIComponent).join(','));
+                    if (!response.ok) {
+                        const data = await response.json();
+                        endpoints.forEach(endpoint => showResult(CARDS[endpoint], response.status, data));
+                        return;
+                    }
+                    const reader = response.body.getReader();
+                    const decoder = new TextDecoder();
+                    let buffered = '';
+                    for (;;) {
+                        const chunk = await reader.read();
+                        if (chunk.done) break;
+                        buffered += decoder.decode(chunk.value, { stream: true });
+                        const lines = buffered.split('\\n');
+                        buffered = lines.pop();
+                        for (const line of lines.filter(Boolean)) {
+                            const item = JSON.parse(line);
+                            if (item.path in CARDS) showResult(CARDS[item.path], item.status, item.body);
+                        }
+                    }
+                } catch (err) {
+                    for (const endpoint of endpoints) {
+                        document.getElementById(CARDS[endpoint]).innerHTML = '<span class="denied"><i class="fas fa-exclamation-triangle"></i> Error: ' + err.message + '</span>';
+                    }
+                }
+            }
+
+            function callApi(endpoint, resultId) {
+                loadBatch([endpoint]);
+            }
+
+            document.addEventListener('DOMContentLoaded', () => loadBatch(Object.keys(CARDS)));
         </script>
     </body>
     </html>
-    """
-    return HTMLResponse(content=html_content)
+    """)
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# TRANG CHỦ - Giao diện web đẹp để demo cho thầy
+# ═══════════════════════════════════════════════════════════════════════════
+@app.get("/", response_class=HTMLResponse)
+async def home(request: Request, identity: Identity = Depends(get_identity)):
+    # Xác định role từ groups header (so khớp chính xác tên role)
+    is_giangvien = identity.has_role("giangvien")
+    is_sinhvien = identity.has_role("sinhvien")
+    role_display = "Giảng viên 👨‍🏫" if is_giangvien else ("Sinh viên 👨‍🎓" if is_sinhvien else "Khách")
+    role_color = "#28a745" if is_giangvien else ("#007bff" if is_sinhvien else "#6c757d")
+    
+    return render_html(request, HOME_TEMPLATE, {
+        "username": identity.user or "Khách",
+        "email": identity.email or "N/A",
+        "role_color": role_color,
+        "role_display": role_display,
+    })
 
 
 # ═══════════════════════════════════════════════════════════════════════════
 # API SINH VIÊN - PUBLIC (Ai cũng vào được nếu đã đăng nhập)
 # ═══════════════════════════════════════════════════════════════════════════
 @app.get("/api/sinhvien")
-def api_sinhvien(request: Request):
-    headers = dict(request.headers)
-    username = headers.get("x-forwarded-preferred-username") or headers.get("x-forwarded-user")
-    email = headers.get("x-forwarded-email")
+async def api_sinhvien(identity: Identity = Depends(get_identity)):
     return {
         "status": "success",
         "message": "Xin chào SINH VIÊN - Đây là dữ liệu PUBLIC",
-        "user": username,
-        "email": email,
+        "user": identity.user,
+        "email": identity.email,
         "access_level": "public"
     }
 
@@ -198,39 +326,27 @@ def api_sinhvien(request: Request):
 # Đây là phần quan trọng để demo Zero Trust RBAC
 # ═══════════════════════════════════════════════════════════════════════════
 @app.get("/api/giangvien")
-def api_giangvien(request: Request):
-    # Lấy headers trực tiếp từ request
-    headers = dict(request.headers)
-    
-    # oauth2-proxy có thể dùng x-auth-request-* hoặc x-forwarded-*
-    username = headers.get("x-forwarded-preferred-username") or headers.get("x-auth-request-preferred-username") or headers.get("x-forwarded-user")
-    email = headers.get("x-forwarded-email") or headers.get("x-auth-request-email")
-    groups = headers.get("x-forwarded-groups") or headers.get("x-auth-request-groups")
-    
-    # Log để debug
-    print(f"[RBAC CHECK] User: {username}, Email: {email}, Groups: {groups}")
-    
-    # Kiểm tra role giangvien trong groups header
-    if groups:
-        # Groups có thể là dạng: "giangvien" hoặc "giangvien,sinhvien"
-        user_roles = [r.strip().lower() for r in groups.split(",")]
-        if "giangvien" in user_roles:
-            return {
-                "status": "success",
-                "message": "Xin chào GIẢNG VIÊN - Đây là dữ liệu MẬT",
-                "user": username,
-                "email": email,
-                "access_level": "protected",
-                "roles": user_roles
-            }
+async def api_giangvien(identity: Identity = Depends(get_identity)):
+    # Identity đã gộp x-forwarded-* / x-auth-request-* (oauth2-proxy dùng cả hai).
+    # Quyết định (kể cả 403 bên dưới) được PolicyMiddleware ghi vào audit log.
+
+    # Kiểm tra role giangvien - groups "giangvien" hoặc "giangvien,sinhvien"
+    if identity.has_role("giangvien"):
+        return {
+            "status": "success",
+            "message": "Xin chào GIẢNG VIÊN - Đây là dữ liệu MẬT",
+            "user": identity.user,
+            "email": identity.email,
+            "access_level": "protected",
+            "roles": sorted(identity.roles)
+        }
     
     # CHẶN TRUY CẬP - Không có role giangvien
-    import json
     debug_info = {
         "status": "denied",
         "error": "RBAC: Access Denied - Bạn không có quyền truy cập. Chỉ Giảng viên mới được phép!",
-        "debug_user": username,
-        "debug_groups": groups
+        "debug_user": identity.user,
+        "debug_groups": identity.groups
     }
     return Response(
         content=json.dumps(debug_info, ensure_ascii=False),
@@ -243,31 +359,75 @@ def api_giangvien(request: Request):
 # API AWS - Hybrid Cloud Demo (Gọi sang AWS/External Service)
 # ═══════════════════════════════════════════════════════════════════════════
 @app.get("/api/aws")
-def api_aws(
-    username: str = Header(None, alias="x-auth-request-preferred-username")
-):
-    try:
-        import requests
-        r = requests.get(AWS_URL, timeout=5)
+async def api_aws(request: Request, identity: Identity = Depends(get_identity)):
+    # Trả lời từ lịch sử probe - không gọi AWS trực tiếp trong request
+    probe = request.app.state.aws_prober.snapshot()
+    if probe["ok"]:
         return {
             "status": "success",
             "message": "Kết nối Hybrid Cloud thành công!",
             "aws_url": AWS_URL,
-            "aws_status_code": r.status_code,
-            "user": username
-        }
-    except Exception as e:
-        return {
-            "status": "error",
-            "message": f"Không thể kết nối tới AWS/External: {str(e)}",
-            "aws_url": AWS_URL,
-            "user": username
+            "aws_status_code": probe["last_status_code"],
+            "user": identity.user,
+            "probe": probe
         }
+    if probe["last_checked_age_s"] is None:
+        message = "Đang kiểm tra kết nối tới AWS/External..."
+    elif probe["breaker"]["state"] == "open":
+        message = f"Circuit breaker đang mở - AWS/External lỗi liên tiếp: {probe['last_error']}"
+    else:
+        message = f"Không thể kết nối tới AWS/External: {probe['last_error']}"
+    return {
+        "status": "error",
+        "message": message,
+        "aws_url": AWS_URL,
+        "user": identity.user,
+        "probe": probe
+    }
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# API BATCH - Trang chủ lấy cả 3 API trong 1 request (xác thực + RBAC 1 lần)
+# GET /api/batch?items=/api/sinhvien,/api/giangvien,/api/aws[&stream=1]
+# ═══════════════════════════════════════════════════════════════════════════
+@app.get("/api/batch")
+async def api_batch(request: Request):
+    return await handle_batch(request, POLICY, AUDIT)
 
 
 # ═══════════════════════════════════════════════════════════════════════════
 # HEALTH CHECK - Cho Kubernetes probe
 # ═══════════════════════════════════════════════════════════════════════════
 @app.get("/health")
-def health():
-    return {"status": "healthy"}
\ No newline at end of file
+async def health():
+    return {"status": "healthy"}
+
+
+# READINESS - 200 khi đã warmup, 503 khi đang khởi động hoặc đang drain (readinessProbe)
+@app.get("/ready")
+async def ready():
+    return LIFECYCLE.response()
+
+
+@app.get("/internal/stats")
+async def internal_stats(request: Request):
+    return {
+        "aws_pool": request.app.state.aws.stats(),
+        "aws_probe": request.app.state.aws_prober.snapshot(),
+        "identity_cache": identity_cache_info()._asdict(),
+        "policy": POLICY.stats(),
+        "audit": AUDIT.stats(),
+        "admission": RATES.stats(),
+        "auth": AUTH.stats() if AUTH is not None else None,
+        "tracing": TRACER.stats(),
+        "lifecycle": LIFECYCLE.stats(),
+        "compression": COMPRESSOR.stats()
+    }
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# METRICS - Prometheus scrape (latency theo route + upstream AWS)
+# ═══════════════════════════════════════════════════════════════════════════
+@app.get("/metrics")
+async def metrics():
+    return Response(METRICS.render(), media_type=METRICS_CONTENT_TYPE)
\ No newline at end of file
@@ -16,22 +16,35 @@ default allow := false
 
 # Role-based access control mapping
 # Maps roles to allowed API paths and methods
+# NOTE: role_permissions and public_endpoints must stay plain JSON literals -
+# the demo apps compile them into their in-process engine (zta_common/policy.py)
 role_permissions := {
     "giangvien": {
         "/api/giangvien": ["GET", "POST", "PUT", "DELETE"],
         "/api/sinhvien": ["GET"],
         "/api/grades": ["GET", "POST", "PUT"],
         "/api/courses": ["GET", "POST", "PUT", "DELETE"],
-        "/api/aws-status": ["GET"]
+        "/api/aws-status": ["GET"],
+        "/api/aws": ["GET"],
+        "/api/batch": ["GET"],
+        "/api/me": ["GET"],
+        "/api/tkb": ["GET"],
+        "/api/tkb/*": ["GET"]
     },
     "sinhvien": {
         "/api/sinhvien": ["GET"],
         "/api/my-grades": ["GET"],
         "/api/courses": ["GET"],
-        "/api/aws-status": ["GET"]
+        "/api/aws-status": ["GET"],
+        "/api/aws": ["GET"],
+        "/api/batch": ["GET"],
+        "/api/me": ["GET"],
+        "/api/tkb": ["GET"],
+        "/api/tkb/*": ["GET"]
     },
     "admin": {
-        "/api/*": ["GET", "POST", "PUT", "DELETE"]
+        "/api/*": ["GET", "POST", "PUT", "DELETE"],
+        "/internal/*": ["GET"]
     }
 }
 
@@ -40,6 +53,7 @@ public_endpoints := {
     "/": ["GET"],
     "/health": ["GET"],
     "/ready": ["GET"],
+    "/metrics": ["GET"],
     "/login": ["GET", "POST"],
     "/oauth2/callback": ["GET"],
     "/static/*": ["GET"]
@@ -74,12 +88,17 @@ allow if {
 }
 
 # Path matching with wildcard support
+# "/api/*" matches "/api" and everything below it, but not "/apifoo"
 path_match(requested_path, allowed_path) if {
     allowed_path == "/*"
 } else if {
     endswith(allowed_path, "/*")
     prefix := trim_suffix(allowed_path, "/*")
-    startswith(requested_path, prefix)
+    requested_path == prefix
+} else if {
+    endswith(allowed_path, "/*")
+    prefix := trim_suffix(allowed_path, "/*")
+    startswith(requested_path, concat("", [prefix, "/"]))
 } else if {
     requested_path == allowed_path
 }
@@ -169,3 +169,152 @@ test_aws_status_sinhvien if {
         }
     }
 }
+
+# Test: both roles can read their TKB schedule through the proxy
+test_tkb_proxy_sinhvien if {
+    allow with input as {
+        "user": {
+            "name": "sv1",
+            "roles": ["sinhvien"]
+        },
+        "request": {
+            "path": "/api/tkb/today",
+            "method": "GET"
+        }
+    }
+}
+
+# Test: unauthenticated user cannot read the TKB schedule
+test_tkb_proxy_unauthenticated_denied if {
+    not allow with input as {
+        "user": {
+            "name": null,
+            "roles": []
+        },
+        "request": {
+            "path": "/api/tkb",
+            "method": "GET"
+        }
+    }
+}
+
+# Test: wildcard only matches whole path segments
+test_wildcard_segment_aligned if {
+    not allow with input as {
+        "user": {
+            "name": null,
+            "roles": []
+        },
+        "request": {
+            "path": "/staticfoo",
+            "method": "GET"
+        }
+    }
+}
+
+# Test: wildcard matches the prefix itself
+test_wildcard_matches_prefix if {
+    allow with input as {
+        "user": {
+            "name": "admin",
+            "roles": ["admin"]
+        },
+        "request": {
+            "path": "/api",
+            "method": "GET"
+        }
+    }
+}
+
+# Test: Prometheus can scrape /metrics without a session, but not write to it
+test_metrics_public_get if {
+    allow with input as {
+        "user": {
+            "name": null,
+            "roles": []
+        },
+        "request": {
+            "path": "/metrics",
+            "method": "GET"
+        }
+    }
+}
+
+test_metrics_post_denied if {
+    not allow with input as {
+        "user": {
+            "name": null,
+            "roles": []
+        },
+        "request": {
+            "path": "/metrics",
+            "method": "POST"
+        }
+    }
+}
+
+test_batch_sinhvien_get if {
+    allow with input as {
+        "user": {
+            "name": "sv001",
+            "roles": ["sinhvien"]
+        },
+        "request": {
+            "path": "/api/batch",
+            "method": "GET"
+        }
+    }
+}
+
+test_batch_anonymous_denied if {
+    not allow with input as {
+        "user": {
+            "name": null,
+            "roles": []
+        },
+        "request": {
+            "path": "/api/batch",
+            "method": "GET"
+        }
+    }
+}
+
+# Test: runtime counters (/internal/*) are for admins only
+test_internal_stats_anonymous_denied if {
+    not allow with input as {
+        "user": {
+            "name": null,
+            "roles": []
+        },
+        "request": {
+            "path": "/internal/stats",
+            "method": "GET"
+        }
+    }
+}
+
+test_internal_stats_sinhvien_denied if {
+    not allow with input as {
+        "user": {
+            "name": "sv001",
+            "roles": ["sinhvien"]
+        },
+        "request": {
+            "path": "/internal/stats",
+            "method": "GET"
+        }
+    }
+}
+
+test_internal_stats_admin_get if {
+    allow with input as {
+        "user": {
+            "name": "admin",
+            "roles": ["admin"]
+        },
+        "request": {
+            "path": "/internal/stats",
+            "method": "GET"
+        }
+    }
+}
@@ -16,19 +16,21 @@ NC='\033[0m'
 IMAGE_NAME="haothandong/zta-demo"
 IMAGE_TAG="4.0"
 FULL_IMAGE="${IMAGE_NAME}:${IMAGE_TAG}"
-APP_DIR="/home/deployer/ZTAproject/projectfinal/k8s/app"
+PROJECT_DIR="/home/deployer/ZTAproject/projectfinal"
+# Build context là projectfinal/ để copy được package dùng chung apps/zta_common
+DOCKERFILE="k8s/app/Dockerfile"
 
 echo -e "${BLUE}========================================${NC}"
 echo -e "${BLUE}   BUILD & PUSH DOCKER IMAGE           ${NC}"
 echo -e "${BLUE}========================================${NC}"
 
-# Navigate to app directory
-cd $APP_DIR
+# Navigate to project directory
+cd $PROJECT_DIR
 echo -e "\n${YELLOW}📂 Working directory: $(pwd)${NC}"
 
 # Build image
 echo -e "\n${YELLOW}[1/2] Building Docker image: ${FULL_IMAGE}${NC}"
-docker build -t $FULL_IMAGE .
+docker build -f $DOCKERFILE -t $FULL_IMAGE .
 
 echo -e "${GREEN}✓ Build thành công!${NC}"
 
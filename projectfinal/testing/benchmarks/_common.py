@@ -0,0 +1,153 @@
+"""Helpers shared by the benchmark scripts."""
+
+import contextlib
+import importlib.util
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import httpx
+
+PROJECT_DIR = Path(__file__).resolve().parents[2]
+APPS_DIR = PROJECT_DIR / "apps"
+APP_PATHS = {
+    "k8s-app": PROJECT_DIR / "k8s" / "app" / "main.py",
+    "demo-app-v5": APPS_DIR / "demo-app-v5" / "main.py",
+}
+
+BENCH_DIR = Path(__file__).resolve().parent
+
+# /internal/* is admin-only in authz.rego; headers-mode identity of the bench operator.
+ADMIN_HEADERS = {"x-forwarded-user": "bench-admin", "x-forwarded-groups": "admin"}
+
+if str(APPS_DIR) not in sys.path:
+    sys.path.insert(0, str(APPS_DIR))
+
+
+def load_app(name: str):
+    """Import one app's ``main.py`` under a unique module name and return the module."""
+    path = APP_PATHS[name]
+    module_name = "bench_" + name.replace("-", "_")
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentiles(samples: list[float]) -> dict:
+    """p50/p95/p99 (milliseconds) of latency samples given in seconds."""
+    if not samples:
+        return {"n": 0}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 3)
+
+    return {
+        "n": len(ordered),
+        "mean": round(statistics.fmean(ordered) * 1000, 3),
+        "p50": pick(0.50),
+        "p95": pick(0.95),
+        "p99": pick(0.99),
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_http(url: str, timeout: float = 20.0) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if httpx.get(url, timeout=1.0).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"{url} did not come up within {timeout}s")
+        time.sleep(0.1)
+
+
+def wait_ready(base_url: str, timeout: float = 30.0) -> None:
+    """Wait until ``/ready`` answers 200, i.e. the app's warmup is over."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            response = httpx.get(base_url + "/ready", timeout=1.0)
+            if response.status_code == 200:
+                return
+        except httpx.HTTPError:
+            response = None
+        if time.monotonic() > deadline:
+            detail = response.text if response is not None else "no answer"
+            raise RuntimeError(f"{base_url} not ready within {timeout}s: {detail}")
+        time.sleep(0.05)
+
+
+@contextlib.contextmanager
+def spawn_stub(kind: str, *args: str):
+    """Run ``stubs.py <kind> <args>`` in its own process; yields the upstream URL."""
+    proc = subprocess.Popen([sys.executable, str(BENCH_DIR / "stubs.py"), kind, *args],
+                            stdout=subprocess.PIPE, text=True)
+    try:
+        yield proc.stdout.readline().strip()
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def launch_app(name: str, env: dict | None = None, port: int | None = None, extra_args: tuple = (),
+               launcher: bool = False, **popen) -> tuple[str, subprocess.Popen]:
+    """Start one app under uvicorn (or ``zta_common.launcher``, as in the images) in a subprocess
+    without waiting for it; returns ``(base_url, Popen)``."""
+    port = port or free_port()
+    path = APP_PATHS[name]
+    # No drain delay on teardown unless a benchmark asks for one: nothing routes around these instances.
+    child_env = {"LIFECYCLE_DRAIN_DELAY": "0", **os.environ, **(env or {}), "PYTHONPATH": str(APPS_DIR)}
+    server = "zta_common.launcher" if launcher else "uvicorn"
+    proc = subprocess.Popen(
+        [sys.executable, "-m", server, "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning", *extra_args],
+        cwd=path.parent, env=child_env, **popen,
+    )
+    return f"http://127.0.0.1:{port}", proc
+
+
+@contextlib.contextmanager
+def spawn_app(name: str, env: dict | None = None, port: int | None = None, extra_args: tuple = (),
+              launcher: bool = False):
+    """Run one app in a subprocess (see ``launch_app``); yields ``(base_url, Popen)`` once /health answers."""
+    base_url, proc = launch_app(name, env, port, extra_args, launcher)
+    try:
+        wait_http(base_url + "/health")
+        yield base_url, proc
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def peak_rss_kb(pid: int) -> int:
+    """High-water resident set size of a process (Linux /proc)."""
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    return 0
+
+
+def cpu_seconds(pid: int) -> float:
+    """User + system CPU time a process has used so far (Linux /proc)."""
+    with open(f"/proc/{pid}/stat") as stat:
+        # Fields after the parenthesised command name; utime and stime are the 12th and 13th of them.
+        fields = stat.read().rpartition(")")[2].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""Overload test for admission control: latency of admitted requests, shedding, noisy users.
+
+    python testing/benchmarks/bench_admission.py --duration 8 --concurrency 32
+
+1. overload: demo-app-v5 proxies /api/tkb (stream mode, so nothing is
+   cached) to a stand-in that serves only ``--capacity`` requests at once,
+   a degraded WireGuard link. ``--concurrency`` users hammer it, first with
+   admission control off (TKB_MAX_CONCURRENCY=0), then on. With it on,
+   admitted requests must keep a bounded p99 while the excess is shed fast
+   with 503 + Retry-After.
+2. noisy user: one user floods /api/me from many connections while
+   ``--users`` others make a request every 200 ms. The flooder must get 429s
+   and nobody else may.
+
+Shed clients wait ``min(Retry-After, --backoff)`` before their next request.
+The defaults keep the stand-in, not the CPU, as the bottleneck: on a single
+core a closed loop of many fast requests queues in the client and the app's
+accept loop and hides what admission control does.
+"""
+
+import argparse
+import asyncio
+import sys
+import time
+from collections import Counter
+
+import httpx
+
+from _common import ADMIN_HEADERS, peak_rss_kb, percentiles, spawn_app, spawn_stub
+
+
+def headers_for(user: str) -> dict:
+    return {"x-forwarded-user": user, "x-forwarded-preferred-username": user, "x-forwarded-groups": "sinhvien"}
+
+
+async def hammer(client: httpx.AsyncClient, path: str, users: list[str], duration: float, backoff: float,
+                 interval: float = 0.0) -> tuple[dict[int, list[float]], Counter]:
+    latencies: dict[int, list[float]] = {}
+    statuses: Counter = Counter()
+    deadline = time.perf_counter() + duration
+
+    async def worker(user: str):
+        headers = headers_for(user)
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                response = await client.get(path, headers=headers)
+                status = response.status_code
+            except httpx.HTTPError:
+                status = 0
+            latencies.setdefault(status, []).append(time.perf_counter() - started)
+            statuses[status] += 1
+            if status in (429, 503):
+                await asyncio.sleep(min(float(response.headers.get("retry-after", 1)), backoff))
+            elif interval:
+                await asyncio.sleep(interval)
+
+    await asyncio.gather(*(worker(user) for user in users))
+    return latencies, statuses
+
+
+async def overload(base_url: str, args) -> dict:
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        users = [f"sv{i:03d}" for i in range(args.concurrency)]
+        latencies, statuses = await hammer(client, "/api/tkb", users, args.duration, args.backoff)
+        stats = (await client.get("/internal/stats", headers=ADMIN_HEADERS)).json()["admission"]["tkb"]
+    return {"latencies": latencies, "statuses": statuses, "limiter": stats}
+
+
+async def noisy(base_url: str, args) -> tuple[Counter, Counter]:
+    async with httpx.AsyncClient(base_url=base_url, timeout=30) as client:
+        flood = hammer(client, "/api/me", ["noisy"] * args.flood_connections, args.duration, args.backoff)
+        polite = hammer(client, "/api/me", [f"sv{i:03d}" for i in range(args.users)], args.duration,
+                        args.backoff, interval=0.2)
+        (_, flood_statuses), (_, polite_statuses) = await asyncio.gather(flood, polite)
+    return flood_statuses, polite_statuses
+
+
+def run_overload(tkb_url: str, args, controlled: bool) -> dict:
+    env = {
+        "TKB_SERVICE_URL": tkb_url, "TKB_PROXY_MODE": "stream", "TKB_HEDGE": "false", "AUDIT_FILE": "/dev/null",
+        "ADMISSION_RATE_SINHVIEN": "0",  # only the upstream cap is under test here
+        "TKB_MAX_CONCURRENCY": str(args.max_concurrency if controlled else 0),
+        "TKB_QUEUE_SIZE": str(args.queue_size),
+        "TKB_QUEUE_TIMEOUT": str(args.queue_timeout),
+    }
+    with spawn_app("demo-app-v5", env=env) as (base_url, proc):
+        result = asyncio.run(overload(base_url, args))
+        result["rss_kb"] = peak_rss_kb(proc.pid)
+    return result
+
+
+def main(args) -> int:
+    ok = True
+    upstream = ["--latency", str(args.latency), "--capacity", str(args.capacity)]
+    print(f"overload: {args.concurrency} users on /api/tkb for {args.duration}s; upstream {args.latency * 1000:.0f} ms, "
+          f"{args.capacity} at a time; cap {args.max_concurrency}, queue {args.queue_size}, "
+          f"wait {args.queue_timeout}s")
+    print(f"  {'':22} {'ok/s':>7} {'ok p50':>8} {'ok p95':>8} {'ok p99':>8} {'shed p99':>9} {'RSS MB':>7}  status")
+    p99 = {}
+    for controlled in (False, True):
+        with spawn_stub("tkb", *upstream) as tkb_url:
+            result = run_overload(tkb_url, args, controlled)
+        admitted = percentiles(result["latencies"].get(200, []))
+        shed = percentiles(result["latencies"].get(503, []))
+        p99[controlled] = admitted.get("p99", float("inf"))
+        label = "admission control on" if controlled else "admission control off"
+        status = " ".join(f"{k}:{v}" for k, v in sorted(result["statuses"].items()))
+        shed_p99 = f"{shed['p99']:9.2f}" if shed["n"] else f"{'-':>9}"
+        print(f"  {label:22} {admitted['n'] / args.duration:7.1f} {admitted.get('p50', 0):8.2f} "
+              f"{admitted.get('p95', 0):8.2f} {admitted.get('p99', 0):8.2f} {shed_p99} "
+              f"{result['rss_kb'] / 1024:7.1f}  {status}")
+        if controlled:
+            limiter = result["limiter"]
+            print(f"  limiter: admitted={limiter['admitted']} queued={limiter['queued']} "
+                  f"shed_queue_full={limiter['shed_queue_full']} shed_timeout={limiter['shed_timeout']} "
+                  f"max_queued={limiter['max_queued']}")
+            # Admitted requests wait at most queue_timeout for a slot, then one upstream call.
+            bound = (args.queue_timeout + args.latency) * 1000 * 1.5
+            if p99[True] > bound:
+                print(f"FAIL: admitted p99 {p99[True]} ms above {bound:.0f} ms")
+                ok = False
+    if p99[True] >= p99[False]:
+        print("FAIL: admission control did not improve admitted p99")
+        ok = False
+
+    with spawn_app("demo-app-v5", env={"AUDIT_FILE": "/dev/null"}) as (base_url, _):
+        flood, polite = asyncio.run(noisy(base_url, args))
+    print(f"\nnoisy user: {args.flood_connections} connections flooding /api/me, {args.users} users at 5 req/s")
+    print(f"  noisy user:  {dict(flood)}")
+    print(f"  other users: {dict(polite)}")
+    if not flood.get(429) or polite.get(429):
+        print("FAIL: the flood was not limited, or other users were")
+        ok = False
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--capacity", type=int, default=2, help="requests the stand-in serves at once")
+    parser.add_argument("--max-concurrency", type=int, default=2, help="TKB_MAX_CONCURRENCY when on")
+    parser.add_argument("--queue-size", type=int, default=4)
+    parser.add_argument("--queue-timeout", type=float, default=0.4)
+    parser.add_argument("--backoff", type=float, default=1.0, help="cap on honouring Retry-After (s)")
+    parser.add_argument("--flood-connections", type=int, default=16)
+    parser.add_argument("--users", type=int, default=10)
+    sys.exit(main(parser.parse_args()))
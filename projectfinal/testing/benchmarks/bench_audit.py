@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""Request-path cost of audit logging: print() per request vs the batched AuditLog.
+
+    python testing/benchmarks/bench_audit.py --write-delay-ms 2
+
+stdout is replaced by a sink whose every write() takes ``--write-delay-ms``
+(a slow pipe or a node whose log agent is behind). ``--concurrency``
+requests run at a time, each recording one decision; the print() variant
+writes synchronously on the event loop like the old ``[RBAC CHECK]`` line.
+For every AuditLog backpressure policy it reports per-request latency,
+throughput and how many records were written or dropped.
+"""
+
+import argparse
+import asyncio
+import sys
+import time
+
+from _common import percentiles
+from zta_common.audit import POLICIES, AuditLog
+
+ROLES = frozenset({"giangvien"})
+
+
+class SlowSink:
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.lines = 0
+
+    def write(self, data: str) -> int:
+        time.sleep(self.delay)  # blocking, like a full pipe
+        self.lines += data.count("\n")
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+
+async def run_requests(n: int, concurrency: int, record) -> tuple[list[float], float]:
+    latencies: list[float] = []
+    queue = iter(range(n))
+
+    async def worker():
+        for i in queue:
+            started = time.perf_counter()
+            await record(i)
+            await asyncio.sleep(0)  # the rest of the handler
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, time.perf_counter() - started
+
+
+async def bench_print(args) -> dict:
+    sink = SlowSink(args.write_delay_ms / 1000)
+
+    async def record(i):
+        print(f"[RBAC CHECK] User: user{i}, Email: None, Groups: giangvien", file=sink, flush=True)
+
+    latencies, elapsed = await run_requests(args.requests, args.concurrency, record)
+    return {"latency": percentiles(latencies), "rps": len(latencies) / elapsed, "written": sink.lines, "dropped": 0}
+
+
+async def bench_audit(args, policy: str) -> dict:
+    sink = SlowSink(args.write_delay_ms / 1000)
+    audit = AuditLog(sink, max_queue=args.queue, batch_size=args.batch, flush_interval=0.05, policy=policy)
+    audit.start()
+
+    async def record(i):
+        await audit.submit(True, f"user{i}", ROLES, "/api/giangvien", "GET", 200, 0.001, None)
+
+    latencies, elapsed = await run_requests(args.requests, args.concurrency, record)
+    await audit.stop(timeout=60)
+    stats = audit.stats()
+    return {"latency": percentiles(latencies), "rps": len(latencies) / elapsed,
+            "written": stats["written"], "dropped": stats["dropped_total"]}
+
+
+async def main(args) -> int:
+    results = {"print() per request": await bench_print(args)}
+    for policy in POLICIES:
+        results[f"AuditLog {policy}"] = await bench_audit(args, policy)
+    print(f"{args.requests} requests, concurrency {args.concurrency}, "
+          f"{args.write_delay_ms} ms per write, queue {args.queue}, batch {args.batch}")
+    print(f"{'variant':24} {'req/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'written':>8} {'dropped':>8}")
+    for name, r in results.items():
+        lat = r["latency"]
+        print(f"{name:24} {r['rps']:10,.0f} {lat['p50']:8.3f} {lat['p99']:8.3f} {r['written']:8} {r['dropped']:8}")
+    ok = all(r["written"] + r["dropped"] == args.requests for r in results.values())
+    if not ok:
+        print("records were lost without being counted")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--write-delay-ms", type=float, default=2.0)
+    parser.add_argument("--queue", type=int, default=1000)
+    parser.add_argument("--batch", type=int, default=256)
+    sys.exit(asyncio.run(main(parser.parse_args())))
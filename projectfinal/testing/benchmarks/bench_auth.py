@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""Local JWT verification against a stand-in Keycloak JWKS: checks, then verifications/s cold vs warm.
+
+    python testing/benchmarks/bench_auth.py --tokens 2000
+
+Two RSA keypairs are generated locally; the stand-in JWKS serves the first
+one (plus an ``enc`` key that must be ignored, like Keycloak's). The checks
+cover valid, expired, wrong-issuer, tampered, ``alg`` confusion and
+unknown-``kid`` tokens, key rotation (many concurrent tokens with the new
+``kid`` must cause exactly one JWKS fetch) and expiry of cached
+verifications. The benchmark then verifies ``--tokens`` distinct tokens
+once (cold: every one is a signature check) and again (warm: LRU hits).
+
+Needs PyJWT with the crypto extra (``pip install 'pyjwt[crypto]'``).
+"""
+
+import argparse
+import asyncio
+import sys
+import time
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jwt.algorithms import RSAAlgorithm
+
+from _common import percentiles
+from stubs import JwksStub, serve_in_thread
+from zta_common.auth import AuthError, JWKSCache, TokenVerifier
+from zta_common.upstream import UpstreamPool
+
+ISSUER = "http://keycloak.local/realms/zta"
+JWKS_PATH = "/realms/zta/protocol/openid-connect/certs"
+
+
+class Clock:
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def keypair(kid: str):
+    private = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    jwk = {**RSAAlgorithm.to_jwk(private.public_key(), as_dict=True), "kid": kid, "alg": "RS256", "use": "sig"}
+    return private, jwk
+
+
+def token(private, kid: str, *, user="sv001", roles=("sinhvien",), issuer=ISSUER, ttl=300.0,
+          now: float | None = None, alg="RS256") -> str:
+    now = time.time() if now is None else now
+    claims = {"iss": issuer, "sub": f"id-{user}", "preferred_username": user, "email": f"{user}@zta.local",
+              "realm_access": {"roles": [*roles, "default-roles-zta"]}, "iat": int(now), "exp": int(now + ttl)}
+    return jwt.encode(claims, private, algorithm=alg, headers={"kid": kid})
+
+
+def make_verifier(url: str, **kwargs) -> TokenVerifier:
+    jwks = JWKSCache(UpstreamPool("keycloak-jwks", url), JWKS_PATH, ttl=300.0, min_refresh_interval=0.5)
+    return TokenVerifier(jwks, ISSUER, **kwargs)
+
+
+async def rejected(verifier: TokenVerifier, value: str) -> str | None:
+    try:
+        await verifier.verify(value)
+    except AuthError as e:
+        return str(e)
+    return None
+
+
+async def checks(stub: JwksStub, key1, key2, jwk2) -> dict[str, bool]:
+    clock = Clock()
+    verifier = make_verifier(stub.url, clock=clock)
+    await verifier.start()
+    results = {}
+    try:
+        fetches = stub.requests
+        identity = await verifier.verify(token(key1, "k1"))
+        results["valid token"] = identity.user == "sv001" and identity.has_role("sinhvien")
+        await verifier.verify(token(key1, "k1"))
+        results["JWKS fetched once"] = stub.requests == fetches
+        results["expired token"] = await rejected(verifier, token(key1, "k1", ttl=-120)) == "Token expired"
+        results["wrong issuer"] = bool(await rejected(verifier, token(key1, "k1", issuer="http://evil/realms/zta")))
+        header, payload, signature = token(key1, "k1", user="gv001", roles=("giangvien",)).split(".")
+        forged = token(key1, "k1", user="sv002").split(".")[1]
+        results["tampered payload"] = bool(await rejected(verifier, f"{header}.{forged}.{signature}"))
+        secret = jwt.encode({"iss": ISSUER, "exp": int(time.time()) + 60}, "s" * 32, algorithm="HS256",
+                            headers={"kid": "k1"})
+        results["alg confusion (HS256)"] = await rejected(verifier, secret) == "Token algorithm not allowed"
+        results["malformed token"] = await rejected(verifier, "not-a-jwt") == "Malformed token"
+
+        # Rotation: Keycloak starts signing with k2; concurrent first requests share one refresh.
+        stub.keys = [*stub.keys, jwk2]
+        await asyncio.sleep(0.6)  # past min_refresh_interval since the priming fetch
+        fetches = stub.requests
+        rotated = [token(key2, "k2", user=f"sv{i:03d}") for i in range(50)]
+        identities = await asyncio.gather(*(verifier.verify(t) for t in rotated))
+        results["rotation: one JWKS fetch for 50 tokens"] = (
+            stub.requests == fetches + 1 and all(i.has_role("sinhvien") for i in identities))
+
+        # Unknown kid right after a refresh is refused without another fetch.
+        stranger, _ = keypair("k3")
+        fetches = stub.requests
+        results["unknown kid throttled"] = (await rejected(verifier, token(stranger, "k3")) is not None
+                                            and stub.requests == fetches)
+
+        # Cached verifications end at exp: past it (on the verifier's clock) the token is checked again.
+        short = token(key1, "k1", user="sv999", ttl=60, now=clock.now)
+        await verifier.verify(short)
+        hits, misses = verifier.counters["hits"], verifier.counters["misses"]
+        await verifier.verify(short)
+        clock.now += 61
+        await verifier.verify(short)
+        results["cache hit, then re-verified at exp"] = (
+            verifier.counters["hits"] == hits + 1 and verifier.counters["misses"] == misses + 1
+            and verifier.counters["expired"] == 1)
+    finally:
+        await verifier.aclose()
+    return results
+
+
+async def throughput(stub: JwksStub, key1, n: int) -> dict:
+    verifier = make_verifier(stub.url, cache_size=n)
+    await verifier.start()
+    try:
+        tokens = [token(key1, "k1", user=f"u{i:05d}") for i in range(n)]
+        rates = {}
+        for phase in ("cold", "warm"):
+            samples = []
+            started = time.perf_counter()
+            for value in tokens:
+                t0 = time.perf_counter()
+                await verifier.verify(value)
+                samples.append(time.perf_counter() - t0)
+            rates[phase] = (n / (time.perf_counter() - started), percentiles(samples))
+        return {**rates, "stats": {k: v for k, v in verifier.stats().items() if k != "jwks"}}
+    finally:
+        await verifier.aclose()
+
+
+async def main(args) -> int:
+    key1, jwk1 = keypair("k1")
+    key2, jwk2 = keypair("k2")
+    enc = {**jwk1, "kid": "enc-1", "alg": "RSA-OAEP", "use": "enc"}
+    with serve_in_thread(JwksStub([jwk1, enc])) as stub:
+        results = await checks(stub, key1, key2, jwk2)
+        stub.keys = [jwk1, enc]
+        rates = await throughput(stub, key1, args.tokens)
+    for name, ok in results.items():
+        print(f"{'ok  ' if ok else 'FAIL'} {name}")
+    print(f"\n{args.tokens} distinct tokens, RS256/2048")
+    for phase, label in (("cold", "cold (signature check)"), ("warm", "warm (LRU hit)")):
+        rate, lat = rates[phase]
+        print(f"  {label:24} {rate:12,.0f} verifications/s   p50 {lat['p50']:.3f} ms  p99 {lat['p99']:.3f} ms")
+    print(f"  warm/cold: {rates['warm'][0] / rates['cold'][0]:.0f}x")
+    print(f"  {rates['stats']}")
+    return 0 if all(results.values()) else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tokens", type=int, default=2000)
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""Page-load cost of separate API fetches vs one /api/batch request.
+
+    python testing/benchmarks/bench_batch.py --app demo-app-v5 --gateway-ms 8
+
+A "page load" fetches ``--items`` the way a browser does: either one
+request per item, all in flight at once (the old home page), or a single
+``/api/batch`` request (JSON, and NDJSON where the time to the first item
+is recorded too). ``--gateway-ms`` is added client-side to every HTTP
+request to stand in for the Istio gateway + oauth2-proxy crossing each
+browser request pays in the cluster.
+
+The tkb stand-in stalls ``--tail-ratio`` of its requests for
+``--tail-latency``; a last pass uses ``?timeout=`` below that to check that
+a stalled item comes back as 504 while the rest of the batch is unaffected,
+and that NaN, infinite, zero, negative and non-numeric values get a 400.
+
+For demo-app-v5 a final check runs /api/batch against a stand-in that
+compresses like tkb-service (4 KB schedule, gzip/br): with the browser's
+``Accept-Encoding`` the /api/tkb item must decode to the same body as with
+identity, in both proxy modes.
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+import httpx
+
+from _common import percentiles, spawn_app, spawn_stub
+
+DEFAULT_ITEMS = {
+    "k8s-app": "/api/sinhvien,/api/giangvien,/api/aws",
+    "demo-app-v5": "/api/me,/api/sinhvien,/api/tkb",
+}
+HEADERS = {"x-forwarded-user": "sv001", "x-forwarded-preferred-username": "sv001",
+           "x-forwarded-groups": "sinhvien"}
+
+
+async def page_loads(client: httpx.AsyncClient, n: int, concurrency: int, load) -> tuple[dict, dict]:
+    totals: list[float] = []
+    firsts: list[float] = []
+    queue = iter(range(n))
+
+    async def worker():
+        for _ in queue:
+            started = time.perf_counter()
+            first = await load()
+            totals.append(time.perf_counter() - started)
+            if first is not None:
+                firsts.append(first - started)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return percentiles(totals), percentiles(firsts)
+
+
+def compressed_upstream() -> bool:
+    ok = True
+    print("compressed upstream: /api/tkb item by Accept-Encoding")
+    with spawn_stub("large", "--payload-kb", "4", "--compress") as tkb_url:
+        for mode in ("stream", "buffered"):
+            env = {"TKB_SERVICE_URL": tkb_url, "TKB_PROXY_MODE": mode, "AUDIT_FILE": "/dev/null"}
+            with spawn_app("demo-app-v5", env=env) as (base_url, _):
+                bodies = {}
+                for accept in ("identity", "gzip, deflate, br", "br"):
+                    for stream in ("0", "1"):
+                        response = httpx.get(base_url + "/api/batch", params={"items": "/api/tkb", "stream": stream},
+                                             headers={**HEADERS, "accept-encoding": accept}, timeout=30)
+                        item = json.loads(response.text.splitlines()[0]) if stream == "1" else response.json()["items"][0]
+                        bodies[accept, stream] = item["body"]
+                        print(f"  {mode:8} {accept:18} {'NDJSON' if stream == '1' else 'JSON':6} {item['status']}")
+                        if item["status"] != 200:
+                            print(f"FAIL: {mode} mode, Accept-Encoding {accept}: item status {item['status']}")
+                            ok = False
+                if len({json.dumps(body, sort_keys=True) for body in bodies.values()}) != 1:
+                    print(f"FAIL: {mode} mode: item bodies differ by Accept-Encoding")
+                    ok = False
+    return ok
+
+
+async def main(args) -> int:
+    items = args.items or DEFAULT_ITEMS[args.app]
+    paths = items.split(",")
+    gateway = args.gateway_ms / 1000
+    upstream = ["--latency", str(args.latency), "--tail-ratio", str(args.tail_ratio),
+                "--tail-latency", str(args.tail_latency)]
+    with spawn_stub("tkb", *upstream) as tkb_url, spawn_stub("plain", "--latency", str(args.latency)) as aws_url:
+        # Stream mode bypasses the TKB response cache, so every page load reaches the stand-in.
+        env = {"TKB_SERVICE_URL": tkb_url, "TKB_PROXY_MODE": args.tkb_mode, "TKB_HEDGE": "false",
+               "AWS_URL": aws_url + "/", "AUDIT_FILE": "/dev/null", "ADMISSION_RATE_SINHVIEN": "0"}
+        with spawn_app(args.app, env=env) as (base_url, _):
+            limits = httpx.Limits(max_connections=args.concurrency * len(paths))
+            async with httpx.AsyncClient(base_url=base_url, headers=HEADERS, limits=limits, timeout=30) as client:
+
+                async def get(path, **params):
+                    await asyncio.sleep(gateway)
+                    response = await client.get(path, params=params)
+                    return response
+
+                async def separate():
+                    await asyncio.gather(*(get(path) for path in paths))
+
+                async def batch_json():
+                    response = await get("/api/batch", items=items)
+                    assert all(item["status"] != 504 for item in response.json()["items"])
+
+                async def batch_ndjson():
+                    await asyncio.sleep(gateway)
+                    first = None
+                    async with client.stream("GET", "/api/batch", params={"items": items, "stream": "1"}) as response:
+                        async for _ in response.aiter_lines():
+                            first = first or time.perf_counter()
+                    return first
+
+                variants = {
+                    f"{len(paths)} separate requests": separate,
+                    "1 batch (JSON)": batch_json,
+                    "1 batch (NDJSON)": batch_ndjson,
+                }
+                results = {}
+                for name, load in variants.items():
+                    await page_loads(client, args.warmup, args.concurrency, load)
+                    results[name] = await page_loads(client, args.loads, args.concurrency, load)
+
+                # Per-item timeout: stalled tkb items must come back as 504, the others as before.
+                timeout = args.tail_latency / 2
+                statuses: dict[str, dict[int, int]] = {path: {} for path in paths}
+                for _ in range(args.timeout_checks):
+                    response = await client.get("/api/batch", params={"items": items, "timeout": timeout})
+                    for item in response.json()["items"]:
+                        counts = statuses[item["path"]]
+                        counts[item["status"]] = counts.get(item["status"], 0) + 1
+                accepted = [value for value in ("nan", "inf", "-inf", "-1", "0", "soon")
+                            if (await client.get("/api/batch", params={"items": items, "timeout": value})).status_code != 400]
+
+    print(f"{args.app}: {args.loads} page loads of {items}, concurrency {args.concurrency}, "
+          f"gateway {args.gateway_ms} ms, upstream {args.latency * 1000:.0f} ms "
+          f"({args.tail_ratio:.0%} stall {args.tail_latency * 1000:.0f} ms)")
+    print(f"  {'variant':24} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'first item p50':>15}")
+    for name, (total, first) in results.items():
+        first_p50 = f"{first['p50']:.2f}" if first["n"] else "-"
+        print(f"  {name:24} {total['p50']:8.2f} {total['p95']:8.2f} {total['p99']:8.2f} {first_p50:>15}")
+    print(f"  item statuses with ?timeout={timeout}: {json.dumps(statuses)}")
+    timed_out = sum(counts.get(504, 0) for counts in statuses.values())
+    others_ok = all(504 not in counts for path, counts in statuses.items() if not path.startswith("/api/tkb"))
+    if args.app == "demo-app-v5" and args.tail_ratio > 0 and not timed_out:
+        print("FAIL: no stalled item timed out")
+        return 1
+    if not others_ok:
+        print("FAIL: a timeout leaked into items that do not call tkb-service")
+        return 1
+    if accepted:
+        print(f"FAIL: ?timeout= values {accepted} were not rejected with 400")
+        return 1
+    if args.app == "demo-app-v5" and not compressed_upstream():
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--app", choices=sorted(DEFAULT_ITEMS), default="demo-app-v5")
+    parser.add_argument("--items", help="comma-separated item paths (default: the app's home page set)")
+    parser.add_argument("--loads", type=int, default=500)
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--gateway-ms", type=float, default=8.0)
+    parser.add_argument("--latency", type=float, default=0.015)
+    parser.add_argument("--tail-ratio", type=float, default=0.05)
+    parser.add_argument("--tail-latency", type=float, default=0.3)
+    parser.add_argument("--tkb-mode", choices=("buffered", "stream"), default="stream")
+    parser.add_argument("--timeout-checks", type=int, default=100)
+    sys.exit(asyncio.run(main(parser.parse_args())))
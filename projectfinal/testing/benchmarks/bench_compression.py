@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""Response compression: bytes on the wire and app CPU per request, both legs.
+
+    python testing/benchmarks/bench_compression.py --requests 1000 --payload-kb 16
+
+demo-app-v5 runs under uvicorn against a stand-in tkb-service (in a thread
+of this process, so its byte counter can be read) that compresses like
+tkb-service's ``compression()`` middleware.
+
+1. client leg: the home page and /api/tkb (json mode, cached schedule of
+   ``--payload-kb``) fetched with Accept-Encoding identity, gzip, br and
+   zstd. Reports body bytes per response, the app's CPU per request (from
+   /proc) and p50 latency; "no variant cache" repeats the compressed runs
+   with COMPRESS_CACHE_BYTES=0; "hits" counts variant-cache hits per row.
+   The home page is private to its user: its body never enters the cache,
+   but its template fragments do, so gzip and zstd views must hit the cache
+   and a run of extra users must not add entries. The schedule (one user
+   here) is cached whole.
+2. upstream leg (stream mode, every request crosses the tunnel): bytes the
+   stand-in sends per request, with and without compression, and whether
+   the body reached the client still compressed (passthrough) or had to be
+   decoded because the client does not accept that coding.
+
+Every decoded response is checked against the identity response. The
+stand-in's schedule repeats one row, so its ratios are optimistic; the home
+page is the realistic one.
+"""
+
+import argparse
+import asyncio
+import sys
+import time
+
+import httpx
+
+from _common import ADMIN_HEADERS, cpu_seconds, percentiles, spawn_app
+from stubs import LargeStub, serve_in_thread
+
+USER = {"x-forwarded-user": "sv001", "x-forwarded-preferred-username": "sv001", "x-forwarded-groups": "sinhvien"}
+ENCODINGS = ("identity", "gzip", "br", "zstd")
+
+
+def comparable(path: str, response: httpx.Response):
+    """Decoded body minus per-request fields (cache outcome)."""
+    if path == "/":
+        return response.text
+    data = response.json()
+    data.pop("_proxy", None)
+    return data
+
+
+async def load(base_url: str, pid: int, path: str, encoding: str, requests: int, concurrency: int) -> dict:
+    headers = {**USER, "accept-encoding": encoding}
+    wire = 0
+    latencies = []
+    async with httpx.AsyncClient(base_url=base_url, headers=headers, timeout=30) as client:
+        sample = await client.get(path)
+        queue = iter(range(requests))
+        cpu_before = cpu_seconds(pid)
+
+        async def worker():
+            nonlocal wire
+            for _ in queue:
+                started = time.perf_counter()
+                response = await client.get(path)
+                latencies.append(time.perf_counter() - started)
+                wire += response.num_bytes_downloaded
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        cpu = cpu_seconds(pid) - cpu_before
+    return {
+        "sample": sample,
+        "bytes": wire / requests,
+        "cpu_us": cpu / requests * 1e6,
+        "p50": percentiles(latencies)["p50"],
+        "encoding": sample.headers.get("content-encoding", "identity"),
+    }
+
+
+def compression_stats(base_url: str) -> dict:
+    # identity, so the stats body itself does not take a variant-cache entry
+    headers = {**ADMIN_HEADERS, "accept-encoding": "identity"}
+    return httpx.get(base_url + "/internal/stats", headers=headers).json()["compression"]
+
+
+def client_leg(stub: LargeStub, args) -> bool:
+    ok = True
+    print(f"client leg: {args.requests} requests per row, concurrency {args.concurrency}")
+    print(f"  {'path':10} {'accept':9} {'variant cache':14} {'bytes/resp':>10} {'ratio':>6} {'cpu µs/req':>10} "
+          f"{'p50 ms':>7} {'hits':>6}")
+    for cache in (True, False):
+        env = {"TKB_SERVICE_URL": stub.url, "AUDIT_FILE": "/dev/null", "ADMISSION_RATE_SINHVIEN": "0",
+               "TKB_HEDGE": "false"}
+        if not cache:
+            env["COMPRESS_CACHE_BYTES"] = "0"
+        with spawn_app("demo-app-v5", env=env) as (base_url, proc):
+            for path in ("/", "/api/tkb"):
+                baseline = None
+                for encoding in ENCODINGS if cache else ENCODINGS[1:]:
+                    hits = compression_stats(base_url)["cache_hits"]
+                    r = asyncio.run(load(base_url, proc.pid, path, encoding, args.requests, args.concurrency))
+                    hits = compression_stats(base_url)["cache_hits"] - hits
+                    if cache and path == "/" and encoding in ("gzip", "zstd") and not hits:
+                        print(f"FAIL: home page with {encoding} never hit the cached template fragments")
+                        ok = False
+                    if encoding == "identity":
+                        baseline = r
+                    elif baseline is not None and comparable(path, r["sample"]) != comparable(path, baseline["sample"]):
+                        print(f"FAIL: {path} with {encoding} does not decode to the identity body")
+                        ok = False
+                    if encoding != "identity" and r["encoding"] != encoding:
+                        print(f"FAIL: {path} asked for {encoding}, got {r['encoding']}")
+                        ok = False
+                    ratio = f"{r['bytes'] / baseline['bytes']:6.2f}" if baseline else f"{'':6}"
+                    print(f"  {path:10} {encoding:9} {'on' if cache else 'off':14} {r['bytes']:10.0f} {ratio} "
+                          f"{r['cpu_us']:10.0f} {r['p50']:7.2f} {hits:6}")
+            entries = compression_stats(base_url)["cache"]["entries"]
+            for n in range(20):
+                for encoding in ENCODINGS[1:]:
+                    user = {**USER, "x-forwarded-user": f"sv{100 + n}", "x-forwarded-preferred-username": f"sv{100 + n}"}
+                    httpx.get(base_url + "/", headers={**user, "accept-encoding": encoding})
+            stats = compression_stats(base_url)
+            print(f"  variant cache {'on' if cache else 'off'}: {stats['compressed']} responses compressed "
+                  f"({stats['spliced']} spliced from template fragments), {stats['cache_hits']} cache hits, "
+                  f"{stats['compress_ms'] / max(stats['compressed'], 1) * 1000:.0f} µs compressing per response")
+            if cache and not stats["cache_hits"]:
+                print("FAIL: repeated identical bodies never hit the compressed-variant cache")
+                ok = False
+            if cache and stats["cache"]["entries"] != entries:
+                print(f"FAIL: 20 more users added {stats['cache']['entries'] - entries} cached variants; "
+                      f"private pages must not be cached")
+                ok = False
+    return ok
+
+
+def upstream_leg(stub: LargeStub, args) -> bool:
+    ok = True
+    print(f"\nupstream leg (stream mode): {args.requests} requests per row")
+    print(f"  {'tkb compresses':15} {'client accepts':15} {'tunnel bytes/req':>16} {'client bytes/req':>16} "
+          f"{'client got':>10}")
+    env = {"TKB_SERVICE_URL": stub.url, "TKB_PROXY_MODE": "stream", "AUDIT_FILE": "/dev/null",
+           "ADMISSION_RATE_SINHVIEN": "0", "TKB_HEDGE": "false"}
+    with spawn_app("demo-app-v5", env=env) as (base_url, proc):
+        reference = None
+        for compress in (False, True):
+            stub.compress = compress
+            for accept in ("identity", "gzip", "br, gzip"):
+                sent = stub.bytes_sent
+                r = asyncio.run(load(base_url, proc.pid, "/api/tkb", accept, args.requests, args.concurrency))
+                tunnel = (stub.bytes_sent - sent) / (args.requests + 1)
+                body = r["sample"].json()
+                reference = reference or body
+                if body != reference:
+                    print(f"FAIL: stream mode with {accept} changed the body")
+                    ok = False
+                if compress and accept != "identity" and r["encoding"] == "identity":
+                    print(f"FAIL: client accepts {accept} but the compressed upstream body was decoded")
+                    ok = False
+                if r["encoding"] != "identity" and r["encoding"] not in accept:
+                    print(f"FAIL: client accepts {accept} but got {r['encoding']}")
+                    ok = False
+                print(f"  {'yes' if compress else 'no':15} {accept:15} {tunnel:16.0f} {r['bytes']:16.0f} "
+                      f"{r['encoding']:>10}")
+        stats = compression_stats(base_url)
+        print(f"  app compressed {stats['compressed']} stream-mode responses; "
+              f"{stats['already_encoded']} passed through already encoded")
+    stub.compress = False
+    return ok
+
+
+def main(args) -> int:
+    with serve_in_thread(LargeStub(payload_kb=args.payload_kb, latency=args.latency)) as stub:
+        ok = client_leg(stub, args)
+        ok = upstream_leg(stub, args) and ok
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--payload-kb", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.005)
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""Home page render cost per request: per-request f-string vs. precompiled Template.
+
+    python testing/benchmarks/bench_home_render.py
+
+"before" rebuilds the whole page as a str and encodes it, which is what the
+old f-string handlers did; "after" is ``Template.render`` plus the ETag.
+"""
+
+import argparse
+import timeit
+
+from _common import load_app
+from zta_common.templates import _PLACEHOLDER
+
+FIELDS = {
+    "k8s-app": {"username": "gv1", "email": "gv1@uit.edu.vn",
+                "role_color": "#28a745", "role_display": "Giảng viên 👨‍🏫"},
+    "demo-app-v5": {"user": "gv1", "groups": "giangvien,sinhvien"},
+}
+
+
+def fstring_equivalent(source: str) -> str:
+    """Turn template source back into a format string (same work as the old f-string)."""
+    parts = _PLACEHOLDER.split(source)
+    for i, part in enumerate(parts):
+        parts[i] = "{" + part + "}" if i % 2 else part.replace("{", "{{").replace("}", "}}")
+    return "".join(parts)
+
+
+def main(args) -> None:
+    for name, fields in FIELDS.items():
+        template = load_app(name).HOME_TEMPLATE
+        fmt = fstring_equivalent(template.source)
+        assert fmt.format(**fields).encode() == template.render(fields)
+
+        before = timeit.repeat(lambda: fmt.format(**fields).encode(), number=args.number, repeat=5)
+        after = timeit.repeat(lambda: (template.render(fields), template.etag(fields)),
+                              number=args.number, repeat=5)
+        b, a = min(before) / args.number * 1e6, min(after) / args.number * 1e6
+        print(f"{name:12s} {len(template.render(fields)):6d} bytes  "
+              f"before {b:7.2f} us/req  after {a:7.2f} us/req  ({b / a:.1f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=20000)
+    main(parser.parse_args())
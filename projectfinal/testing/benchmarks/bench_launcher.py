@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""Container entrypoint: startup time, worker recycling and throughput from 1 to N cores.
+
+    python testing/benchmarks/bench_launcher.py --cores 1 2 4 --duration 10
+
+Compares a bare ``uvicorn main:app`` (the old image CMD) with
+``python -m zta_common.launcher main:app`` (the new one) against stand-in
+upstreams in their own processes:
+
+1. startup: seconds from exec until /health and /ready answer, median of
+   ``--runs``, and how long a forked worker took to serve (launcher log).
+2. recycling: the launcher with two workers and
+   ``LAUNCHER_MAX_REQUESTS=--max-requests`` under the loadtest workload.
+   Reports recycles, the respawned workers' fork-to-serving time, errors
+   and p99 against the same run without recycling, and checks that
+   /metrics (summed over workers, retired ones included) counted every
+   request.
+3. scaling: the app pinned to 1..N cores with ``sched_setaffinity`` (as a
+   CPU limit would), so the launcher sizes itself from the affinity mask;
+   req/s per mode and speedup over one core. The load generator and the
+   stand-ins run on the remaining cores when there are any, else they
+   share; core counts above this host's are skipped.
+
+Pass: no errors while workers recycle, every request counted in /metrics,
+and the launcher started as many workers as it had cores.
+"""
+
+import argparse
+import asyncio
+import os
+import re
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+import httpx
+
+from _common import launch_app, percentiles, spawn_stub, wait_http
+from loadtest import Workload, drive, parse_mix
+
+MODES = ("uvicorn", "launcher")
+SERVING = re.compile(r"worker \d+ serving (\d+) ms after fork")
+WORKERS = re.compile(r"'workers': (\d+)")
+
+
+class App:
+    """One app instance with its stderr collected in the background."""
+
+    def __init__(self, name: str, env: dict, launcher: bool, cpus: list[int] | None = None):
+        preexec = (lambda: os.sched_setaffinity(0, cpus)) if cpus else None
+        self.started = time.perf_counter()
+        self.url, self.proc = launch_app(name, env, launcher=launcher, stderr=subprocess.PIPE, text=True,
+                                         preexec_fn=preexec)
+        self.log: list[str] = []
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._reader.start()
+
+    def _read(self):
+        for line in self.proc.stderr:
+            self.log.append(line)
+
+    def matches(self, pattern: re.Pattern) -> list[int]:
+        return [int(m.group(1)) for line in self.log if (m := pattern.search(line))]
+
+    def stop(self):
+        self.proc.terminate()
+        self.proc.wait(timeout=60)
+        self._reader.join(timeout=5)
+
+
+def environment(stubs: tuple[str, str], extra: dict | None = None) -> dict:
+    tkb_url, aws_url = stubs
+    # One synthetic population hits the apps far harder than real users: rate limits off.
+    return {"TKB_SERVICE_URL": tkb_url, "AWS_URL": aws_url + "/", "AUDIT_FILE": "/dev/null",
+            "ADMISSION_RATE_SINHVIEN": "0", "ADMISSION_RATE_GIANGVIEN": "0", "ADMISSION_RATE_ANONYMOUS": "0",
+            **(extra or {})}
+
+
+def startup(stubs, args) -> bool:
+    print(f"startup: median of {args.runs} runs (s)")
+    print(f"  {'app':12} {'mode':9} {'/health':>8} {'/ready':>8} {'worker fork->serving':>21}")
+    for name in args.apps:
+        for mode in MODES:
+            health, ready, serving = [], [], []
+            for _ in range(args.runs):
+                app = App(name, environment(stubs), launcher=mode == "launcher")
+                try:
+                    wait_http(app.url + "/health", timeout=30)
+                    health.append(time.perf_counter() - app.started)
+                    wait_http(app.url + "/ready", timeout=30)
+                    # wait_http accepts any status below 500; /ready is 503 until warm.
+                    ready.append(time.perf_counter() - app.started)
+                    serving += app.matches(SERVING)
+                finally:
+                    app.stop()
+            fork = f"{statistics.median(serving):.0f} ms" if serving else "-"
+            print(f"  {name:12} {mode:9} {statistics.median(health):8.2f} {statistics.median(ready):8.2f} "
+                  f"{fork:>21}")
+    return True
+
+
+def requests_counted(base_url: str) -> int:
+    text = httpx.get(base_url + "/metrics").text
+    return sum(int(float(line.rpartition(" ")[2])) for line in text.splitlines()
+               if line.startswith("zta_http_requests_total{") and 'route="/metrics"' not in line)
+
+
+def errors_of(result: dict) -> int:
+    return sum(count for r in result["endpoints"].values() for status, count in r["status"].items()
+               if not status.isdigit() or int(status) >= 500)
+
+
+def recycling(stubs, args) -> bool:
+    ok = True
+    name = "demo-app-v5"
+    print(f"\nrecycling: {name}, 2 workers, {args.concurrency} clients for {args.duration:.0f}s")
+    print(f"  {'max requests':13} {'recycles':>8} {'respawn ms':>10} {'req/s':>8} {'p99 ms':>7} {'errors':>6} "
+          f"{'counted':>9}")
+    workload = Workload(name, args.mix, size=10_000, seed=1)
+    for limit in (0, args.max_requests):
+        env = environment(stubs, {"WEB_CONCURRENCY": "2", "LAUNCHER_MAX_REQUESTS": str(limit),
+                                  "LAUNCHER_MAX_REQUESTS_JITTER": str(limit // 5)})
+        app = App(name, env, launcher=True)
+        try:
+            wait_http(app.url + "/ready", timeout=30)
+            while httpx.get(app.url + "/ready").status_code != 200:
+                time.sleep(0.05)
+            first = len(app.matches(SERVING))
+            time.sleep(1.5)  # every worker's metrics export has landed
+            before = requests_counted(app.url)
+            result = asyncio.run(drive(app.url, workload, args.concurrency, args.duration))
+            time.sleep(1.5)
+            counted = requests_counted(app.url) - before
+        finally:
+            app.stop()
+        # Requests that got a response; a transport error may never have reached the app.
+        sent = sum(count for r in result["endpoints"].values() for status, count in r["status"].items()
+                   if status.isdigit())
+        respawns = app.matches(SERVING)[first:]
+        errors = errors_of(result)
+        respawn = f"{statistics.median(respawns):.0f}" if respawns else "-"
+        print(f"  {limit or 'never':13} {len(respawns):8} {respawn:>10} {result['total']['rps']:8.1f} "
+              f"{result['total']['p99']:7.2f} {errors:6} {counted:>4}/{sent:<4}")
+        if errors:
+            print(f"FAIL: {errors} errors with LAUNCHER_MAX_REQUESTS={limit}")
+            ok = False
+        if counted != sent:
+            print(f"FAIL: /metrics counted {counted} requests, {sent} were answered")
+            ok = False
+        if limit and not respawns:
+            print("FAIL: no worker was recycled; raise --duration or lower --max-requests")
+            ok = False
+    return ok
+
+
+def scaling(stubs, args) -> bool:
+    ok = True
+    name = "demo-app-v5"
+    available = sorted(os.sched_getaffinity(0))
+    cores = [n for n in args.cores if n <= len(available)]
+    skipped = [n for n in args.cores if n > len(available)]
+    print(f"\nscaling: {name}, {args.concurrency} clients for {args.duration:.0f}s per row; "
+          f"host has {len(available)} core(s)" + (f", skipping {skipped}" if skipped else ""))
+    print(f"  {'cores':5} {'mode':9} {'workers':>7} {'req/s':>8} {'speedup':>7} {'p99 ms':>7}")
+    workload = Workload(name, args.mix, size=10_000, seed=1)
+    baseline = {}
+    for n in cores:
+        app_cpus = available[:n]
+        rest = available[n:] or available
+        os.sched_setaffinity(0, rest)
+        try:
+            for mode in MODES:
+                app = App(name, environment(stubs), launcher=mode == "launcher", cpus=app_cpus)
+                try:
+                    wait_http(app.url + "/ready", timeout=30)
+                    asyncio.run(drive(app.url, workload, args.concurrency, min(args.duration, 3.0)))
+                    result = asyncio.run(drive(app.url, workload, args.concurrency, args.duration))
+                finally:
+                    app.stop()
+                workers = (app.matches(WORKERS) or [1])[0]
+                rps = result["total"]["rps"]
+                baseline.setdefault(mode, rps)
+                print(f"  {n:5} {mode:9} {workers:7} {rps:8.1f} {rps / baseline[mode]:6.2f}x "
+                      f"{result['total']['p99']:7.2f}")
+                if mode == "launcher" and workers != n:
+                    print(f"FAIL: launcher started {workers} workers on {n} core(s)")
+                    ok = False
+                if errors_of(result):
+                    print(f"FAIL: {errors_of(result)} errors")
+                    ok = False
+        finally:
+            os.sched_setaffinity(0, available)
+    return ok
+
+
+def main(args) -> int:
+    upstream = ["--latency", str(args.latency), "--jitter", str(args.latency / 3),
+                "--connect-delay", str(args.connect_delay)]
+    with spawn_stub("tkb", *upstream) as tkb_url, spawn_stub("plain", *upstream) as aws_url:
+        stubs = (tkb_url, aws_url)
+        ok = startup(stubs, args)
+        ok = recycling(stubs, args) and ok
+        ok = scaling(stubs, args) and ok
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--apps", nargs="+", default=["demo-app-v5", "k8s-app"])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--cores", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--max-requests", type=int, default=500, help="LAUNCHER_MAX_REQUESTS for the recycling run")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("giangvien=0.3,sinhvien=0.5,anonymous=0.2"))
+    parser.add_argument("--latency", type=float, default=0.015, help="stand-in upstream latency (s)")
+    parser.add_argument("--connect-delay", type=float, default=0.03)
+    sys.exit(main(parser.parse_args()))
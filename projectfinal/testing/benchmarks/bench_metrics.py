@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""Per-request cost of MetricsMiddleware and the size of a /metrics scrape.
+
+    python testing/benchmarks/bench_metrics.py
+
+Drives the demo-app-v5 ASGI stack directly (no server, no sockets) on a
+cheap public route and on a policy-denied one, with and without the
+metrics middleware, so the difference is the instrumentation alone.
+Also checks that steady-state recording does not grow the heap: every
+series exists after the warm-up pass (a few bytes of float churn for the
+running sums is tolerated).
+"""
+
+import argparse
+import asyncio
+import sys
+import time
+import tracemalloc
+
+from _common import load_app
+from zta_common.metrics import MetricsMiddleware, MetricsRegistry
+
+HEADERS = [(b"x-forwarded-user", b"gv1"), (b"x-forwarded-groups", b"giangvien")]
+
+
+def scope(path: str, method: str = "GET", headers=()) -> dict:
+    return {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": method,
+        "scheme": "http", "path": path, "raw_path": path.encode(), "root_path": "",
+        "query_string": b"", "headers": list(headers), "server": ("bench", 80), "client": ("127.0.0.1", 1),
+    }
+
+
+async def receive():
+    return {"type": "http.request", "body": b"", "more_body": False}
+
+
+async def send(message):
+    pass
+
+
+async def drive(app, requests: list[dict]) -> float:
+    started = time.perf_counter()
+    for s in requests:
+        await app(dict(s), receive, send)
+    return time.perf_counter() - started
+
+
+async def run(args) -> int:
+    module = load_app("demo-app-v5")
+    app = module.app
+    # Build the middleware stack once, then get at the layer under MetricsMiddleware.
+    await app(scope("/health"), receive, send)
+    layer = app.middleware_stack
+    while layer is not None and not isinstance(layer, MetricsMiddleware):
+        layer = getattr(layer, "app", None)
+    if layer is None:
+        print("MetricsMiddleware is not installed")
+        return 1
+    bare = layer.app
+    registry = MetricsRegistry()
+    registry.register_routes(app.routes)
+    metered = MetricsMiddleware(bare, registry)
+
+    workloads = {
+        "GET /health": [scope("/health")] * args.requests,
+        "GET /api/giangvien (403)": [scope("/api/giangvien", headers=[(b"x-forwarded-user", b"sv1")])] * args.requests,
+        "GET /api/sinhvien": [scope("/api/sinhvien", headers=HEADERS)] * args.requests,
+    }
+    print(f"{'workload':28} {'bare us/req':>12} {'metered us/req':>15} {'overhead us':>12}")
+    for name, requests in workloads.items():
+        await drive(metered, requests[:1000])
+        t_bare = t_metered = float("inf")
+        for _ in range(args.rounds):
+            t_bare = min(t_bare, await drive(bare, requests))
+            t_metered = min(t_metered, await drive(metered, requests))
+        per = lambda t: t / len(requests) * 1e6  # noqa: E731
+        print(f"{name:28} {per(t_bare):12.2f} {per(t_metered):15.2f} {per(t_metered) - per(t_bare):12.2f}")
+
+    tracemalloc.start()
+    await drive(metered, workloads["GET /api/sinhvien"][:1000])
+    before = tracemalloc.take_snapshot()
+    await drive(metered, workloads["GET /api/sinhvien"][:20_000])
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    growth = sum(stat.size_diff for stat in after.compare_to(before, "filename")
+                 if stat.traceback[0].filename.endswith("metrics.py"))
+    print(f"heap growth in metrics.py over 20k requests: {growth} bytes")
+
+    started = time.perf_counter()
+    body = registry.render()
+    lines = body.count(b"\n")
+    print(f"scrape: {len(body):,} bytes, {lines:,} lines, "
+          f"rendered in {(time.perf_counter() - started) * 1e3:.2f} ms")
+    return 0 if growth < 1024 else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=20_000)
+    parser.add_argument("--rounds", type=int, default=5, help="best-of-N timing per workload")
+    sys.exit(asyncio.run(run(parser.parse_args())))
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""Parity of the in-process PolicyEngine with authz_test.rego, then decisions/sec.
+
+    python testing/benchmarks/bench_policy.py
+
+Every ``test_*`` rule in policies/opa/authz_test.rego of the form
+``[not] allow with input as {...}`` is replayed against the engine; the
+benchmark only runs if all of them agree with the expected outcome.
+"""
+
+import argparse
+import json
+import random
+import re
+import sys
+import time
+
+from _common import PROJECT_DIR
+from zta_common.policy import PolicyEngine
+
+REGO_TESTS = PROJECT_DIR / "policies" / "opa" / "authz_test.rego"
+POLICY = PROJECT_DIR / "policies" / "opa" / "authz.rego"
+
+
+def rego_cases(text: str):
+    """Yield (name, expect_allow, input) for each ``test_*`` rule."""
+    for match in re.finditer(r"^(test_\w+) if \{\s*(not\s+)?allow with input as ", text, re.MULTILINE):
+        start = match.end()
+        depth = 0
+        for i in range(start, len(text)):
+            depth += {"{": 1, "}": -1}.get(text[i], 0)
+            if depth == 0:
+                yield match.group(1), match.group(2) is None, json.loads(text[start:i + 1])
+                break
+
+
+def check_parity(engine: PolicyEngine) -> bool:
+    ok = True
+    for name, expected, case in rego_cases(REGO_TESTS.read_text(encoding="utf-8")):
+        roles = frozenset(case["user"]["roles"] or ())
+        got = engine.allow(roles, case["request"]["method"], case["request"]["path"])
+        ok &= got == expected
+        print(f"  {'ok  ' if got == expected else 'FAIL'} {name}: expected {expected}, got {got}")
+    return ok
+
+
+def workload(n: int) -> list[tuple]:
+    rng = random.Random(42)
+    role_sets = [frozenset(), frozenset({"sinhvien"}), frozenset({"giangvien"}),
+                 frozenset({"giangvien", "sinhvien"}), frozenset({"admin"})]
+    paths = ["/", "/health", "/api/me", "/api/sinhvien", "/api/giangvien", "/api/aws",
+             "/api/tkb", "/api/tkb/today", "/static/app.css", "/api/unknown", "/internal/stats"]
+    methods = ["GET"] * 8 + ["POST", "DELETE"]
+    return [(rng.choice(role_sets), rng.choice(methods), rng.choice(paths)) for _ in range(n)]
+
+
+def rate(fn, calls: list[tuple]) -> float:
+    started = time.perf_counter()
+    for roles, method, path in calls:
+        fn(roles, method, path)
+    return len(calls) / (time.perf_counter() - started)
+
+
+def main(args) -> int:
+    engine = PolicyEngine.from_file(POLICY)
+    print(f"parity with {REGO_TESTS.name}:")
+    if not check_parity(engine):
+        print("engine disagrees with the Rego tests; not benchmarking")
+        return 1
+    calls = workload(args.decisions)
+    print(f"uncached trie walk: {rate(engine.evaluate_uncached, calls):12,.0f} decisions/s")
+    print(f"LRU-cached:         {rate(engine.allow, calls):12,.0f} decisions/s")
+    print("cache:", engine.stats()["cache"])
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--decisions", type=int, default=500_000)
+    sys.exit(main(parser.parse_args()))
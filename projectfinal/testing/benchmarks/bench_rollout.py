@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""Rolling restart under load: latency and errors with /ready + drain vs /health only.
+
+    python testing/benchmarks/bench_rollout.py --restarts 3 --rate 40
+
+demo-app-v5 runs behind a small in-process load balancer that behaves like
+a Service with ``maxSurge: 1, maxUnavailable: 0``: it polls each instance's
+readiness path every ``--probe-interval`` seconds and sends requests only to
+instances that passed. Open-loop traffic (``--rate`` requests/s over
+/api/tkb, /api/me and /, as sinhvien and giangvien) runs throughout. Each
+restart starts a new instance, waits until the balancer routes to it, sends
+SIGTERM to the old one and drops it from rotation ``--propagation`` seconds
+later (the time an endpoint removal takes to reach every proxy).
+
+- health: readiness is /health, no drain delay (the old behaviour). The new
+  instance gets traffic with no connections to tkb-service and an empty
+  cache; the old one closes its listener while it is still in rotation.
+- ready: readiness is /ready (warmup done), LIFECYCLE_DRAIN_DELAY covers the
+  propagation.
+
+The stand-in tkb-service charges ``--connect-delay`` per new connection (the
+WireGuard handshake) and ``--latency`` per request. Pass: with /ready, no
+errors, and no request slower than that cold path (a new connection plus an
+upstream call), i.e. nobody paid for a cold instance. New instances start at nice 19 until
+they are routed to, standing in for the CPU a new pod has to itself;
+otherwise, on one core, the interpreter's imports show up in the serving
+instance's p99 in both modes.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import itertools
+import os
+import signal
+import sys
+import time
+
+import httpx
+
+from _common import launch_app, percentiles, spawn_stub
+
+USERS = [("sv001", "sinhvien"), ("sv002", "sinhvien"), ("gv001", "giangvien"), ("gv002", "giangvien")]
+PATHS = ["/api/tkb", "/api/tkb", "/api/me", "/"]
+
+
+class Backend:
+    def __init__(self, url: str, proc):
+        self.url = url
+        self.proc = proc
+        self.ready = False
+        self.removed = False
+        self.client = httpx.AsyncClient(base_url=url, timeout=10)
+
+    @property
+    def routable(self) -> bool:
+        return self.ready and not self.removed
+
+
+class Balancer:
+    """Round-robin over backends whose readiness probe last passed."""
+
+    def __init__(self, probe_path: str, probe_interval: float):
+        self.probe_path = probe_path
+        self.probe_interval = probe_interval
+        self.backends: list[Backend] = []
+        self._rr = itertools.count()
+        self._probes: list[asyncio.Task] = []
+
+    def add(self, backend: Backend) -> None:
+        self.backends.append(backend)
+        self._probes.append(asyncio.create_task(self._probe(backend)))
+
+    async def _probe(self, backend: Backend) -> None:
+        async with httpx.AsyncClient(base_url=backend.url, timeout=1) as client:
+            while not backend.removed:
+                try:
+                    backend.ready = (await client.get(self.probe_path)).status_code == 200
+                except httpx.HTTPError:
+                    backend.ready = False
+                await asyncio.sleep(self.probe_interval)
+
+    def pick(self) -> Backend | None:
+        routable = [b for b in self.backends if b.routable]
+        return routable[next(self._rr) % len(routable)] if routable else None
+
+    async def aclose(self) -> None:
+        for task in self._probes:
+            task.cancel()
+        for backend in self.backends:
+            await backend.client.aclose()
+
+
+def renice(pid: int, niceness: int) -> None:
+    with contextlib.suppress(OSError):  # raising priority back needs CAP_SYS_NICE
+        os.setpriority(os.PRIO_PROCESS, pid, niceness)
+
+
+async def start_backend(balancer: Balancer, env: dict) -> Backend:
+    backend = Backend(*launch_app("demo-app-v5", env=env))
+    # A new pod boots on CPU of its own; on a single core, keep its imports
+    # from preempting the instance that is serving until it takes traffic.
+    renice(backend.proc.pid, 19)
+    balancer.add(backend)
+    while not backend.ready:
+        if backend.proc.poll() is not None:
+            raise RuntimeError("demo-app-v5 exited during startup")
+        await asyncio.sleep(0.02)
+    renice(backend.proc.pid, 0)
+    return backend
+
+
+async def stop_backend(backend: Backend, propagation: float) -> None:
+    backend.proc.send_signal(signal.SIGTERM)
+    await asyncio.sleep(propagation)
+    backend.removed = True
+    await asyncio.to_thread(backend.proc.wait)
+
+
+async def traffic(balancer: Balancer, rate: float, stop: asyncio.Event, samples: list) -> None:
+    """Open loop: a request every 1/rate seconds regardless of how long earlier ones take."""
+    requests = itertools.cycle(itertools.product(PATHS, USERS))
+    pending = set()
+
+    async def one(path: str, user: str, role: str):
+        sent = time.perf_counter()
+        backend = balancer.pick()
+        ok = False
+        if backend is not None:
+            headers = {"x-forwarded-user": user, "x-forwarded-preferred-username": user, "x-forwarded-groups": role}
+            try:
+                ok = (await backend.client.get(path, headers=headers)).status_code == 200
+            except httpx.HTTPError:
+                pass
+        samples.append((sent, time.perf_counter() - sent, ok))
+
+    next_at = time.perf_counter()
+    while not stop.is_set():
+        path, (user, role) = next(requests)
+        task = asyncio.create_task(one(path, user, role))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+        next_at += 1 / rate
+        await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+    await asyncio.gather(*pending)
+
+
+async def rollout(mode: str, tkb_url: str, args) -> dict:
+    env = {"TKB_SERVICE_URL": tkb_url, "AUDIT_FILE": "/dev/null", "ADMISSION_RATE_SINHVIEN": "0",
+           "ADMISSION_RATE_GIANGVIEN": "0", "TKB_HEDGE": "false",
+           "LIFECYCLE_DRAIN_DELAY": str(args.propagation + 0.5 if mode == "ready" else 0)}
+    balancer = Balancer("/ready" if mode == "ready" else "/health", args.probe_interval)
+    samples: list = []
+    stop = asyncio.Event()
+    current = await start_backend(balancer, env)
+    await asyncio.sleep(1.0)
+    load = asyncio.create_task(traffic(balancer, args.rate, stop, samples))
+    await asyncio.sleep(args.steady)
+    rollout_started = time.perf_counter()
+    for _ in range(args.restarts):
+        new = await start_backend(balancer, env)
+        await stop_backend(current, args.propagation)
+        current = new
+        await asyncio.sleep(args.settle)
+    rollout_ended = time.perf_counter()
+    stop.set()
+    await load
+    current.proc.send_signal(signal.SIGTERM)
+    await asyncio.to_thread(current.proc.wait)
+    await balancer.aclose()
+    steady = [s for s in samples if s[0] < rollout_started]
+    during = [s for s in samples if rollout_started <= s[0] < rollout_ended]
+    return {
+        "steady": percentiles([s[1] for s in steady]),
+        "rollout": percentiles([s[1] for s in during]),
+        "rollout_max_ms": round(max((s[1] for s in during), default=0) * 1000, 1),
+        "errors": sum(1 for s in during if not s[2]),
+        "requests": len(during),
+    }
+
+
+def main(args) -> int:
+    print(f"{args.restarts} rolling restart(s) of demo-app-v5 at {args.rate:.0f} req/s; tkb-service "
+          f"{args.latency * 1000:.0f} ms/request, {args.connect_delay * 1000:.0f} ms/connection; "
+          f"probe every {args.probe_interval}s, endpoint removal after {args.propagation}s")
+    print(f"  {'readiness':10} {'steady p50':>10} {'steady p99':>10} {'roll p50':>9} {'roll p99':>9} "
+          f"{'roll max':>9} {'errors':>10}")
+    results = {}
+    for mode in ("health", "ready"):
+        with spawn_stub("tkb", "--latency", str(args.latency), "--connect-delay", str(args.connect_delay)) as tkb:
+            result = results[mode] = asyncio.run(rollout(mode, tkb, args))
+        steady, during = result["steady"], result["rollout"]
+        print(f"  {'/' + mode:10} {steady['p50']:10.2f} {steady['p99']:10.2f} {during['p50']:9.2f} "
+              f"{during['p99']:9.2f} {result['rollout_max_ms']:9.1f} {result['errors']:>4}/{result['requests']:<5}")
+
+    ok = True
+    ready = results["ready"]
+    if ready["errors"]:
+        print(f"FAIL: {ready['errors']} request(s) failed during the /ready rollout")
+        ok = False
+    cold_ms = (args.connect_delay + args.latency) * 1000
+    if ready["rollout_max_ms"] >= cold_ms:
+        print(f"FAIL: a request took {ready['rollout_max_ms']} ms during the /ready rollout, "
+              f"as long as a cold call ({cold_ms:.0f} ms)")
+        ok = False
+    print(f"rollout p99 over steady: /health +{results['health']['rollout']['p99'] - results['health']['steady']['p99']:.1f} ms, "
+          f"/ready +{ready['rollout']['p99'] - ready['steady']['p99']:.1f} ms")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--restarts", type=int, default=3)
+    parser.add_argument("--rate", type=float, default=40.0, help="requests per second (open loop)")
+    parser.add_argument("--steady", type=float, default=8.0, help="seconds of traffic before the first restart")
+    parser.add_argument("--settle", type=float, default=2.0, help="seconds between restarts")
+    parser.add_argument("--probe-interval", type=float, default=0.2)
+    parser.add_argument("--propagation", type=float, default=0.5)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--connect-delay", type=float, default=0.15)
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""Failover, latency-aware routing and hedging of UpstreamBalancer against stand-in TKB nodes.
+
+    python testing/benchmarks/bench_tkb_balancer.py
+
+Three scenarios, each checked and then reported:
+
+1. failover: one endpoint refuses connections, one works. No request may
+   fail, and the dead endpoint's breaker must open.
+2. routing: one endpoint answers in ``--slow`` seconds, the other in
+   ``--latency``. The fast one must take the bulk (>= 70%) of the traffic;
+   the rest spills over by design when it is already busy (peak EWMA).
+3. hedging: two identical endpoints where ``--tail-ratio`` of requests
+   stall for ``--tail-latency``. p99 with hedging must beat p99 without,
+   while staying inside the hedge budget.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import sys
+import time
+
+import httpx
+
+from _common import free_port, percentiles
+from stubs import StubUpstream, serve_in_thread
+from zta_common.balancer import Endpoint, UpstreamBalancer
+from zta_common.probe import CircuitBreaker, HealthProber
+from zta_common.upstream import PoolConfig, UpstreamPool
+
+
+def make_balancer(urls: list[str], **options) -> UpstreamBalancer:
+    config = PoolConfig(connect_timeout=1.0, read_timeout=5.0)
+    endpoints = []
+    for url in urls:
+        pool = UpstreamPool("tkb-service", url, config)
+        # Slow active probing so the scenarios exercise the passive signal.
+        prober = HealthProber(f"tkb@{url}", "/health", pool, interval=30.0, timeout=1.0,
+                              breaker=CircuitBreaker(failure_threshold=3, reset_timeout=60.0))
+        endpoints.append(Endpoint(pool.base_url, pool, prober, failure_penalty=0.5))
+    return UpstreamBalancer("tkb-service", endpoints, **options)
+
+
+async def load(balancer: UpstreamBalancer, requests: int, concurrency: int, method: str = "GET"):
+    samples: list[float] = []
+    errors = 0
+    queue = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for _ in queue:
+            started = time.perf_counter()
+            try:
+                response = await balancer.request(method, "/api/tkb")
+                response.raise_for_status()
+            except httpx.HTTPError:
+                errors += 1
+            samples.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return percentiles(samples), errors
+
+
+def show(title: str, balancer: UpstreamBalancer, result: dict, errors: int) -> None:
+    print(f"\n{title}: errors={errors} {result}")
+    stats = balancer.stats()
+    print("  balancer:", json.dumps({k: v for k, v in stats.items() if k not in ("endpoints", "hedging")}))
+    for e in stats["endpoints"]:
+        print(f"  {e['url']:28} healthy={e['healthy']!s:5} requests={e['requests']:5} failures={e['failures']:3} "
+              f"cancelled={e['cancelled']:3} ewma_ms={e['ewma_ms']} breaker={e['probe']['breaker']['state']}")
+
+
+async def failover(args, live: str) -> bool:
+    dead = f"http://127.0.0.1:{free_port()}"
+    balancer = make_balancer([dead, live], hedge=False)
+    await balancer.start()
+    try:
+        result, errors = await load(balancer, args.requests, args.concurrency)
+        show("failover (GET)", balancer, result, errors)
+        post, post_errors = await load(balancer, 50, 5, method="POST")
+        print(f"  POST after breaker opened: errors={post_errors}")
+        dead_endpoint = balancer.endpoints[0]
+        return errors == 0 and post_errors == 0 and not dead_endpoint.healthy
+    finally:
+        await balancer.aclose()
+
+
+async def routing(args, slow: str, fast: str) -> bool:
+    balancer = make_balancer([slow, fast], hedge=False)
+    await balancer.start()
+    try:
+        result, errors = await load(balancer, args.requests, args.concurrency)
+        show("latency-aware routing", balancer, result, errors)
+        share = balancer.endpoints[1].counters["requests"] / max(1, balancer.counters["requests"])
+        print(f"  fast endpoint share: {share:.0%}")
+        return errors == 0 and share >= 0.7
+    finally:
+        await balancer.aclose()
+
+
+async def hedging(args, urls: list[str]) -> bool:
+    p99 = {}
+    for hedge in (False, True):
+        balancer = make_balancer(urls, hedge=hedge, hedge_percentile=args.hedge_percentile,
+                                 hedge_budget=args.hedge_budget)
+        await balancer.start()
+        try:
+            result, errors = await load(balancer, args.requests, args.concurrency)
+            show(f"hedging {'on' if hedge else 'off'}", balancer, result, errors)
+            p99[hedge] = result["p99"]
+            if hedge:
+                ratio = balancer.counters["hedges"] / balancer.counters["requests"]
+                print(f"  hedges sent: {ratio:.1%} of requests (budget {args.hedge_budget:.0%}), "
+                      f"won: {balancer.counters['hedges_won']}")
+                within_budget = ratio <= args.hedge_budget + 0.01
+        finally:
+            await balancer.aclose()
+    print(f"  p99 without hedging {p99[False]} ms -> with hedging {p99[True]} ms")
+    return p99[True] < p99[False] and within_budget
+
+
+async def main(args) -> int:
+    with contextlib.ExitStack() as stack:
+        live = stack.enter_context(serve_in_thread(StubUpstream(latency=args.latency))).url
+        slow = stack.enter_context(serve_in_thread(StubUpstream(latency=args.slow))).url
+        tails = [
+            stack.enter_context(serve_in_thread(StubUpstream(
+                latency=args.latency, tail_ratio=args.tail_ratio, tail_latency=args.tail_latency))).url
+            for _ in range(2)
+        ]
+        results = {
+            "failover": await failover(args, live),
+            "routing": await routing(args, slow, live),
+            "hedging": await hedging(args, tails),
+        }
+    print()
+    for name, ok in results.items():
+        print(f"{'ok  ' if ok else 'FAIL'} {name}")
+    return 0 if all(results.values()) else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.005)
+    parser.add_argument("--slow", type=float, default=0.05)
+    parser.add_argument("--tail-ratio", type=float, default=0.03)
+    parser.add_argument("--tail-latency", type=float, default=0.25)
+    parser.add_argument("--hedge-percentile", type=float, default=0.9)
+    parser.add_argument("--hedge-budget", type=float, default=0.1)
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""TKB response cache: burst coalescing, role isolation and revalidation.
+
+    python testing/benchmarks/bench_tkb_cache.py --burst 500
+
+Drives demo-app-v5's /api/tkb in-process against a stand-in tkb-service
+with WireGuard-like latency. Exits non-zero if a burst of identical
+requests makes more than one upstream call, or if any response carries
+another role's schedule or another user's name.
+"""
+
+import argparse
+import asyncio
+import collections
+import os
+import sys
+import time
+
+import httpx
+
+from _common import ADMIN_HEADERS, load_app, percentiles
+from stubs import TkbStub, serve_in_thread
+
+
+def who(user: str, groups: str) -> dict:
+    return {"x-forwarded-user": user, "x-forwarded-groups": groups}
+
+
+async def main(args) -> int:
+    stub = TkbStub(latency=args.latency)
+    failures = []
+    with serve_in_thread(stub):
+        os.environ["TKB_SERVICE_URL"] = stub.url
+        os.environ.setdefault("TKB_CACHE_TTL", str(args.ttl))
+        # The warm-hit loop is one user far above any human rate: measure the cache, not the 429s.
+        for role in ("SINHVIEN", "GIANGVIEN"):
+            os.environ.setdefault(f"ADMISSION_RATE_{role}", "0")
+        app = load_app("demo-app-v5").app
+        async with app.router.lifespan_context(app):
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://demo") as client:
+                # Warmup fills the cache in the background; start from an empty one after it.
+                while (ready := await client.get("/ready")).status_code != 200:
+                    if ready.json()["status"] == "failed":
+                        failures.append(f"warmup failed: {ready.json()['warmup']}")
+                        break
+                    await asyncio.sleep(0.05)
+                app.state.tkb_cache.clear()
+
+                async def get(user, groups):
+                    started = time.perf_counter()
+                    r = await client.get("/api/tkb", headers=who(user, groups))
+                    return r, time.perf_counter() - started
+
+                # 1. A burst of identical students: one upstream call.
+                before = stub.requests_by_path["/api/tkb"]
+                results = await asyncio.gather(*(get(f"sv{i}", "sinhvien") for i in range(args.burst)))
+                outcomes = collections.Counter(r.headers["x-cache"] for r, _ in results)
+                calls = stub.requests_by_path["/api/tkb"] - before
+                print(f"burst of {args.burst}: upstream calls={calls} outcomes={dict(outcomes)} "
+                      f"latency={percentiles([t for _, t in results])}")
+                if calls != 1:
+                    failures.append(f"burst made {calls} upstream calls")
+                for i, (r, _) in enumerate(results):
+                    body = r.json()
+                    if body["role"] != "sinhvien" or body["user"] != f"sv{i}":
+                        failures.append(f"sv{i} got role={body['role']} user={body['user']}")
+
+                # 2. Other role sets get their own entries.
+                for user, groups, role in (("gv1", "giangvien", "giangvien"),
+                                           ("both", "sinhvien,giangvien", "giangvien"),
+                                           ("sv-again", "sinhvien", "sinhvien")):
+                    r, _ = await get(user, groups)
+                    body = r.json()
+                    print(f"{user:9s} groups={groups:20s} -> {r.headers['x-cache']:9s} role={body['role']}")
+                    if body["role"] != role or body["user"] != user:
+                        failures.append(f"{user} got role={body['role']} user={body['user']}")
+
+                # 3. Warm hits vs. the first (cold) request.
+                warm = [(await get("sv-warm", "sinhvien"))[1] for _ in range(200)]
+                print(f"warm hits: {percentiles(warm)}")
+
+                # 4. Past the TTL: served stale, refreshed in the background with If-None-Match.
+                await asyncio.sleep(args.ttl + 0.05)
+                r, _ = await get("sv-late", "sinhvien")
+                await asyncio.sleep(args.latency * 3)
+                stats = (await client.get("/internal/stats", headers=ADMIN_HEADERS)).json()["tkb_cache"]
+                print(f"after ttl: {r.headers['x-cache']}; cache stats {stats}")
+                if stats["revalidated"] < 1:
+                    failures.append("stale entry was not revalidated with a 304")
+
+    for failure in failures[:10]:
+        print("FAIL:", failure)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--burst", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--ttl", type=float, default=1.0)
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""Per-request AsyncClient vs. the shared UpstreamPool against a stand-in tkb-service.
+
+    python testing/benchmarks/bench_tkb_pool.py --connect-delay 0.02 --latency 0.005
+
+``--connect-delay`` models the extra round-trips of opening a connection
+across the WireGuard tunnel; the pooled client only pays it once per
+keep-alive connection.
+"""
+
+import argparse
+import asyncio
+import time
+
+import httpx
+
+from _common import percentiles
+from stubs import StubUpstream, serve_in_thread
+from zta_common import PoolConfig, UpstreamPool
+
+
+async def run(concurrency: int, total: int, call) -> tuple[list[float], float]:
+    samples: list[float] = []
+    queue = iter(range(total))
+
+    async def worker():
+        for _ in queue:
+            start = time.perf_counter()
+            await call()
+            samples.append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return samples, time.perf_counter() - started
+
+
+async def main(args) -> None:
+    stub = StubUpstream(connect_delay=args.connect_delay, latency=args.latency, jitter=args.jitter)
+    with serve_in_thread(stub):
+
+        async def per_request_client():
+            async with httpx.AsyncClient(timeout=10.0) as client:
+                (await client.get(f"{stub.url}/api/tkb")).json()
+
+        pool = UpstreamPool("tkb-service", stub.url, PoolConfig(max_keepalive_connections=args.concurrency))
+        await pool.start()
+
+        async def pooled_client():
+            (await pool.client.get("/api/tkb")).json()
+
+        results = {}
+        for label, call in (("per-request client", per_request_client), ("shared pool", pooled_client)):
+            before = stub.connections
+            samples, elapsed = await run(args.concurrency, args.requests, call)
+            results[label] = percentiles(samples)
+            print(f"{label:20s} {args.requests / elapsed:8.1f} req/s  "
+                  f"connections={stub.connections - before:5d}  {results[label]}")
+        print("pool stats:", pool.stats())
+        await pool.aclose()
+
+        base, pooled = results["per-request client"]["p99"], results["shared pool"]["p99"]
+        print(f"p99 speedup: {base / pooled:.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--connect-delay", type=float, default=0.02)
+    parser.add_argument("--latency", type=float, default=0.005)
+    parser.add_argument("--jitter", type=float, default=0.001)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""Buffered JSON proxy vs. streaming passthrough for large TKB payloads.
+
+    python testing/benchmarks/bench_tkb_stream.py --sizes-kb 1024 8192 32768
+
+For each payload size and TKB_PROXY_MODE, demo-app-v5 runs under uvicorn
+in its own process against a stand-in upstream in another process; the
+table shows the app's peak RSS growth (from the end of its warmup), time
+to first byte and total time. In stream mode the peak RSS growth should
+stay flat as payloads grow.
+"""
+
+import argparse
+import time
+
+import httpx
+
+from _common import peak_rss_kb, spawn_app, spawn_stub, wait_ready
+
+# identity: measure the proxy modes themselves, not response compression
+HEADERS = {"x-forwarded-user": "sv1", "x-forwarded-groups": "sinhvien", "accept-encoding": "identity"}
+
+
+def measure(base_url: str, pid: int, requests: int) -> dict:
+    baseline = peak_rss_kb(pid)
+    ttfb, total, size = [], [], 0
+    with httpx.Client(base_url=base_url, timeout=120) as client:
+        for _ in range(requests):
+            started = time.perf_counter()
+            with client.stream("GET", "/api/tkb", headers=HEADERS) as response:
+                first = True
+                for chunk in response.iter_raw():
+                    if first:
+                        ttfb.append(time.perf_counter() - started)
+                        first = False
+                    size += len(chunk)
+            total.append(time.perf_counter() - started)
+    return {
+        "rss_growth_mb": (peak_rss_kb(pid) - baseline) / 1024,
+        "ttfb_ms": min(ttfb) * 1000,
+        "total_ms": min(total) * 1000,
+        "mb_per_response": size / requests / 1024 / 1024,
+    }
+
+
+def main(args) -> None:
+    print(f"{'payload':>10s} {'mode':>7s} {'rss growth':>11s} {'ttfb':>9s} {'total':>9s}")
+    for size_kb in args.sizes_kb:
+        with spawn_stub("large", "--payload-kb", str(size_kb)) as upstream:
+            for mode in ("json", "stream"):
+                env = {"TKB_SERVICE_URL": upstream, "TKB_PROXY_MODE": mode, "TKB_CACHE_TTL": "0",
+                       "ADMISSION_RATE_SINHVIEN": "0"}
+                with spawn_app("demo-app-v5", env) as (base_url, proc):
+                    # Warmup requests in flight would count towards the RSS growth.
+                    wait_ready(base_url)
+                    r = measure(base_url, proc.pid, args.requests)
+                print(f"{r['mb_per_response']:8.1f}MB {mode:>7s} {r['rss_growth_mb']:9.1f}MB "
+                      f"{r['ttfb_ms']:7.1f}ms {r['total_ms']:7.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes-kb", type=int, nargs="+", default=[1024, 8192, 32768])
+    parser.add_argument("--requests", type=int, default=3)
+    main(parser.parse_args())
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""Tracing: traceparent propagation to tkb-service, span tree, and per-request overhead by sample ratio.
+
+    python testing/benchmarks/bench_tracing.py --duration 5 --budget 5
+
+1. checks: demo-app-v5 in-process proxies /api/tkb (stream mode) to a
+   stand-in tkb-service, with every trace sampled and spans written to a
+   temporary OTLP/JSON file. A caller's sampled ``traceparent`` must reach
+   the stand-in with the same trace id and the client span as parent, and
+   the exported spans must form the tree server -> rbac.evaluate / handler
+   -> client. Unsampled, missing and malformed ``traceparent`` headers and
+   the untraced probe path are covered too.
+2. cost per request: drives the ASGI stack under ``TracingMiddleware``
+   directly (no server, no sockets, like bench_metrics.py) without it and
+   at several sample ratios, exporting to /dev/null; the export itself is
+   included in the time.
+3. full load: loadtest.py's demo-app-v5 mix through uvicorn, propagate-only
+   (ratio 0, no exporter) vs ``--ratio`` vs every request sampled, best of
+   ``--runs`` alternating runs, compared on the app's CPU time per request
+   (req/s on a shared core mostly measures the client). Fails if
+   ``--ratio`` (the default TRACE_SAMPLE_RATIO) adds more than ``--budget``
+   percent.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+import httpx
+
+import loadtest
+from _common import ADMIN_HEADERS, cpu_seconds, load_app, spawn_app, spawn_stub
+from stubs import TkbStub, serve_in_thread
+from zta_common.tracing import FileSink, SpanExporter, Tracer, TracingMiddleware, parse_traceparent
+
+STUDENT = {"x-forwarded-user": "sv001", "x-forwarded-groups": "sinhvien"}
+CALLER = "00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01"
+
+
+class TracedTkbStub(TkbStub):
+    """Remembers the ``traceparent`` of the last proxied request (not the balancer's health checks)."""
+
+    traceparent = ""
+
+    def respond(self, method, target, headers):
+        if "x-forwarded-user" in headers:
+            self.traceparent = headers.get("traceparent", "")
+        return super().respond(method, target, headers)
+
+
+def read_spans(path: str) -> list[dict]:
+    spans = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            for resource in json.loads(line)["resourceSpans"]:
+                service = {a["key"]: a["value"]["stringValue"] for a in resource["resource"]["attributes"]}
+                for scope in resource["scopeSpans"]:
+                    spans.extend({**s, "service": service.get("service.name")} for s in scope["spans"])
+    return spans
+
+
+async def checks(module, stub: TracedTkbStub, trace_file: str) -> dict[str, bool]:
+    app = module.app
+    results = {}
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://demo") as client:
+
+            async def call(path: str, traceparent: str | None = None) -> tuple[httpx.Response, list[dict]]:
+                before = len(read_spans(trace_file))
+                headers = {**STUDENT, **({"traceparent": traceparent} if traceparent else {})}
+                response = await client.get(path, headers=headers)
+                await module.TRACER.exporter.flush()
+                return response, read_spans(trace_file)[before:]
+
+            caller = parse_traceparent(CALLER)
+            response, spans = await call("/api/tkb", CALLER)
+            sent = parse_traceparent(stub.traceparent)
+            by_name = {s["name"].split(" ")[0] if s["kind"] == 3 else s["name"]: s for s in spans}
+            server = next((s for s in spans if s["kind"] == 2), None)
+            client_span = next((s for s in spans if s["kind"] == 3), None)
+            results["sampled caller: upstream continues the trace"] = (
+                response.status_code == 200 and sent is not None and sent.trace_id == caller.trace_id
+                and sent.sampled and client_span is not None and sent.span_id == client_span["spanId"])
+            results["span tree server > rbac, handler > client"] = (
+                server is not None and server["parentSpanId"] == caller.span_id
+                and server["name"] == "GET /api/tkb"
+                and by_name.get("rbac.evaluate", {}).get("parentSpanId") == server["spanId"]
+                and by_name.get("handler", {}).get("parentSpanId") == server["spanId"]
+                and client_span["parentSpanId"] == by_name["handler"]["spanId"]
+                and all(s["traceId"] == caller.trace_id and s["service"] == "demo-app-v5" for s in spans))
+            print("  spans for one sampled /api/tkb:")
+            for s in sorted(spans, key=lambda s: int(s["startTimeUnixNano"])):
+                took = (int(s["endTimeUnixNano"]) - int(s["startTimeUnixNano"])) / 1e6
+                print(f"    {s['name']:28} {took:8.3f} ms")
+
+            unsampled = CALLER[:-2] + "00"
+            response, spans = await call("/api/tkb", unsampled)
+            sent = parse_traceparent(stub.traceparent)
+            results["unsampled caller: propagated, nothing recorded"] = (
+                response.status_code == 200 and not spans and sent is not None
+                and sent.trace_id == caller.trace_id and not sent.sampled and sent.span_id != caller.span_id)
+
+            response, spans = await call("/api/tkb")
+            sent = parse_traceparent(stub.traceparent)
+            results["no traceparent: new trace"] = (
+                sent is not None and sent.trace_id != caller.trace_id and sent.sampled
+                and {s["traceId"] for s in spans} == {sent.trace_id})
+
+            response, spans = await call("/api/tkb", "00-zz-not-a-traceparent-01")
+            sent = parse_traceparent(stub.traceparent)
+            results["malformed traceparent: new trace"] = sent is not None and sent.trace_id != caller.trace_id
+
+            _, spans = await call("/health", CALLER)
+            results["/health is not traced"] = not spans
+            stats = (await client.get("/internal/stats", headers=ADMIN_HEADERS)).json()["tracing"]
+            print(f"  tracer: {stats}")
+    return results
+
+
+def scope(path: str, headers=()) -> dict:
+    return {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+        "scheme": "http", "path": path, "raw_path": path.encode(), "root_path": "",
+        "query_string": b"", "headers": list(headers), "server": ("bench", 80), "client": ("127.0.0.1", 1),
+    }
+
+
+async def receive():
+    return {"type": "http.request", "body": b"", "more_body": False}
+
+
+async def send(message):
+    pass
+
+
+async def drive(app, requests: list[dict], exporter: SpanExporter | None) -> float:
+    started = time.perf_counter()
+    for i, s in enumerate(requests):
+        await app(dict(s), receive, send)
+        if exporter is not None and i % 1000 == 999:
+            await exporter.flush()
+    if exporter is not None:
+        await exporter.flush()
+    return time.perf_counter() - started
+
+
+async def per_request(module, args) -> None:
+    app = module.app
+    layer = app.middleware_stack
+    while layer is not None and not isinstance(layer, TracingMiddleware):
+        layer = getattr(layer, "app", None)
+    bare = layer.app
+    devnull = open(os.devnull, "w", encoding="utf-8")  # noqa: SIM115
+    headers = [(k.encode(), v.encode()) for k, v in STUDENT.items()]
+    workloads = {
+        "GET /api/sinhvien": [scope("/api/sinhvien", headers)] * args.requests,
+        "GET /api/me": [scope("/api/me", headers)] * args.requests,
+    }
+    ratios = sorted({0.0, 0.01, args.ratio, 0.25, 1.0})
+    print(f"\nin-process, {args.requests} requests: {'ratio':>6} {'us/req':>8} {'added us':>9}")
+    for name, requests in workloads.items():
+        t_bare = min([await drive(bare, requests, None) for _ in range(args.rounds)])
+        per_bare = t_bare / len(requests) * 1e6
+        print(f"  {name:34} {'off':>6} {per_bare:8.2f}")
+        for ratio in ratios:
+            exporter = SpanExporter(FileSink(devnull), {"service.name": "bench"})
+            layer.tracer = Tracer("bench", exporter, sample_ratio=ratio)
+            await drive(layer, requests[:1000], exporter)
+            t = min([await drive(layer, requests, exporter) for _ in range(args.rounds)])
+            per = t / len(requests) * 1e6
+            print(f"  {'':34} {ratio:6.2f} {per:8.2f} {per - per_bare:9.2f}")
+
+
+def full_load(tkb_url: str, args) -> bool:
+    configs = {
+        "propagate only": {"TRACE_EXPORTER": "none", "TRACE_SAMPLE_RATIO": "0"},
+        f"ratio {args.ratio}": {"TRACE_EXPORTER": "file", "TRACE_FILE": os.devnull,
+                                "TRACE_SAMPLE_RATIO": str(args.ratio)},
+        "ratio 1.0": {"TRACE_EXPORTER": "file", "TRACE_FILE": os.devnull, "TRACE_SAMPLE_RATIO": "1"},
+    }
+    base = {"TKB_SERVICE_URL": tkb_url, "AUDIT_FILE": os.devnull, "ADMISSION_RATE_SINHVIEN": "0",
+            "ADMISSION_RATE_GIANGVIEN": "0", "ADMISSION_RATE_DEFAULT": "0"}
+    workload = loadtest.Workload("demo-app-v5", {"giangvien": 1, "sinhvien": 3, "anonymous": 0.2}, 10_000, 1)
+    best: dict[str, tuple[float, dict]] = {}
+    for _ in range(args.runs):
+        for name, env in configs.items():
+            with spawn_app("demo-app-v5", env={**base, **env}) as (base_url, proc):
+                asyncio.run(loadtest.drive(base_url, workload, args.concurrency, 1.0))
+                cpu = cpu_seconds(proc.pid)
+                total = asyncio.run(loadtest.drive(base_url, workload, args.concurrency, args.duration))["total"]
+                cpu = cpu_seconds(proc.pid) - cpu
+            # App CPU per request: unlike req/s it does not depend on how much CPU the client got.
+            per_request = cpu / (total["rps"] * args.duration) * 1e6
+            if name not in best or per_request < best[name][0]:
+                best[name] = (per_request, total)
+    print(f"\nfull load through uvicorn, {args.concurrency} connections, best of {args.runs} x {args.duration}s")
+    baseline = best["propagate only"][0]
+    ok = True
+    for name, (per_request, total) in best.items():
+        extra = (per_request - baseline) / baseline * 100
+        print(f"  {name:16} {per_request:8.1f} app CPU us/req {extra:+6.1f}%   {total['rps']:8.1f} req/s"
+              f"  p99 {total['p99']:7.2f} ms")
+        if name == f"ratio {args.ratio}" and extra > args.budget:
+            print(f"FAIL: ratio {args.ratio} costs {extra:.1f}% more CPU per request, budget {args.budget}%")
+            ok = False
+    return ok
+
+
+async def main(args) -> int:
+    with tempfile.TemporaryDirectory() as tmp, serve_in_thread(TracedTkbStub(latency=args.latency)) as stub:
+        trace_file = os.path.join(tmp, "spans.jsonl")
+        open(trace_file, "w").close()
+        os.environ.update({
+            "TKB_SERVICE_URL": stub.url, "TKB_PROXY_MODE": "stream", "TKB_HEDGE": "false",
+            "AUDIT_FILE": os.devnull, "ADMISSION_RATE_SINHVIEN": "0", "TRACE_EXPORTER": "file",
+            "TRACE_FILE": trace_file, "TRACE_SAMPLE_RATIO": "1",
+        })
+        module = load_app("demo-app-v5")
+        print("checks")
+        results = await checks(module, stub, trace_file)
+        for name, passed in results.items():
+            print(f"{'ok  ' if passed else 'FAIL'} {name}")
+        await per_request(module, args)
+    return 0 if all(results.values()) else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=20_000, help="in-process requests per ratio")
+    parser.add_argument("--rounds", type=int, default=3, help="best-of-N in-process timing per ratio")
+    parser.add_argument("--ratio", type=float, default=0.05, help="sample ratio held to the budget")
+    parser.add_argument("--budget", type=float, default=5.0, help="max extra app CPU per request at --ratio, percent")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per full-load run")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--latency", type=float, default=0.005, help="stand-in tkb-service latency (s)")
+    args = parser.parse_args()
+    status = asyncio.run(main(args))
+    with spawn_stub("tkb", "--latency", str(args.latency)) as tkb_url:
+        within_budget = full_load(tkb_url, args)
+    sys.exit(status or (0 if within_budget else 1))
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""Load test both FastAPI apps under uvicorn with local stand-in upstreams.
+
+    python testing/benchmarks/loadtest.py --duration 20 --concurrency 64
+    python testing/benchmarks/loadtest.py --apps demo-app-v5 --save          # write baselines/demo-app-v5.json
+    python testing/benchmarks/loadtest.py --compare --max-regression 15      # diff against saved baselines
+
+For each app a stand-in tkb-service (TKB_SERVICE_URL) and AWS endpoint
+(AWS_URL) run in their own processes with ``--latency``/``--jitter`` per
+request and ``--connect-delay`` per new connection, to look like the
+WireGuard crossing. The app runs as a single uvicorn process, so results
+do not depend on the host's core count (the images run
+``zta_common.launcher``; bench_launcher.py measures that).
+
+Traffic is a closed loop of ``--concurrency`` workers. Each request picks a
+caller from the ``--mix`` population (giangvien / sinhvien / anonymous,
+identified by the x-forwarded-* headers oauth2-proxy would inject) and an
+endpoint from the app's weighted scenario, so denied requests are part of
+the load just as they are in the cluster. Results are reported per
+endpoint (req/s, p50/p95/p99, status codes).
+
+The load generator, app and stand-ins share the machine; on small hosts
+the client saturates first, so only compare baselines taken on the same
+host with the same flags.
+"""
+
+import argparse
+import asyncio
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+
+import httpx
+
+from _common import BENCH_DIR, PROJECT_DIR, percentiles, spawn_app, spawn_stub
+
+BASELINE_DIR = BENCH_DIR / "baselines"
+
+# (endpoint, method, path, weight): what a browser session on each app does.
+SCENARIOS = {
+    "k8s-app": [
+        ("GET /", "GET", "/", 3),
+        ("GET /api/sinhvien", "GET", "/api/sinhvien", 4),
+        ("GET /api/giangvien", "GET", "/api/giangvien", 4),
+        ("GET /api/aws", "GET", "/api/aws", 2),
+        ("GET /health", "GET", "/health", 1),
+    ],
+    "demo-app-v5": [
+        ("GET /", "GET", "/", 3),
+        ("GET /api/me", "GET", "/api/me", 1),
+        ("GET /api/sinhvien", "GET", "/api/sinhvien", 2),
+        ("GET /api/giangvien", "GET", "/api/giangvien", 2),
+        ("GET /api/tkb", "GET", "/api/tkb", 4),
+        ("GET /api/tkb/{path}", "GET", "/api/tkb/schedule", 2),
+        ("GET /health", "GET", "/health", 1),
+    ],
+}
+
+POPULATIONS = ("giangvien", "sinhvien", "anonymous")
+USERS_PER_ROLE = 50
+
+
+def identity_headers(population: str, n: int) -> dict:
+    """Headers oauth2-proxy sets for an authenticated Keycloak user of ``population``."""
+    if population == "anonymous":
+        return {}
+    user = f"{population[:2]}{n:03d}"
+    return {
+        "x-forwarded-user": user,
+        "x-forwarded-preferred-username": user,
+        "x-forwarded-email": f"{user}@zta.local",
+        "x-forwarded-groups": population,
+    }
+
+
+def parse_mix(text: str) -> dict[str, float]:
+    mix = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        if name.strip() not in POPULATIONS:
+            raise argparse.ArgumentTypeError(f"unknown population '{name}', expected {POPULATIONS}")
+        mix[name.strip()] = float(weight)
+    return mix
+
+
+class Workload:
+    """Pre-generated request sequence so the load loop does no random choices or dict building."""
+
+    def __init__(self, app: str, mix: dict[str, float], size: int, seed: int):
+        rng = random.Random(seed)
+        scenario = SCENARIOS[app]
+        callers = [(pop, identity_headers(pop, i)) for pop in mix for i in range(USERS_PER_ROLE)]
+        caller_weights = [mix[pop] for pop, _ in callers]
+        self.items = [
+            (endpoint, method, path, pop, headers)
+            for (endpoint, method, path, _), (pop, headers) in zip(
+                rng.choices(scenario, weights=[w for *_, w in scenario], k=size),
+                rng.choices(callers, weights=caller_weights, k=size),
+            )
+        ]
+
+    def __iter__(self):
+        while True:
+            yield from self.items
+
+
+async def drive(base_url: str, workload: Workload, concurrency: int, duration: float) -> dict:
+    samples: dict[str, list[float]] = defaultdict(list)
+    statuses: dict[str, Counter] = defaultdict(Counter)
+    requests = iter(workload)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30.0) as client:
+        deadline = time.perf_counter() + duration
+
+        async def worker():
+            while time.perf_counter() < deadline:
+                endpoint, method, path, _, headers = next(requests)
+                started = time.perf_counter()
+                try:
+                    response = await client.request(method, path, headers=headers)
+                    await response.aread()
+                    status = str(response.status_code)
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                samples[endpoint].append(time.perf_counter() - started)
+                statuses[endpoint][status] += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    endpoints = {
+        endpoint: {"rps": round(len(s) / elapsed, 1), **percentiles(s), "status": dict(statuses[endpoint])}
+        for endpoint, s in sorted(samples.items())
+    }
+    total = sum(len(s) for s in samples.values())
+    everything = [x for s in samples.values() for x in s]
+    return {"total": {"rps": round(total / elapsed, 1), **percentiles(everything)}, "endpoints": endpoints}
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=PROJECT_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_app(app: str, args) -> dict:
+    upstream = ["--latency", str(args.latency), "--jitter", str(args.jitter),
+                "--connect-delay", str(args.connect_delay)]
+    with spawn_stub("tkb", *upstream) as tkb_url, spawn_stub("plain", *upstream) as aws_url:
+        env = {
+            "TKB_SERVICE_URL": tkb_url,
+            "AWS_URL": aws_url + "/",
+            "AUDIT_FILE": args.audit_file,
+            **dict(item.split("=", 1) for item in args.env),
+        }
+        with spawn_app(app, env=env, extra_args=tuple(args.uvicorn_arg)) as (base_url, _):
+            workload = Workload(app, args.mix, size=10_000, seed=args.seed)
+            if args.warmup > 0:
+                asyncio.run(drive(base_url, workload, args.concurrency, args.warmup))
+            result = asyncio.run(drive(base_url, workload, args.concurrency, args.duration))
+    return {
+        "app": app,
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "config": {
+            "concurrency": args.concurrency, "duration": args.duration, "mix": args.mix,
+            "latency": args.latency, "jitter": args.jitter, "connect_delay": args.connect_delay,
+            "env": args.env, "uvicorn_args": args.uvicorn_arg, "seed": args.seed,
+        },
+        **result,
+    }
+
+
+def print_result(result: dict) -> None:
+    print(f"\n{result['app']} @ {result['revision']}  ({result['config']['concurrency']} workers, "
+          f"{result['config']['duration']}s)")
+    print(f"  {'endpoint':24} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}  status")
+    rows = list(result["endpoints"].items()) + [("TOTAL", result["total"])]
+    for endpoint, r in rows:
+        status = " ".join(f"{k}:{v}" for k, v in sorted(r.get("status", {}).items()))
+        print(f"  {endpoint:24} {r['rps']:9.1f} {r['p50']:8.2f} {r['p95']:8.2f} {r['p99']:8.2f}  {status}")
+
+
+def compare(result: dict, baseline: dict, max_regression: float) -> list[str]:
+    """Print deltas against ``baseline``; return the endpoints that regressed beyond ``max_regression`` %."""
+    regressions = []
+    print(f"  vs baseline @ {baseline.get('revision')} ({baseline.get('timestamp')}):")
+    rows = list(result["endpoints"].items()) + [("TOTAL", result["total"])]
+    base_rows = {**baseline["endpoints"], "TOTAL": baseline["total"]}
+    for endpoint, r in rows:
+        base = base_rows.get(endpoint)
+        if base is None:
+            continue
+        rps = (r["rps"] / base["rps"] - 1) * 100 if base["rps"] else 0.0
+        p99 = (r["p99"] / base["p99"] - 1) * 100 if base["p99"] else 0.0
+        flag = ""
+        if rps < -max_regression or p99 > max_regression:
+            regressions.append(endpoint)
+            flag = "  REGRESSION"
+        print(f"  {endpoint:24} req/s {rps:+7.1f}%   p99 {p99:+7.1f}%{flag}")
+    return regressions
+
+
+def main(args) -> int:
+    failed = []
+    for app in args.apps:
+        result = run_app(app, args)
+        print_result(result)
+        path = BASELINE_DIR / f"{app}.json"
+        if args.compare:
+            if path.exists():
+                failed += [f"{app}: {e}" for e in compare(result, json.loads(path.read_text()), args.max_regression)]
+            else:
+                print(f"  no baseline at {path.relative_to(PROJECT_DIR)}; run with --save first")
+        if args.save:
+            BASELINE_DIR.mkdir(exist_ok=True)
+            path.write_text(json.dumps(result, indent=2, ensure_ascii=False) + "\n")
+            print(f"  saved {path.relative_to(PROJECT_DIR)}")
+        if args.json_out:
+            out = Path(args.json_out)
+            out.parent.mkdir(parents=True, exist_ok=True)
+            with out.open("a") as f:
+                f.write(json.dumps(result, ensure_ascii=False) + "\n")
+    if failed:
+        print("\nregressed beyond", f"{args.max_regression}%:", ", ".join(failed))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--apps", nargs="+", choices=sorted(SCENARIOS), default=sorted(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=15.0, help="measured seconds per app")
+    parser.add_argument("--warmup", type=float, default=3.0)
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("giangvien=0.3,sinhvien=0.5,anonymous=0.2"))
+    parser.add_argument("--latency", type=float, default=0.015, help="stand-in upstream latency (s)")
+    parser.add_argument("--jitter", type=float, default=0.005)
+    parser.add_argument("--connect-delay", type=float, default=0.03)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra app environment, e.g. --env TKB_PROXY_MODE=stream")
+    parser.add_argument("--uvicorn-arg", action="append", default=[], help="passed through to uvicorn")
+    parser.add_argument("--audit-file", default="/dev/null", help="AUDIT_FILE for the app under test")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", action="store_true", help=f"write {BASELINE_DIR.name}/<app>.json")
+    parser.add_argument("--compare", action="store_true", help="diff against the saved baseline")
+    parser.add_argument("--max-regression", type=float, default=10.0,
+                        help="percent drop in req/s or rise in p99 that fails --compare")
+    parser.add_argument("--json-out", help="also append each result as one JSON line to this file")
+    sys.exit(main(parser.parse_args()))
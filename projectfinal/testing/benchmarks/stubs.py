@@ -0,0 +1,266 @@
+"""Local stand-ins for the cross-cloud upstreams (tkb-service, AWS_URL).
+
+A deliberately tiny HTTP/1.1 server on asyncio streams. ``connect_delay``
+is paid once per new TCP connection (the handshake across the WireGuard
+tunnel), ``latency``/``jitter`` on every request, so connection reuse shows
+up in the numbers the same way it does in the real deployment.
+``tail_ratio`` of the requests additionally wait ``tail_latency`` (a
+congested or GC-pausing node), which is what hedged requests are for.
+``capacity`` caps how many requests are served at once (a degraded link);
+the rest wait their turn, so latency grows with the offered load.
+``compress`` answers like tkb-service's ``compression()`` middleware: bodies
+of 1 KiB or more in br (when the ``brotli`` package is installed) or gzip,
+per ``Accept-Encoding``.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import gzip
+import hashlib
+import http
+import json
+import random
+import threading
+from collections import Counter
+
+try:
+    import brotli as _brotli
+except ImportError:
+    _brotli = None
+
+TKB_BODY = {
+    "service": "tkb-service",
+    "location": "AWS Singapore (stand-in)",
+    "role": "sinhvien",
+    "tkb": {
+        "Thứ 2": [{"time": "07:30-09:30", "subject": "Mạng máy tính", "room": "A101"}],
+        "Thứ 3": [{"time": "13:30-15:30", "subject": "Cơ sở dữ liệu", "room": "A201"}],
+    },
+}
+
+
+def _pick_coding(accept_encoding: str) -> str | None:
+    """Highest-q of br/gzip (br on ties, as Express's negotiator does), or None."""
+    q = {}
+    for item in accept_encoding.split(","):
+        coding, _, param = item.partition(";")
+        value = param.strip().removeprefix("q=")
+        q[coding.strip()] = float(value) if value else 1.0
+    offered = [c for c in (("br",) if _brotli is not None else ()) + ("gzip",) if q.get(c, 0) > 0]
+    return max(offered, key=lambda c: q[c], default=None)
+
+
+class StubUpstream:
+    def __init__(self, host="127.0.0.1", port=0, *, connect_delay=0.0, latency=0.0,
+                 jitter=0.0, tail_ratio=0.0, tail_latency=0.0, capacity=0, compress=False, body=None, status=200):
+        self.host = host
+        self.port = port
+        self.connect_delay = connect_delay
+        self.latency = latency
+        self.jitter = jitter
+        self.tail_ratio = tail_ratio
+        self.tail_latency = tail_latency
+        self.capacity = capacity
+        self.compress = compress
+        self._slots = None
+        self.status = status
+        self.body = json.dumps(TKB_BODY if body is None else body, ensure_ascii=False).encode()
+        self.connections = 0
+        self.requests = 0
+        self.requests_by_path: Counter = Counter()
+        self.bytes_sent = 0
+        self._server = None
+        self._writers = set()
+        self._handlers = set()
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self) -> "StubUpstream":
+        if self.capacity:
+            self._slots = asyncio.Semaphore(self.capacity)
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            for writer in list(self._writers):
+                writer.close()
+            # Handlers still sleeping on an injected delay (e.g. a cancelled hedge) never see the close.
+            for task in list(self._handlers):
+                task.cancel()
+            await asyncio.gather(*self._handlers, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    async def _delay(self, base: float) -> None:
+        delay = base + (random.uniform(-self.jitter, self.jitter) if self.jitter else 0.0)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        self._writers.add(writer)
+        self._handlers.add(asyncio.current_task())
+        try:
+            await self._delay(self.connect_delay)
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", "0") or 0)
+                if length:
+                    await reader.readexactly(length)
+                self.requests += 1
+                self.requests_by_path[target.partition("?")[0]] += 1
+                tail = self.tail_latency if self.tail_ratio and random.random() < self.tail_ratio else 0.0
+                if self._slots is None:
+                    await self._delay(self.latency + tail)
+                else:
+                    async with self._slots:
+                        await self._delay(self.latency + tail)
+                status, extra, body = self.respond(method, target, headers)
+                if self.compress and len(body) >= 1024:
+                    extra = {**extra, "vary": "Accept-Encoding"}
+                    coding = _pick_coding(headers.get("accept-encoding", ""))
+                    if coding == "br":
+                        extra["content-encoding"], body = "br", _brotli.compress(body, quality=4)
+                    elif coding == "gzip":
+                        extra["content-encoding"], body = "gzip", gzip.compress(body, 6, mtime=0)
+                head = [f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}", f"content-length: {len(body)}",
+                        "content-type: application/json", "connection: keep-alive"]
+                head += [f"{k}: {v}" for k, v in extra.items()]
+                data = ("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body
+                self.bytes_sent += len(data)
+                writer.write(data)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            self._handlers.discard(asyncio.current_task())
+            writer.close()
+
+    def respond(self, method: str, target: str, headers: dict) -> tuple[int, dict, bytes]:
+        """Hook for subclasses; returns (status, extra headers, body)."""
+        return self.status, {}, self.body
+
+
+class TkbStub(StubUpstream):
+    """Mimics tkb-service: 401 without a user, schedule picked by role, ETag/304."""
+
+    SCHEDULES = {
+        "giangvien": {"Thứ 2": [{"time": "07:30-09:30", "subject": "Mạng máy tính", "class": "CNTT01"}]},
+        "sinhvien": {"Thứ 2": [{"time": "07:30-09:30", "subject": "Mạng máy tính", "teacher": "ThS. A"}]},
+    }
+
+    def respond(self, method, target, headers):
+        user = headers.get("x-forwarded-user", "")
+        roles = {g.strip() for g in headers.get("x-forwarded-groups", "").split(",")}
+        if not user:
+            return 401, {}, b'{"error": "Unauthorized"}'
+        role = next((r for r in ("giangvien", "sinhvien") if r in roles), None)
+        if role is None:
+            return 403, {}, b'{"error": "Forbidden"}'
+        body = json.dumps({"success": True, "user": user, "role": role, "schedule": self.SCHEDULES[role]},
+                          ensure_ascii=False).encode()
+        etag = '"' + hashlib.sha1(json.dumps(self.SCHEDULES[role]).encode()).hexdigest()[:16] + '"'
+        if headers.get("if-none-match") == etag:
+            return 304, {"etag": etag}, b""
+        return 200, {"etag": etag}, body
+
+
+class LargeStub(StubUpstream):
+    """Serves a JSON schedule padded to roughly ``payload_kb`` kilobytes."""
+
+    def __init__(self, payload_kb: int = 1024, **kwargs):
+        row = {"time": "07:30-09:30", "subject": "Mạng máy tính", "room": "A101", "teacher": "ThS. Nguyễn Văn A"}
+        rows = max(1, payload_kb * 1024 // len(json.dumps(row, ensure_ascii=False).encode()))
+        super().__init__(body={"success": True, "user": "stub", "role": "sinhvien",
+                               "schedule": {"rows": [row] * rows}}, **kwargs)
+
+
+class JwksStub(StubUpstream):
+    """Stands in for Keycloak's ``/realms/<realm>/protocol/openid-connect/certs``; ``keys`` can be swapped."""
+
+    def __init__(self, keys: list[dict], **kwargs):
+        super().__init__(**kwargs)
+        self.keys = keys
+
+    def respond(self, method, target, headers):
+        return 200, {"cache-control": "no-cache"}, json.dumps({"keys": self.keys}).encode()
+
+
+STUBS = {"plain": StubUpstream, "tkb": TkbStub, "large": LargeStub}
+
+
+@contextlib.contextmanager
+def serve_in_thread(stub: StubUpstream):
+    """Run ``stub`` on its own event loop in a daemon thread.
+
+    Keeps the stand-in's work off the loop being measured; it still shares
+    the GIL, so absolute numbers are pessimistic but comparisons hold.
+    """
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    asyncio.run_coroutine_threadsafe(stub.start(), loop).result()
+    try:
+        yield stub
+    finally:
+        asyncio.run_coroutine_threadsafe(stub.stop(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+async def _serve_forever(stub: StubUpstream) -> None:
+    await stub.start()
+    print(stub.url, flush=True)
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    # Standalone mode for benchmarks that need the upstream in its own process:
+    #   python stubs.py tkb --latency 0.02   -> prints the URL, serves until killed
+    parser = argparse.ArgumentParser(description="Run a stand-in upstream")
+    parser.add_argument("kind", choices=sorted(STUBS))
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--connect-delay", type=float, default=0.0)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--tail-ratio", type=float, default=0.0)
+    parser.add_argument("--tail-latency", type=float, default=0.0)
+    parser.add_argument("--capacity", type=int, default=0, help="requests served at once (0 = unlimited)")
+    parser.add_argument("--payload-kb", type=int, default=1024, help="large only")
+    parser.add_argument("--compress", action="store_true", help="gzip/br bodies per Accept-Encoding")
+    args = parser.parse_args()
+    options = dict(port=args.port, connect_delay=args.connect_delay, latency=args.latency, jitter=args.jitter,
+                   tail_ratio=args.tail_ratio, tail_latency=args.tail_latency, capacity=args.capacity,
+                   compress=args.compress)
+    if args.kind == "large":
+        options["payload_kb"] = args.payload_kb
+    try:
+        asyncio.run(_serve_forever(STUBS[args.kind](**options)))
+    except KeyboardInterrupt:
+        pass